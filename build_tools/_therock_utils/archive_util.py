@@ -0,0 +1,677 @@
+"""Reading and writing of compressed artifact archives.
+
+Artifact archives are tar files compressed with either:
+
+* xz (`.tar.xz`): The default. Archives are written as a sequence of
+  independently compressed xz streams, one per fixed size block of the tar
+  stream, which lets blocks be compressed on all cores. Concatenated xz
+  streams are part of the xz file format and are transparently decoded by
+  `xz`, `tar -J` and Python's `lzma`/`tarfile`.
+* zstd (`.tar.zst`): Requires the optional `zstandard` package. Uses the
+  native multi-threaded zstd compressor.
+
+Other tarballs (such as the gzip compressed release tarballs) can be streamed
+with `open_gzip_stream` and extracted with `extract_tar_stream`, which decodes
+on a `pigz` subprocess when one is installed and writes files on a thread pool.
+
+Since xz blocks are independent, an xz archive can optionally be written with
+a sidecar index (`{archive}.index`) which maps each member name to its offset
+in the uncompressed tar stream and each block to its compressed offset. An
+`IndexedArchive` uses it to read individual members, decompressing only the
+blocks that contain them.
+"""
+
+from typing import BinaryIO, Callable, Generator
+
+from collections import deque
+import concurrent.futures
+import contextlib
+import gzip
+import json
+import lzma
+import os
+from pathlib import Path
+import shutil
+import stat
+import subprocess
+import tarfile
+import threading
+import time
+
+try:
+    import grp
+    import pwd
+except ImportError:
+    # Windows.
+    grp = pwd = None
+
+ARCHIVE_EXTENSIONS = {
+    ".tar.xz": "xz",
+    ".tar.zst": "zstd",
+}
+
+ARCHIVE_INDEX_SUFFIX = ".index"
+
+# Bumped whenever the archive index format changes.
+_ARCHIVE_INDEX_VERSION = 2
+
+# Default number of compression threads per archive. The build runs many
+# archive steps at once (see `therock_archive` in cmake/therock_job_pools.cmake),
+# and each thread holds up to two blocks and an LZMA encoder in memory, so this
+# is kept small rather than scaling with the number of cores.
+DEFAULT_COMPRESSION_THREADS = 4
+
+# Buffer size used to stream member contents into the tar stream. The tarfile
+# default of 16KiB costs a read syscall and a compressor call per 16KiB.
+COPY_BUFSIZE = 1 << 20
+
+# LZMA dictionary sizes by preset level. As with `xz -T`, blocks are sized at
+# 3x the dictionary so that splitting costs little compression ratio.
+_XZ_DICT_SIZES = [
+    256 << 10,
+    1 << 20,
+    2 << 20,
+    4 << 20,
+    4 << 20,
+    8 << 20,
+    8 << 20,
+    16 << 20,
+    32 << 20,
+    64 << 20,
+]
+
+
+def archive_compression(path: Path | str) -> str:
+    """Returns the compression type ("xz" or "zstd") of an archive path."""
+    name = os.fspath(path)
+    for extension, compression in ARCHIVE_EXTENSIONS.items():
+        if name.endswith(extension):
+            return compression
+    raise ValueError(
+        f"Unsupported archive extension for {name} "
+        f"(expected one of {', '.join(ARCHIVE_EXTENSIONS)})"
+    )
+
+
+def archive_index_path(path: Path) -> Path:
+    """Returns the path of the sidecar index of an archive."""
+    return path.with_name(f"{path.name}{ARCHIVE_INDEX_SUFFIX}")
+
+
+def _import_zstandard():
+    try:
+        import zstandard
+    except ModuleNotFoundError as e:
+        raise ModuleNotFoundError(
+            "The 'zstandard' package is required for .tar.zst archives "
+            "(pip install zstandard)"
+        ) from e
+    return zstandard
+
+
+class ParallelXzCompressor:
+    """Write-only file object which compresses blocks on a thread pool.
+
+    Each block is compressed into its own xz stream. Blocks are written to
+    the output in order and at most 2x `threads` blocks are in flight, which
+    bounds memory use.
+    """
+
+    def __init__(self, fileobj, *, preset: int, threads: int):
+        self.fileobj = fileobj
+        self.preset = preset
+        self.block_size = 3 * _XZ_DICT_SIZES[min(max(preset, 0), 9)]
+        self.max_pending = 2 * threads
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+        self.pending: deque[concurrent.futures.Future] = deque()
+        self.buffer = bytearray()
+        self.blocks = 0
+        self.compressed_block_sizes: list[int] = []
+
+    def write(self, data) -> int:
+        self.buffer += data
+        block_size = self.block_size
+        while len(self.buffer) >= block_size:
+            self._submit(bytes(self.buffer[:block_size]))
+            del self.buffer[:block_size]
+        return len(data)
+
+    def _submit(self, block: bytes):
+        self.blocks += 1
+        self.pending.append(
+            self.executor.submit(
+                lzma.compress, block, format=lzma.FORMAT_XZ, preset=self.preset
+            )
+        )
+        while len(self.pending) > self.max_pending:
+            self._write_next()
+
+    def _write_next(self):
+        compressed = self.pending.popleft().result()
+        self.compressed_block_sizes.append(len(compressed))
+        self.fileobj.write(compressed)
+
+    def close(self):
+        # Always emit at least one stream so that an empty input is valid xz.
+        if self.buffer or not self.blocks:
+            self._submit(bytes(self.buffer))
+            self.buffer.clear()
+        try:
+            while self.pending:
+                self._write_next()
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+
+
+class ZstdCompressor:
+    """Write-only file object which compresses with multi-threaded zstd."""
+
+    def __init__(self, fileobj, *, level: int, threads: int):
+        zstandard = _import_zstandard()
+        self.writer = zstandard.ZstdCompressor(
+            level=level, threads=threads
+        ).stream_writer(fileobj, closefd=False)
+
+    def write(self, data) -> int:
+        self.writer.write(data)
+        return len(data)
+
+    def close(self):
+        self.writer.close()
+
+
+class _IndexingTarFile(tarfile.TarFile):
+    """TarFile which records the stream offset of each added member."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.member_offsets: list[tuple[str, int]] = []
+
+    def addfile(self, tarinfo, fileobj=None):
+        self.member_offsets.append((tarinfo.name, self.offset))
+        super().addfile(tarinfo, fileobj)
+
+
+class ArchiveWriter:
+    """Writes a tar archive, compressing with multiple threads.
+
+    The compression type is determined by the output file extension. For xz,
+    `compression_level` is the LZMA preset [0-9]. For zstd, it is the zstd
+    level (0 selects the zstd default). `threads` is the number of compression
+    threads, or 0 to use all cores. If `index`, an xz archive is written with a
+    sidecar index for random access (see `IndexedArchive`).
+
+    Usage:
+        with ArchiveWriter(path, compression_level=6) as writer:
+            writer.tar.add(...)
+            writer.add_direntry(dir_entry, arcname)
+        print(writer.throughput_summary())
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        *,
+        compression_level: int,
+        threads: int = DEFAULT_COMPRESSION_THREADS,
+        index: bool = False,
+    ):
+        self.path = path
+        self.compression = archive_compression(path)
+        if index and self.compression != "xz":
+            raise ValueError(f"Archive indexes are only supported for .tar.xz: {path}")
+        self.index = index
+        self.threads = threads or os.cpu_count() or 1
+        self.compression_level = compression_level
+        self.uncompressed_bytes = 0
+        self.compressed_bytes = 0
+        self.elapsed = 0.0
+        self._unames: dict[int, str] = {}
+        self._gnames: dict[int, str] = {}
+
+    def __enter__(self) -> "ArchiveWriter":
+        self._start = time.monotonic()
+        self._file = open(self.path, "xb")
+        try:
+            if self.compression == "zstd":
+                self._compressor = ZstdCompressor(
+                    self._file, level=self.compression_level, threads=self.threads
+                )
+            else:
+                self._compressor = ParallelXzCompressor(
+                    self._file, preset=self.compression_level, threads=self.threads
+                )
+            self.tar = _IndexingTarFile.open(fileobj=self, mode="w|")
+            self.tar.copybufsize = COPY_BUFSIZE
+        except BaseException:
+            self._file.close()
+            raise
+        return self
+
+    def write(self, data) -> int:
+        # Receives the uncompressed tar stream.
+        self.uncompressed_bytes += len(data)
+        return self._compressor.write(data)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.tar.close()
+            self._compressor.close()
+            self.compressed_bytes = self._file.tell()
+        finally:
+            self._file.close()
+            self.elapsed = time.monotonic() - self._start
+        if self.index and exc_type is None:
+            self._write_index()
+
+    def _write_index(self):
+        block_offsets = [0]
+        for size in self._compressor.compressed_block_sizes:
+            block_offsets.append(block_offsets[-1] + size)
+        index_path = archive_index_path(self.path)
+        tmp_path = index_path.with_name(f"{index_path.name}.tmp")
+        with open(tmp_path, "wt") as f:
+            json.dump(
+                {
+                    "version": _ARCHIVE_INDEX_VERSION,
+                    # Identifies the archive which the index describes.
+                    "archive_size": self.compressed_bytes,
+                    "size": self.uncompressed_bytes,
+                    "block_size": self._compressor.block_size,
+                    "block_offsets": block_offsets,
+                    "members": self.tar.member_offsets,
+                },
+                f,
+                separators=(",", ":"),
+            )
+        os.replace(tmp_path, index_path)
+
+    def add_direntry(self, direntry: os.DirEntry[str], arcname: str):
+        """Adds a scanned file system entry (non-recursively).
+
+        This is equivalent to `tar.add(direntry.path, arcname, recursive=False)`
+        but builds the TarInfo from the stat result cached on the entry rather
+        than re-stating the path, and caches owner/group name lookups.
+        """
+        tar = self.tar
+        st = direntry.stat(follow_symlinks=False)
+        mode = st.st_mode
+        ti = tarfile.TarInfo(arcname)
+        ti.mode = stat.S_IMODE(mode)
+        ti.uid = st.st_uid
+        ti.gid = st.st_gid
+        ti.mtime = st.st_mtime
+        ti.uname = self._uname(st.st_uid)
+        ti.gname = self._gname(st.st_gid)
+        if stat.S_ISREG(mode):
+            # Mirror tarfile's hardlink detection within the archive.
+            inode = (st.st_ino, st.st_dev)
+            if st.st_nlink > 1 and tar.inodes.get(inode, arcname) != arcname:
+                ti.type = tarfile.LNKTYPE
+                ti.linkname = tar.inodes[inode]
+                tar.addfile(ti)
+                return
+            if inode[0]:
+                tar.inodes[inode] = arcname
+            ti.type = tarfile.REGTYPE
+            ti.size = st.st_size
+            with open(direntry.path, "rb") as f:
+                tar.addfile(ti, f)
+        elif stat.S_ISDIR(mode):
+            ti.type = tarfile.DIRTYPE
+            tar.addfile(ti)
+        elif stat.S_ISLNK(mode):
+            ti.type = tarfile.SYMTYPE
+            ti.linkname = os.readlink(direntry.path)
+            tar.addfile(ti)
+        else:
+            tar.add(direntry.path, arcname=arcname, recursive=False)
+
+    def _uname(self, uid: int) -> str:
+        uname = self._unames.get(uid)
+        if uname is None:
+            uname = ""
+            if pwd:
+                try:
+                    uname = pwd.getpwuid(uid)[0]
+                except KeyError:
+                    pass
+            self._unames[uid] = uname
+        return uname
+
+    def _gname(self, gid: int) -> str:
+        gname = self._gnames.get(gid)
+        if gname is None:
+            gname = ""
+            if grp:
+                try:
+                    gname = grp.getgrgid(gid)[0]
+                except KeyError:
+                    pass
+            self._gnames[gid] = gname
+        return gname
+
+    def throughput_summary(self) -> str:
+        mb_in = self.uncompressed_bytes / 1e6
+        mb_out = self.compressed_bytes / 1e6
+        rate = mb_in / self.elapsed if self.elapsed > 0 else 0.0
+        return (
+            f"{self.path.name}: {mb_in:.1f} MB -> {mb_out:.1f} MB "
+            f"({self.compression}, {self.threads} threads) in {self.elapsed:.2f}s "
+            f"= {rate:.1f} MB/s"
+        )
+
+
+@contextlib.contextmanager
+def open_archive(path: Path) -> Generator[tarfile.TarFile, None, None]:
+    """Opens an artifact archive for sequential reading.
+
+    Members must be processed in order (via `next()` or iteration), as zstd
+    archives are read as a stream.
+    """
+    compression = archive_compression(path)
+    if compression == "zstd":
+        with open(path, "rb") as f, open_archive_stream(f, compression) as tf:
+            yield tf
+    else:
+        with tarfile.open(path, mode="r:xz") as tf:
+            yield tf
+
+
+@contextlib.contextmanager
+def open_archive_stream(
+    fileobj, compression: str
+) -> Generator[tarfile.TarFile, None, None]:
+    """Opens an artifact archive from a non-seekable stream of compressed bytes.
+
+    As with `open_archive`, members must be processed in order. The stream is
+    decompressed incrementally as members are read, so the archive never needs
+    to exist as a file.
+    """
+    if compression == "zstd":
+        zstandard = _import_zstandard()
+        reader = zstandard.ZstdDecompressor().stream_reader(fileobj, closefd=False)
+    else:
+        # Unlike tarfile's "r|xz" mode, LZMAFile decodes concatenated streams.
+        reader = lzma.LZMAFile(fileobj)
+    with reader, tarfile.open(fileobj=reader, mode="r|", bufsize=COPY_BUFSIZE) as tf:
+        yield tf
+
+
+@contextlib.contextmanager
+def open_gzip_stream(
+    fileobj, *, use_pigz: bool = True
+) -> Generator[BinaryIO, None, None]:
+    """Decompresses a non-seekable stream of gzip compressed bytes.
+
+    If `pigz` is installed (and `use_pigz`), the stream is piped through it,
+    which decodes on separate threads (and cores) from the reader. Otherwise
+    it is decoded in-process with `gzip`.
+    """
+    pigz = shutil.which("pigz") if use_pigz else None
+    if not pigz:
+        with gzip.GzipFile(fileobj=fileobj, mode="rb") as reader:
+            yield reader
+        return
+
+    proc = subprocess.Popen(
+        [pigz, "-dc"], stdin=subprocess.PIPE, stdout=subprocess.PIPE
+    )
+    feed_errors: list[BaseException] = []
+
+    def feed():
+        try:
+            while chunk := fileobj.read(COPY_BUFSIZE):
+                proc.stdin.write(chunk)
+        except BrokenPipeError:
+            # pigz exited early, which is reported by its exit code.
+            pass
+        except BaseException as e:
+            feed_errors.append(e)
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    feeder = threading.Thread(target=feed, name="pigz-feed", daemon=True)
+    feeder.start()
+    try:
+        yield proc.stdout
+        # Consume trailing output (such as tar padding), so that pigz does
+        # not fail writing it.
+        while proc.stdout.read(COPY_BUFSIZE):
+            pass
+    finally:
+        proc.stdout.close()
+        feeder.join()
+        returncode = proc.wait()
+    if feed_errors:
+        raise feed_errors[0]
+    if returncode != 0:
+        raise IOError(f"pigz failed decompressing with exit code {returncode}")
+
+
+def extract_tar_stream(
+    tf: tarfile.TarFile,
+    output_path: Path,
+    *,
+    write_threads: int = 4,
+    memory_limit: int = 64 << 20,
+    on_member: Callable[[tarfile.TarInfo], None] | None = None,
+) -> tuple[int, int]:
+    """Extracts all members of a tar file which is read sequentially.
+
+    This is equivalent to `tf.extractall(output_path, filter="tar")`, but
+    files which fit in the copy buffer are read whole and written on a thread
+    pool (holding at most `memory_limit` bytes of their contents), so that
+    reading the archive overlaps writing files. Larger files are streamed
+    through the copy buffer on the reading thread.
+
+    Returns the number of files and bytes extracted.
+    """
+    file_count = 0
+    byte_count = 0
+    # Pending writes of each file member, for resolving hardlinks.
+    file_writes: dict[str, tuple[Path, concurrent.futures.Future | None]] = {}
+    # Writes queued on the thread pool and the size of their contents.
+    pending: deque[tuple[concurrent.futures.Future, int]] = deque()
+    pending_bytes = 0
+    max_pending = 2 * write_threads
+    copy_size = min(COPY_BUFSIZE, memory_limit)
+    with concurrent.futures.ThreadPoolExecutor(write_threads) as executor:
+        while member := tf.next():
+            if on_member:
+                on_member(member)
+            member = tarfile.tar_filter(member, os.fspath(output_path))
+            dest_path = output_path / member.name
+            # Existing entries are replaced, including directories replaced
+            # by a file.
+            if dest_path.is_symlink() or (
+                dest_path.exists() and not dest_path.is_dir()
+            ):
+                os.unlink(dest_path)
+            elif dest_path.is_dir() and not member.isdir():
+                shutil.rmtree(dest_path)
+            if member.isdir():
+                dest_path.mkdir(parents=True, exist_ok=True)
+                continue
+            dest_path.parent.mkdir(parents=True, exist_ok=True)
+            if member.isfile():
+                file_count += 1
+                byte_count += member.size
+                if member.size > copy_size:
+                    with tf.extractfile(member) as member_file, open(
+                        dest_path, "wb"
+                    ) as out_file:
+                        shutil.copyfileobj(member_file, out_file, copy_size)
+                    _set_file_attributes(dest_path, member.mode, member.mtime)
+                    file_writes[member.name] = (dest_path, None)
+                    continue
+                while pending and (
+                    len(pending) >= max_pending
+                    or pending_bytes + member.size > memory_limit
+                ):
+                    done_future, done_size = pending.popleft()
+                    done_future.result()
+                    pending_bytes -= done_size
+                with tf.extractfile(member) as member_file:
+                    data = member_file.read()
+                future = executor.submit(
+                    _write_file, dest_path, data, member.mode, member.mtime
+                )
+                file_writes[member.name] = (dest_path, future)
+                pending.append((future, member.size))
+                pending_bytes += member.size
+            elif member.issym():
+                dest_path.symlink_to(member.linkname)
+            elif member.islnk():
+                # Hardlink to a file earlier in the archive.
+                link_source, link_future = file_writes[member.linkname]
+                if link_future:
+                    link_future.result()
+                try:
+                    os.link(link_source, dest_path)
+                except OSError:
+                    shutil.copy2(link_source, dest_path)
+                file_writes[member.name] = (dest_path, None)
+            else:
+                raise IOError(f"Unhandled tar member: {member}")
+        for future, _ in pending:
+            future.result()
+    return file_count, byte_count
+
+
+def _write_file(dest_path: Path, data: bytes, mode: int, mtime: float):
+    with open(dest_path, "wb") as out_file:
+        out_file.write(data)
+    _set_file_attributes(dest_path, mode, mtime)
+
+
+def _set_file_attributes(dest_path: Path, mode: int, mtime: float):
+    os.chmod(dest_path, mode)
+    os.utime(dest_path, (mtime, mtime))
+
+
+class _IndexedXzReader:
+    """Seekable read-only file object over the tar stream of an indexed archive.
+
+    Only the most recently used block is kept decompressed, so members should
+    be read in archive order to decompress each block at most once.
+    """
+
+    def __init__(self, fileobj, *, size: int, block_size: int, block_offsets: list):
+        self.fileobj = fileobj
+        self.size = size
+        self.block_size = block_size
+        self.block_offsets = block_offsets
+        self.position = 0
+        self.blocks_decompressed = 0
+        self._block_number = -1
+        self._block = b""
+
+    def _load_block(self, block_number: int):
+        if block_number != self._block_number:
+            start = self.block_offsets[block_number]
+            self.fileobj.seek(start)
+            compressed = self.fileobj.read(self.block_offsets[block_number + 1] - start)
+            self._block = lzma.decompress(compressed, format=lzma.FORMAT_XZ)
+            self._block_number = block_number
+            self.blocks_decompressed += 1
+
+    def read(self, size: int = -1) -> bytes:
+        end = self.size if size < 0 else min(self.position + size, self.size)
+        chunks = []
+        while self.position < end:
+            block_number, block_offset = divmod(self.position, self.block_size)
+            self._load_block(block_number)
+            chunk = self._block[block_offset : block_offset + end - self.position]
+            chunks.append(chunk)
+            self.position += len(chunk)
+        return b"".join(chunks)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.position = offset
+        return offset
+
+    def tell(self) -> int:
+        return self.position
+
+
+class IndexedArchive:
+    """Random access reader of an xz archive written with an index.
+
+    Usage:
+        with IndexedArchive(path) as archive:
+            member = archive.getmember("artifact_manifest.txt")
+            with archive.tar.extractfile(member) as f:
+                ...
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        index = IndexedArchive._load_index(path)
+        self._index = index
+        # Later members of the same name replace earlier ones, as with tar.
+        self.member_offsets: dict[str, int] = dict(index["members"])
+
+    @staticmethod
+    def _load_index(path: Path) -> dict:
+        """Loads the index of an archive, raising if it does not match it."""
+        index_path = archive_index_path(path)
+        with open(index_path, "rt") as f:
+            index = json.load(f)
+        if index.get("version") != _ARCHIVE_INDEX_VERSION:
+            raise IOError(f"Unsupported archive index version in {index_path}")
+        if index["archive_size"] != path.stat().st_size:
+            raise IOError(
+                f"Archive index {index_path} is stale: it describes an archive of "
+                f"{index['archive_size']} bytes, not {path.stat().st_size}"
+            )
+        return index
+
+    @staticmethod
+    def has_index(path: Path) -> bool:
+        """Returns whether an archive has an index which matches it."""
+        try:
+            IndexedArchive._load_index(path)
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def __enter__(self) -> "IndexedArchive":
+        self._file = open(self.path, "rb")
+        try:
+            self.reader = _IndexedXzReader(
+                self._file,
+                size=self._index["size"],
+                block_size=self._index["block_size"],
+                block_offsets=self._index["block_offsets"],
+            )
+            self.tar = tarfile.TarFile(fileobj=self.reader, mode="r")
+        except BaseException:
+            self._file.close()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._file.close()
+
+    @property
+    def block_count(self) -> int:
+        return len(self._index["block_offsets"]) - 1
+
+    def getmember(self, name: str) -> tarfile.TarInfo:
+        """Reads the header of a member, decompressing only its block(s)."""
+        offset = self.member_offsets.get(name)
+        if offset is None:
+            raise KeyError(f"{name} not found in {self.path}")
+        self.reader.seek(offset)
+        member = tarfile.TarInfo.fromtarfile(self.tar)
+        if member.name != name:
+            raise IOError(f"Archive index of {self.path} is inconsistent at {name}")
+        return member
@@ -0,0 +1,100 @@
+"""Runtime dependency graph between artifacts.
+
+The build writes `artifacts/artifact_graph_{target_family}.json` (see
+`therock_write_artifact_graph` in cmake/therock_artifacts.cmake), which lists
+every artifact slice, its components and the slices it depends on at runtime
+(derived from the RUNTIME_DEPS of the subprojects in each slice):
+
+    {"version": 1, "artifacts": {"blas": {"components": ["lib", "test"],
+                                          "deps": ["base", "core-hip"]}}}
+
+Consumers use it to resolve exactly the artifacts needed for a selection
+(see `ArtifactGraph.closure`) rather than maintaining lists by hand.
+"""
+
+from typing import Iterable
+
+import json
+from pathlib import Path
+
+ARTIFACT_GRAPH_VERSION = 1
+
+# Components which need the `lib` component of their own artifact.
+_COMPONENTS_NEEDING_LIB = ("run", "test")
+
+
+def artifact_graph_filename(target_family: str) -> str:
+    return f"artifact_graph_{target_family}.json"
+
+
+class ArtifactGraph:
+    def __init__(self, components: dict[str, list[str]], deps: dict[str, list[str]]):
+        self.components = components
+        self.deps = deps
+
+    @staticmethod
+    def from_json(text: str) -> "ArtifactGraph":
+        contents = json.loads(text)
+        if contents.get("version") != ARTIFACT_GRAPH_VERSION:
+            raise IOError(
+                f"Unsupported artifact graph version {contents.get('version')} "
+                f"(expected {ARTIFACT_GRAPH_VERSION})"
+            )
+        artifacts = contents["artifacts"]
+        return ArtifactGraph(
+            components={name: a["components"] for name, a in artifacts.items()},
+            deps={name: a["deps"] for name, a in artifacts.items()},
+        )
+
+    @staticmethod
+    def load(path: Path) -> "ArtifactGraph":
+        return ArtifactGraph.from_json(path.read_text())
+
+    def transitive_deps(self, name: str) -> list[str]:
+        """Returns the transitive deps of an artifact, dependencies first."""
+        ordered: list[str] = []
+        visited: set[str] = {name}
+
+        def visit(current: str):
+            for dep in self.deps.get(current, []):
+                if dep not in visited:
+                    visited.add(dep)
+                    visit(dep)
+                    ordered.append(dep)
+
+        visit(name)
+        return ordered
+
+    def closure(self, artifact_names: Iterable[str]) -> list[str]:
+        """Resolves `{name}_{component}` artifacts to everything they need.
+
+        The closure contains each requested component, the `lib` component of
+        every transitive dependency and, for `run` and `test` components, the
+        artifact's own `lib` component. Artifacts and components which are not
+        in the graph are skipped. Dependencies are ordered before dependents.
+        """
+        selected: set[str] = set()
+        for artifact_name in artifact_names:
+            name, component = artifact_name.split("_")
+            if component not in self.components.get(name, []):
+                continue
+            selected.add(artifact_name)
+            needs_lib = self.transitive_deps(name)
+            if component in _COMPONENTS_NEEDING_LIB:
+                needs_lib.append(name)
+            for dep in needs_lib:
+                if "lib" in self.components.get(dep, []):
+                    selected.add(f"{dep}_lib")
+
+        # Order by artifact, dependencies first.
+        order: dict[str, int] = {}
+        for name in sorted(self.components):
+            for dep in self.transitive_deps(name) + [name]:
+                order.setdefault(dep, len(order))
+        return sorted(
+            selected,
+            key=lambda artifact_name: (
+                order[artifact_name.split("_")[0]],
+                artifact_name,
+            ),
+        )
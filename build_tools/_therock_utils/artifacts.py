@@ -18,16 +18,45 @@ contains one relative path per line. That path represents a path into a TheRock
 build directory that its contents are subset from.
 """
 
-from typing import Callable, Optional, Sequence
+from typing import BinaryIO, Callable, Iterable, Iterator, Optional, Sequence
 
+from collections import deque
+import concurrent.futures
+import copy
+from dataclasses import dataclass, field
+import hashlib
 import os
 import re
 from pathlib import Path, PurePosixPath
+import shutil
+import stat
 import tarfile
+import threading
+import time
 
+from .archive_util import (
+    COPY_BUFSIZE,
+    archive_compression,
+    open_archive,
+    open_archive_stream,
+)
+from .content_store import (
+    ARTIFACT_CONTENTS_NAME,
+    CONTENTS_HASH_ALGORITHM,
+    ContentsEntry,
+    ContentStore,
+    hash_file,
+    parse_contents_manifest,
+)
 from .pattern_match import PatternMatcher, MatchPredicate
 
 
+# Matches {name}_{component}_{target_family}.
+_ARTIFACT_DIRNAME_RE = re.compile(r"^([^_]+)_([^_]+)_([^_]+)$")
+# Matches {name}_{component}_{target_family} and an archive extension.
+_ARTIFACT_FILENAME_RE = re.compile(r"^([^_]+)_([^_]+)_([^_]+)\.tar\.(xz|zst)$")
+
+
 class ArtifactName:
     def __init__(self, name: str, component: str, target_family: str):
         self.name = name
@@ -38,18 +67,20 @@ class ArtifactName:
     def from_path(path: Path) -> Optional["ArtifactName"]:
         filename = path.name
         if path.is_dir():
-            # Matches {name}_{component}_{target_family}.
-            m = re.match(r"^([^_]+)_([^_]+)_([^_]+)$", filename)
-            if not m:
-                return None
-            return ArtifactName(m.group(1), m.group(2), m.group(3))
+            return ArtifactName.from_dirname(filename)
         else:
             return ArtifactName.from_filename(filename)
 
+    @staticmethod
+    def from_dirname(dirname: str) -> Optional["ArtifactName"]:
+        m = _ARTIFACT_DIRNAME_RE.match(dirname)
+        if not m:
+            return None
+        return ArtifactName(m.group(1), m.group(2), m.group(3))
+
     @staticmethod
     def from_filename(filename: str) -> Optional["ArtifactName"]:
-        # Matches {name}_{component}_{target_family} and an archive extension.
-        m = re.match(r"^([^_]+)_([^_]+)_([^_]+)\.tar.xz$", filename)
+        m = _ARTIFACT_FILENAME_RE.match(filename)
         if not m:
             return None
         return ArtifactName(m.group(1), m.group(2), m.group(3))
@@ -70,11 +101,116 @@ class ArtifactName:
         return hash((self.name, self.component, self.target_family))
 
 
+class ArtifactRegistry:
+    """Table of artifacts parsed once from a directory or an S3 listing.
+
+    Each artifact name maps to the file (or directory) name it was found as,
+    and artifacts are indexed by name, component and target family so that
+    set queries such as "all lib components for family X plus generic" are
+    answered without re-parsing names or re-listing directories. Where an
+    artifact is present more than once (i.e. as a directory and an archive),
+    the first by sorted file name wins.
+    """
+
+    def __init__(self):
+        self._filenames: dict[ArtifactName, str] = {}
+        self._by_name: dict[str, set[ArtifactName]] = {}
+        self._by_component: dict[str, set[ArtifactName]] = {}
+        self._by_target_family: dict[str, set[ArtifactName]] = {}
+
+    @staticmethod
+    def from_filenames(filenames: Iterable[str]) -> "ArtifactRegistry":
+        """Registers artifact archive file names (e.g. from an S3 listing)."""
+        registry = ArtifactRegistry()
+        for filename in sorted(filenames):
+            an = ArtifactName.from_filename(filename)
+            if an:
+                registry.add(an, filename)
+        return registry
+
+    @staticmethod
+    def from_dir(
+        artifact_dir: Path,
+        *,
+        include_dirs: bool = True,
+        include_archives: bool = True,
+    ) -> "ArtifactRegistry":
+        """Registers the artifact directories and/or archives in a directory."""
+        registry = ArtifactRegistry()
+        with os.scandir(artifact_dir) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        for entry in entries:
+            if entry.is_dir():
+                an = ArtifactName.from_dirname(entry.name) if include_dirs else None
+            else:
+                an = (
+                    ArtifactName.from_filename(entry.name) if include_archives else None
+                )
+            if an:
+                registry.add(an, entry.name)
+        return registry
+
+    def add(self, an: ArtifactName, filename: str) -> bool:
+        """Adds an artifact, returning False if it was already present."""
+        if an in self._filenames:
+            return False
+        self._filenames[an] = filename
+        self._by_name.setdefault(an.name, set()).add(an)
+        self._by_component.setdefault(an.component, set()).add(an)
+        self._by_target_family.setdefault(an.target_family, set()).add(an)
+        return True
+
+    def filename(self, an: ArtifactName) -> str | None:
+        return self._filenames.get(an)
+
+    def query(
+        self,
+        *,
+        names: Iterable[str] | None = None,
+        components: Iterable[str] | None = None,
+        target_families: Iterable[str] | None = None,
+    ) -> set[ArtifactName]:
+        """Returns the artifacts matching any of the given values of each field.
+
+        Fields which are not given are not constrained.
+        """
+        result: set[ArtifactName] | None = None
+        for index, keys in [
+            (self._by_name, names),
+            (self._by_component, components),
+            (self._by_target_family, target_families),
+        ]:
+            if keys is None:
+                continue
+            matched = set().union(*(index.get(key, ()) for key in keys))
+            result = matched if result is None else result & matched
+        return set(self._filenames) if result is None else result
+
+    @property
+    def target_families(self) -> set[str]:
+        return set(self._by_target_family.keys())
+
+    def __contains__(self, an: ArtifactName) -> bool:
+        return an in self._filenames
+
+    def __iter__(self) -> Iterator[ArtifactName]:
+        """Iterates over artifacts in file name order."""
+        return iter(self._filenames)
+
+    def __len__(self) -> int:
+        return len(self._filenames)
+
+
 class ArtifactCatalog:
     """Scans a directory containing exploded artifact sub-directories.
 
     This is used for various packaging activities that need to operate on
     actual files in the file system (vs as part of compressed/remote archives).
+
+    Artifact base directories are only scanned when the `pm` of a catalog is
+    first used, and each is scanned at most once. Catalogs derived with
+    `project()` share the scans of the catalog they were derived from, so
+    serving many filtered views of the same artifacts costs one scan.
     """
 
     def __init__(
@@ -85,17 +221,18 @@ class ArtifactCatalog:
         excludes: Sequence[str] = (),
     ):
         self.artifact_dir = artifact_dir
+        self.registry = ArtifactRegistry.from_dir(artifact_dir, include_archives=False)
         self.artifact_basedirs: list[tuple[ArtifactName, Path]] = []
-        self.pm = PatternMatcher(includes=includes, excludes=excludes)
+        self.includes = includes
+        self.excludes = excludes
+        # Unpruned scans of each artifact basedir, shared with projections.
+        self._scans: dict[Path, dict[str, os.DirEntry[str]]] = {}
+        self._pm: PatternMatcher | None = None
 
-        for subdir in self.artifact_dir.iterdir():
-            if not subdir.is_dir():
-                continue
-            name = ArtifactName.from_path(subdir)
-            if not name:
-                continue
+        for name in self.registry:
             if not filter(name):
                 continue
+            subdir = self.artifact_dir / self.registry.filename(name)
             manifest = subdir / "artifact_manifest.txt"
             if not manifest.exists():
                 continue
@@ -106,7 +243,44 @@ class ArtifactCatalog:
                 full_path = subdir / manifest_line
                 if full_path.exists():
                     self.artifact_basedirs.append((name, full_path))
-                    self.pm.add_basedir(full_path)
+
+    def project(
+        self,
+        filter: Callable[[ArtifactName], bool] = lambda _: True,
+        includes: Sequence[str] = (),
+        excludes: Sequence[str] = (),
+    ) -> "ArtifactCatalog":
+        """Returns a catalog of the subset of artifacts matching `filter`.
+
+        The includes and excludes of the projection replace (rather than
+        refine) those of this catalog.
+        """
+        view = copy.copy(self)
+        view.artifact_basedirs = [
+            (an, basedir) for an, basedir in self.artifact_basedirs if filter(an)
+        ]
+        view.includes = includes
+        view.excludes = excludes
+        view._pm = None
+        return view
+
+    @property
+    def pm(self) -> PatternMatcher:
+        """PatternMatcher over all artifact basedirs, filtered by the patterns."""
+        if self._pm is None:
+            pm = PatternMatcher(includes=self.includes, excludes=self.excludes)
+            for _, basedir in self.artifact_basedirs:
+                pm.add_entries(self._scan(basedir))
+            self._pm = pm
+        return self._pm
+
+    def _scan(self, basedir: Path) -> dict[str, os.DirEntry[str]]:
+        entries = self._scans.get(basedir)
+        if entries is None:
+            pm = PatternMatcher()
+            pm.add_basedir(basedir)
+            entries = self._scans[basedir] = pm.all
+        return entries
 
     @property
     def artifact_names(self) -> list[ArtifactName]:
@@ -128,15 +302,65 @@ class ArtifactPopulator:
     The set of all relative root paths from all encountered artifact manifests.
     These paths can be interpreted relative to the output_path to get a full
     populated path on the filesystem.
+
+    If a `content_store` is given and an archive carries an
+    `artifact_contents.txt` manifest, files whose contents are already in the
+    store are hardlinked from it rather than written, and newly written files
+    are verified against their digest and copied into the store.
+
+    Archives are extracted in this process by default. With `jobs` > 1 (or 0
+    for all cores), consecutive archives are extracted in parallel on up to
+    `jobs` processes, each writing files on `write_threads` threads. Each
+    process is spawned (on Windows and macOS) and re-imports the main module,
+    which can cost more than it saves for a few small archives. The
+    manifests of all archives are read (and the relpath callbacks invoked)
+    before any are extracted. When extracting in parallel, each archive is
+    extracted into its own staging directory and the staging directories are
+    merged into the output in argument order, so where artifacts overlap, the
+    later artifact wins exactly as when populating sequentially.
+
+    Member contents are streamed to disk through a fixed buffer. Each
+    extracting process holds at most `memory_limit` bytes of member contents
+    in memory at a time (small files queued for the writer threads), however
+    large the members are.
+
+    If `update`, files, symlinks and hardlinks which already exist in the
+    output with identical contents are left alone rather than rewritten.
+    Extracted files keep their archived mtime, and a file is considered
+    identical if its size, executable bits and mtime match the archive member.
+    If the archive carries an `artifact_contents.txt`, a file whose mtime
+    differs is also identical if its digest matches.
+
+    Archives can also be populated from streams of their compressed bytes
+    (see `populate_streams`), which overlaps fetching, decompressing and
+    extracting them without the archives ever being written to disk.
     """
 
     def __init__(
-        self, *, output_path: Path, verbose: bool = False, flatten: bool = False
+        self,
+        *,
+        output_path: Path,
+        verbose: bool = False,
+        flatten: bool = False,
+        content_store: ContentStore | None = None,
+        jobs: int = 1,
+        write_threads: int = 4,
+        memory_limit: int = 64 << 20,
+        update: bool = False,
     ):
         self.output_path = output_path
         self.verbose = verbose
         self.flatten = flatten
+        self.content_store = content_store
+        self.jobs = jobs or os.cpu_count() or 1
+        self.write_threads = write_threads
+        self.memory_limit = memory_limit
+        self.update = update
         self.relpaths: set[str] = set()
+        self.extracted_files = 0
+        self.extracted_bytes = 0
+        self.unchanged_files = 0
+        self.elapsed = 0.0
 
     def on_relpath(self, relpath: str):
         """Callback that is invoked for every top-level relpath encountered."""
@@ -158,8 +382,13 @@ class ArtifactPopulator:
 
     def __call__(self, *artifact_paths: Sequence[Path]):
         all_root_relpaths: set[str] = set()
+        start = time.monotonic()
+        pending_archives: list[_ArchiveExtractJob] = []
         for artifact_path in artifact_paths:
             if artifact_path.is_dir():
+                # Preserve ordering relative to any preceding archives.
+                self._extract_archives(pending_archives)
+                pending_archives.clear()
                 # Process an exploded artifact dir.
                 self.on_artifact_dir(artifact_path)
                 manifest_path: Path = artifact_path / "artifact_manifest.txt"
@@ -176,63 +405,548 @@ class ArtifactPopulator:
                     destdir = (
                         self.output_path if self.flatten else self.output_path / relpath
                     )
-                    pm.copy_to(destdir=destdir, verbose=self.verbose, remove_dest=False)
+                    pm.copy_to(
+                        destdir=destdir,
+                        verbose=self.verbose,
+                        remove_dest=False,
+                        update=self.update,
+                    )
             else:
                 # Process as an archive file.
-                with tarfile.TarFile.open(artifact_path, mode="r:xz") as tf:
-                    self.on_artifact_archive(artifact_path)
-                    # Read manifest first.
-                    manifest_member = tf.next()
-                    if (
-                        manifest_member is None
-                        or manifest_member.name != "artifact_manifest.txt"
-                    ):
-                        raise IOError(
-                            f"Artifact archive {artifact_path} must have artifact_manifest.txt as its first member"
-                        )
-                    with tf.extractfile(manifest_member) as mf_file:
-                        relpaths = mf_file.read().decode().splitlines()
-                        for relpath in relpaths:
-                            self.on_relpath(relpath)
-                    # Iterate over all remaining members.
-                    while member := tf.next():
-                        member_name = member.name
-                        # Figure out which relpath prefix it is a part of.
-                        for prefix_relpath in relpaths:
-                            output_path = self.output_path
-                            if not self.flatten:
-                                output_path = output_path / prefix_relpath
-                            prefix_relpath += "/"
-                            if member_name.startswith(prefix_relpath):
-                                scoped_path = member_name[len(prefix_relpath) :]
-                                dest_path = output_path / PurePosixPath(scoped_path)
-                                if dest_path.is_symlink() or (
-                                    dest_path.exists() and not dest_path.is_dir()
-                                ):
-                                    os.unlink(dest_path)
-                                dest_path.parent.mkdir(parents=True, exist_ok=True)
-                                if member.isfile():
-                                    exec_mask = member.mode & 0o111
-                                    with tf.extractfile(member) as member_file:
-                                        with open(
-                                            dest_path,
-                                            "wb",
-                                        ) as out_file:
-                                            out_file.write(member_file.read())
-                                            st = os.fstat(out_file.fileno())
-                                            if hasattr(os, "fchmod"):
-                                                # Windows has no fchmod.
-                                                new_mode = st.st_mode | exec_mask
-                                                os.fchmod(out_file.fileno(), new_mode)
-                                elif member.isdir():
-                                    dest_path.mkdir(parents=True, exist_ok=True)
-                                elif member.issym():
-                                    dest_path.symlink_to(member.linkname)
-                                else:
-                                    raise IOError(f"Unhandled tar member: {member}")
-                                break
-                        else:
-                            raise IOError(
-                                f"Extracting tar artifact archive, encountered file not in manifest: {member}"
-                            )
+                self.on_artifact_archive(artifact_path)
+                with open_archive(artifact_path) as tf:
+                    relpaths = _read_archive_manifest(tf, artifact_path)
+                for relpath in relpaths:
+                    self.on_relpath(relpath)
+                pending_archives.append(
+                    _ArchiveExtractJob(
+                        artifact_path=artifact_path,
+                        output_path=self.output_path,
+                        relpaths=relpaths,
+                        flatten=self.flatten,
+                        content_store_root=(
+                            self.content_store.root if self.content_store else None
+                        ),
+                        write_threads=self.write_threads,
+                        memory_limit=self.memory_limit,
+                        update=self.update,
+                    )
+                )
+        self._extract_archives(pending_archives)
+        self.elapsed += time.monotonic() - start
         return all_root_relpaths
+
+    def _extract_archives(self, jobs: list["_ArchiveExtractJob"]):
+        if not jobs:
+            return
+        if self.jobs == 1 or len(jobs) == 1:
+            for job in jobs:
+                self._add_stats(_extract_archive(job))
+            return
+
+        staging_root = self.output_path / f".populate-{os.getpid()}.tmp"
+        for i, job in enumerate(jobs):
+            job.compare_path = self.output_path
+            job.output_path = staging_root / str(i)
+        try:
+            with concurrent.futures.ProcessPoolExecutor(
+                min(self.jobs, len(jobs))
+            ) as executor:
+                futures = [executor.submit(_extract_archive, job) for job in jobs]
+                results = [future.result() for future in futures]
+            for result in results:
+                self._add_stats(result)
+            self._merge_staged(jobs, results)
+        finally:
+            shutil.rmtree(staging_root, ignore_errors=True)
+
+    def _merge_staged(
+        self, jobs: list["_ArchiveExtractJob"], results: list["_ExtractResult"]
+    ):
+        """Merges staged extractions into the output in job order."""
+        # Index of the last archive which found each path unchanged. Its
+        # (existing) version must win over any earlier archive's.
+        last_unchanged: dict[str, int] = {}
+        for i, result in enumerate(results):
+            for relpath in result.unchanged_relpaths:
+                last_unchanged[relpath] = i
+        for i, job in enumerate(jobs):
+            if job.output_path.exists():
+                _merge_tree(
+                    job.output_path,
+                    self.output_path,
+                    lambda relpath: last_unchanged.get(relpath, -1) > i,
+                )
+
+    def populate_streams(
+        self,
+        streams: Sequence["ArtifactStream"],
+        *,
+        max_streams: int = 4,
+        on_progress: Callable[["StreamProgress"], None] | None = None,
+        progress_interval: float = 10.0,
+    ) -> "StreamProgress":
+        """Populates artifact archives from streams of their compressed bytes.
+
+        Up to `max_streams` archives are read at once, each decompressed and
+        extracted on its own thread as its bytes arrive. As when extracting
+        archive files in parallel, each archive is extracted into a staging
+        directory and merged in order, so later streams win. Since manifests
+        are only known once a stream is read, the relpath callbacks are
+        invoked after extraction. `on_progress` is called with the progress
+        of each stage every `progress_interval` seconds and on completion.
+        """
+        start = time.monotonic()
+        progress = StreamProgress(artifacts_total=len(streams))
+        staged = len(streams) > 1
+        staging_root = self.output_path / f".populate-{os.getpid()}.tmp"
+        jobs = [
+            _ArchiveExtractJob(
+                artifact_path=Path(stream.filename),
+                output_path=(staging_root / str(i) if staged else self.output_path),
+                relpaths=[],
+                flatten=self.flatten,
+                content_store_root=(
+                    self.content_store.root if self.content_store else None
+                ),
+                write_threads=self.write_threads,
+                memory_limit=self.memory_limit,
+                update=self.update,
+                compare_path=self.output_path if staged else None,
+            )
+            for i, stream in enumerate(streams)
+        ]
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                max(1, min(max_streams, len(streams)))
+            ) as executor:
+                futures = [
+                    executor.submit(_extract_stream, stream, job, progress)
+                    for stream, job in zip(streams, jobs)
+                ]
+                not_done = futures
+                while not_done:
+                    done, not_done = concurrent.futures.wait(
+                        not_done,
+                        timeout=progress_interval,
+                        return_when=concurrent.futures.FIRST_EXCEPTION,
+                    )
+                    for future in done:
+                        if future.exception():
+                            executor.shutdown(wait=False, cancel_futures=True)
+                            future.result()
+                    if on_progress and not_done:
+                        on_progress(progress)
+                results = [future.result() for future in futures]
+            for result in results:
+                self._add_stats(result)
+                for relpath in result.relpaths:
+                    self.on_relpath(relpath)
+            if staged:
+                self._merge_staged(jobs, results)
+        finally:
+            if staged:
+                shutil.rmtree(staging_root, ignore_errors=True)
+            self.elapsed += time.monotonic() - start
+        if on_progress:
+            on_progress(progress)
+        return progress
+
+    def _add_stats(self, result: "_ExtractResult"):
+        self.extracted_files += result.file_count
+        self.extracted_bytes += result.byte_count
+        self.unchanged_files += len(result.unchanged_relpaths)
+
+    def throughput_summary(self) -> str:
+        mb = self.extracted_bytes / 1e6
+        rate = mb / self.elapsed if self.elapsed > 0 else 0.0
+        unchanged = (
+            f" ({self.unchanged_files} unchanged)" if self.unchanged_files else ""
+        )
+        return (
+            f"{self.extracted_files} files{unchanged}, {mb:.1f} MB in "
+            f"{self.elapsed:.2f}s = {rate:.1f} MB/s"
+        )
+
+
+@dataclass
+class ArtifactStream:
+    """An artifact archive to populate from a stream (see `populate_streams`).
+
+    `open` returns a readable file object over the compressed archive bytes.
+    The compression is determined by the extension of `filename`.
+    """
+
+    filename: str
+    open: Callable[[], BinaryIO]
+
+
+class StreamProgress:
+    """Progress of each stage of `ArtifactPopulator.populate_streams`.
+
+    Counters are updated concurrently by the stream threads.
+    """
+
+    def __init__(self, artifacts_total: int):
+        self.artifacts_total = artifacts_total
+        self.artifacts_done = 0
+        self.downloaded_bytes = 0
+        self.decompressed_bytes = 0
+        self.extracted_files = 0
+        self.extracted_bytes = 0
+        self.start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, **counts: int):
+        with self._lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+    def summary(self) -> str:
+        elapsed = time.monotonic() - self.start
+        mb = self.downloaded_bytes / 1e6
+        rate = mb / elapsed if elapsed > 0 else 0.0
+        return (
+            f"{self.artifacts_done}/{self.artifacts_total} artifacts: "
+            f"downloaded {mb:.1f} MB ({rate:.1f} MB/s), "
+            f"decompressed {self.decompressed_bytes / 1e6:.1f} MB, "
+            f"extracted {self.extracted_files} files "
+            f"({self.extracted_bytes / 1e6:.1f} MB) in {elapsed:.1f}s"
+        )
+
+
+class _CountingReader:
+    """Wraps a readable file object, reporting the number of bytes read."""
+
+    def __init__(self, fileobj, on_read: Callable[[int], None]):
+        self.fileobj = fileobj
+        self.on_read = on_read
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.fileobj.read(size)
+        self.on_read(len(data))
+        return data
+
+    def readinto(self, buffer) -> int:
+        n = self.fileobj.readinto(buffer)
+        self.on_read(n or 0)
+        return n
+
+
+class RelpathIndex:
+    """Maps archive member names to the manifest relpath which contains them.
+
+    Lookups probe each ancestor directory of the member name in a dict, so
+    they cost O(path depth) rather than O(relpaths). If relpaths are nested,
+    the first one in manifest order wins.
+    """
+
+    def __init__(self, relpaths: Iterable[str], output_path: Path, flatten: bool):
+        # Map of relpath to (manifest order, destination root).
+        self._roots: dict[str, tuple[int, Path]] = {}
+        for i, relpath in enumerate(relpaths):
+            if relpath and relpath not in self._roots:
+                root = output_path if flatten else output_path / relpath
+                self._roots[relpath] = (i, root)
+
+    def lookup(self, member_name: str) -> tuple[Path, str] | None:
+        """Returns the (destination root, path relative to it) of a member."""
+        best = None
+        best_relpath = ""
+        pos = member_name.find("/")
+        while pos != -1:
+            relpath = member_name[:pos]
+            root = self._roots.get(relpath)
+            if root and (best is None or root[0] < best[0]):
+                best = root
+                best_relpath = relpath
+            pos = member_name.find("/", pos + 1)
+        if best is None:
+            return None
+        return best[1], member_name[len(best_relpath) + 1 :]
+
+
+def _read_archive_manifest(tf: tarfile.TarFile, artifact_path: Path) -> list[str]:
+    manifest_member = tf.next()
+    if manifest_member is None or manifest_member.name != "artifact_manifest.txt":
+        raise IOError(
+            f"Artifact archive {artifact_path} must have artifact_manifest.txt as its first member"
+        )
+    with tf.extractfile(manifest_member) as mf_file:
+        return mf_file.read().decode().splitlines()
+
+
+@dataclass
+class _ArchiveExtractJob:
+    """Picklable description of one archive to extract (see `_extract_archive`)."""
+
+    artifact_path: Path
+    output_path: Path
+    relpaths: list[str]
+    flatten: bool
+    content_store_root: Path | None
+    write_threads: int
+    memory_limit: int
+    update: bool = False
+    # Where existing files are compared in update mode, if not `output_path`.
+    compare_path: Path | None = None
+
+
+@dataclass
+class _ExtractResult:
+    file_count: int = 0
+    byte_count: int = 0
+    # Output relative paths of members skipped as unchanged in update mode.
+    unchanged_relpaths: list[str] = field(default_factory=list)
+    # Relpaths from the archive manifest.
+    relpaths: list[str] = field(default_factory=list)
+
+
+def _extract_archive(job: _ArchiveExtractJob) -> _ExtractResult:
+    """Extracts one artifact archive file."""
+    with open_archive(job.artifact_path) as tf:
+        return _extract_tar(job, tf)
+
+
+def _extract_stream(
+    stream: ArtifactStream, job: _ArchiveExtractJob, progress: StreamProgress
+) -> _ExtractResult:
+    """Extracts one artifact archive from a stream, updating `progress`."""
+    fileobj = stream.open()
+    try:
+        reader = _CountingReader(fileobj, lambda n: progress.add(downloaded_bytes=n))
+        with open_archive_stream(reader, archive_compression(stream.filename)) as tf:
+            tar_offset = 0
+
+            def on_member(member: tarfile.TarInfo):
+                nonlocal tar_offset
+                progress.add(
+                    decompressed_bytes=tf.offset - tar_offset,
+                    extracted_files=int(member.isfile()),
+                    extracted_bytes=member.size if member.isfile() else 0,
+                )
+                tar_offset = tf.offset
+
+            result = _extract_tar(job, tf, on_member)
+        # Consume any trailing bytes, so that streams which verify (or cache)
+        # their contents see all of them.
+        while reader.read(COPY_BUFSIZE):
+            pass
+    finally:
+        fileobj.close()
+    progress.add(artifacts_done=1)
+    return result
+
+
+def _extract_tar(
+    job: _ArchiveExtractJob,
+    tf: tarfile.TarFile,
+    on_member: Callable[[tarfile.TarInfo], None] | None = None,
+) -> _ExtractResult:
+    """Extracts the members of an artifact archive.
+
+    Members are read sequentially from the archive. Files which fit in the
+    copy buffer are read whole and written (and verified/added to the content
+    store) on a thread pool, bounded by the memory limit. Larger files are
+    streamed through the copy buffer on the reading thread.
+    """
+    store = ContentStore(job.content_store_root) if job.content_store_root else None
+    compare_path = job.compare_path or job.output_path
+    result = _ExtractResult()
+    with concurrent.futures.ThreadPoolExecutor(job.write_threads) as executor:
+        result.relpaths = _read_archive_manifest(tf, job.artifact_path)
+        # Destinations are resolved relative to the output root.
+        relpath_index = RelpathIndex(result.relpaths, Path(), job.flatten)
+        contents: dict[str, ContentsEntry] = {}
+        # Pending writes of each file member, for resolving hardlinks.
+        file_writes: dict[str, tuple[Path, concurrent.futures.Future | None]] = {}
+        # Writes queued on the thread pool and the size of their contents.
+        pending: deque[tuple[concurrent.futures.Future, int]] = deque()
+        pending_bytes = 0
+        max_pending = 2 * job.write_threads
+        copy_buffer = memoryview(bytearray(min(COPY_BUFSIZE, job.memory_limit)))
+        # Iterate over all remaining members.
+        while member := tf.next():
+            if on_member:
+                on_member(member)
+            member_name = member.name
+            if member_name == ARTIFACT_CONTENTS_NAME:
+                with tf.extractfile(member) as contents_file:
+                    contents = parse_contents_manifest(contents_file.read().decode())
+                continue
+            # Figure out which relpath prefix it is a part of.
+            found = relpath_index.lookup(member_name)
+            if found is None:
+                raise IOError(
+                    f"Extracting tar artifact archive, encountered file not in manifest: {member}"
+                )
+            dest_relpath = found[0] / PurePosixPath(found[1])
+            dest_path = job.output_path / dest_relpath
+            entry = contents.get(member_name)
+            if member.isfile():
+                result.file_count += 1
+                result.byte_count += member.size
+            if job.update:
+                link_source = None
+                if member.islnk():
+                    link_source, link_future = file_writes[member.linkname]
+                    if link_future:
+                        link_future.result()
+                if _is_member_unchanged(
+                    compare_path / dest_relpath, member, entry, link_source
+                ):
+                    result.unchanged_relpaths.append(dest_relpath.as_posix())
+                    file_writes[member_name] = (compare_path / dest_relpath, None)
+                    continue
+            if dest_path.is_symlink() or (
+                dest_path.exists() and not dest_path.is_dir()
+            ):
+                os.unlink(dest_path)
+            dest_path.parent.mkdir(parents=True, exist_ok=True)
+            if member.isfile():
+                entry_store = store if entry else None
+                if entry_store and entry_store.contains(
+                    entry.target, entry.is_executable
+                ):
+                    entry_store.link_to(entry.target, entry.is_executable, dest_path)
+                    file_writes[member_name] = (dest_path, None)
+                    continue
+                write_args = (
+                    member.mode & 0o111,
+                    member.mtime,
+                    entry_store,
+                    entry,
+                    f"{member_name} from {job.artifact_path}",
+                )
+                if member.size > len(copy_buffer):
+                    with tf.extractfile(member) as member_file:
+                        _write_member_file(
+                            dest_path,
+                            _read_chunks(member_file, copy_buffer),
+                            *write_args,
+                        )
+                    file_writes[member_name] = (dest_path, None)
+                    continue
+                while pending and (
+                    len(pending) >= max_pending
+                    or pending_bytes + member.size > job.memory_limit
+                ):
+                    done_future, done_size = pending.popleft()
+                    done_future.result()
+                    pending_bytes -= done_size
+                with tf.extractfile(member) as member_file:
+                    data = member_file.read()
+                future = executor.submit(
+                    _write_member_file, dest_path, [data], *write_args
+                )
+                file_writes[member_name] = (dest_path, future)
+                pending.append((future, member.size))
+                pending_bytes += member.size
+            elif member.isdir():
+                dest_path.mkdir(parents=True, exist_ok=True)
+            elif member.issym():
+                dest_path.symlink_to(member.linkname)
+            elif member.islnk():
+                # Hardlink to a file earlier in the archive.
+                link_source, link_future = file_writes[member.linkname]
+                if link_future:
+                    link_future.result()
+                try:
+                    os.link(link_source, dest_path)
+                except OSError:
+                    shutil.copy2(link_source, dest_path)
+                file_writes[member_name] = (dest_path, None)
+            else:
+                raise IOError(f"Unhandled tar member: {member}")
+        for future, _ in pending:
+            future.result()
+    return result
+
+
+def _is_member_unchanged(
+    dest_path: Path,
+    member: tarfile.TarInfo,
+    entry: ContentsEntry | None,
+    link_source: Path | None,
+) -> bool:
+    """Checks whether an existing output path already matches a member."""
+    try:
+        st = os.lstat(dest_path)
+    except FileNotFoundError:
+        return False
+    if member.issym():
+        return stat.S_ISLNK(st.st_mode) and os.readlink(dest_path) == member.linkname
+    if member.islnk():
+        try:
+            return os.path.samefile(link_source, dest_path)
+        except OSError:
+            return False
+    if not member.isfile() or not stat.S_ISREG(st.st_mode):
+        return False
+    if st.st_size != member.size or (st.st_mode & 0o111) != (member.mode & 0o111):
+        return False
+    if int(st.st_mtime) == int(member.mtime):
+        return True
+    return entry is not None and hash_file(dest_path) == entry.target
+
+
+def _read_chunks(member_file, buffer: memoryview) -> Iterator[memoryview]:
+    """Yields the contents of a file as views into a reused buffer."""
+    while n := member_file.readinto(buffer):
+        yield buffer[:n]
+
+
+def _write_member_file(
+    dest_path: Path,
+    chunks: Iterable[bytes | memoryview],
+    exec_mask: int,
+    mtime: float,
+    store: ContentStore | None,
+    entry: ContentsEntry | None,
+    description: str,
+):
+    hasher = hashlib.new(CONTENTS_HASH_ALGORITHM) if store else None
+    with open(dest_path, "wb") as out_file:
+        for chunk in chunks:
+            out_file.write(chunk)
+            if hasher:
+                hasher.update(chunk)
+        st = os.fstat(out_file.fileno())
+        if hasattr(os, "fchmod"):
+            # Windows has no fchmod.
+            new_mode = st.st_mode | exec_mask
+            os.fchmod(out_file.fileno(), new_mode)
+    os.utime(dest_path, (mtime, mtime))
+    if store:
+        digest = hasher.hexdigest()
+        if digest != entry.target:
+            raise IOError(f"Digest mismatch extracting {description}")
+        store.add(dest_path, digest=digest)
+
+
+def _merge_tree(
+    source_dir: Path,
+    dest_dir: Path,
+    is_excluded: Callable[[str], bool],
+    relpath_prefix: str = "",
+):
+    """Moves the contents of `source_dir` into `dest_dir`, replacing entries.
+
+    Entries whose relative path `is_excluded` are left behind.
+    """
+    dest_dir.mkdir(parents=True, exist_ok=True)
+    with os.scandir(source_dir) as it:
+        entries = list(it)
+    for entry in entries:
+        relpath = f"{relpath_prefix}{entry.name}"
+        dest_path = dest_dir / entry.name
+        if dest_path.is_dir() and not dest_path.is_symlink():
+            if not entry.is_dir(follow_symlinks=False):
+                raise IOError(f"Cannot replace directory {dest_path} with a file")
+            _merge_tree(Path(entry.path), dest_path, is_excluded, f"{relpath}/")
+            continue
+        if is_excluded(relpath):
+            continue
+        if dest_path.is_symlink() or dest_path.exists():
+            os.unlink(dest_path)
+        os.rename(entry.path, dest_path)
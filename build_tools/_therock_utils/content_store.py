@@ -0,0 +1,234 @@
+"""Content-addressed file store for deduplicating artifact files.
+
+Many artifacts contain identical files: the `generic` artifacts of builds for
+different target families, or the same shared library materialized into
+several artifact, dist and install directories. The ContentStore keeps one
+blob per unique file content (keyed by its digest), and artifact directories
+and populated outputs hardlink to the blob instead of holding their own copy.
+
+Layout:
+    {root}/objects/{digest[:2]}/{digest[2:]}     Non-executable blobs
+    {root}/objects/{digest[:2]}/{digest[2:]}.x   Executable blobs
+
+Since all hardlinks to a blob share its permissions, executable and
+non-executable files with the same contents are distinct blobs. Blobs are
+inserted by copying to a temporary file which is atomically renamed into
+place, so concurrent writers never observe partial blobs and the store never
+shares an inode with a file it does not own. Files linked from the store do
+share the blob's inode, so they must be replaced rather than modified in place.
+
+Artifacts which use a store (or are created with `--contents-manifest`)
+carry an `artifact_contents.txt` manifest describing every entry (see
+`ContentsEntry`). It lets consumers link files from the store without reading
+them from an archive, and lets two artifacts be compared without reading
+their files (see `diff_contents`).
+"""
+
+from typing import Iterable
+
+import concurrent.futures
+from dataclasses import dataclass
+import os
+from pathlib import Path, PurePosixPath
+import shutil
+import stat
+import threading
+
+from .archive_util import open_archive
+from .hash_util import calculate_hash
+from .pattern_match import PatternMatcher
+
+ARTIFACT_CONTENTS_NAME = "artifact_contents.txt"
+CONTENTS_HASH_ALGORITHM = "blake2b"
+_CONTENTS_HEADER = f"# artifact-contents v1 {CONTENTS_HASH_ALGORITHM}"
+
+
+@dataclass
+class ContentsEntry:
+    """An entry in an artifact contents manifest.
+
+    Kind is one of "f" (regular file), "l" (symlink) or "d" (directory). For
+    files, `target` is the content digest. For symlinks, it is the link text.
+    """
+
+    relpath: str
+    kind: str
+    mode: int
+    size: int
+    target: str = ""
+
+    @property
+    def is_executable(self) -> bool:
+        return bool(self.mode & 0o111)
+
+    def to_line(self) -> str:
+        return (
+            f"{self.kind}\t{self.mode:04o}\t{self.size}\t{self.target}\t{self.relpath}"
+        )
+
+    @staticmethod
+    def from_line(line: str) -> "ContentsEntry":
+        kind, mode, size, target, relpath = line.split("\t", 4)
+        return ContentsEntry(relpath, kind, int(mode, 8), int(size), target)
+
+
+def write_contents_manifest(path: Path, entries: Iterable[ContentsEntry]):
+    lines = [_CONTENTS_HEADER]
+    lines.extend(e.to_line() for e in entries)
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    tmp_path.write_text("\n".join(lines) + "\n")
+    os.replace(tmp_path, path)
+
+
+def parse_contents_manifest(text: str) -> dict[str, ContentsEntry]:
+    lines = text.splitlines()
+    if not lines or lines[0] != _CONTENTS_HEADER:
+        raise IOError(
+            f"Unsupported artifact contents manifest (expected '{_CONTENTS_HEADER}')"
+        )
+    entries = [ContentsEntry.from_line(line) for line in lines[1:] if line]
+    return {e.relpath: e for e in entries}
+
+
+def hash_file(path: Path | str) -> str:
+    return calculate_hash(path, CONTENTS_HASH_ALGORITHM).hexdigest()
+
+
+class ContentStore:
+    def __init__(self, root: Path):
+        self.root = root
+        self.objects_dir = root / "objects"
+
+    def blob_path(self, digest: str, executable: bool) -> Path:
+        suffix = ".x" if executable else ""
+        return self.objects_dir / digest[0:2] / f"{digest[2:]}{suffix}"
+
+    def contains(self, digest: str, executable: bool) -> bool:
+        return self.blob_path(digest, executable).exists()
+
+    def add(self, path: Path, *, digest: str | None = None) -> str:
+        """Adds the file at `path` to the store, returning its digest.
+
+        The contents are copied into a new blob, so the file may be modified
+        afterwards without affecting the store.
+        """
+        st = os.stat(path)
+        if digest is None:
+            digest = hash_file(path)
+        blob = self.blob_path(digest, bool(st.st_mode & 0o111))
+        if blob.exists():
+            return digest
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        tmp_blob = blob.with_name(
+            f"{blob.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+        )
+        shutil.copy2(path, tmp_blob)
+        os.replace(tmp_blob, blob)
+        return digest
+
+    def link_to(self, digest: str, executable: bool, dest_path: Path):
+        """Replaces `dest_path` with a hardlink to (or copy of) a blob."""
+        blob = self.blob_path(digest, executable)
+        try:
+            blob_st = os.stat(blob)
+            dest_st = os.lstat(dest_path)
+            if (blob_st.st_ino, blob_st.st_dev) == (dest_st.st_ino, dest_st.st_dev):
+                return
+        except FileNotFoundError:
+            pass
+        tmp_path = dest_path.with_name(f"{dest_path.name}.cas.tmp")
+        try:
+            os.link(blob, tmp_path)
+        except OSError:
+            shutil.copy2(blob, tmp_path)
+        os.replace(tmp_path, dest_path)
+
+
+def collect_contents(
+    artifact_dir: Path,
+    basedir_relpaths: Iterable[str],
+    *,
+    store: ContentStore | None = None,
+    threads: int = 0,
+) -> list[ContentsEntry]:
+    """Describes every entry under the given artifact base directories.
+
+    Files are hashed in parallel on `threads` threads (default: all cores).
+    If a store is given, regular files are added to it and replaced by links
+    to their blob.
+    """
+    entries: list[ContentsEntry] = []
+    file_entries: list[tuple[ContentsEntry, str]] = []
+    for basedir_relpath in basedir_relpaths:
+        basedir = artifact_dir / PurePosixPath(basedir_relpath)
+        if not basedir.exists():
+            continue
+        pm = PatternMatcher()
+        pm.add_basedir(basedir)
+        for subpath, direntry in pm.all.items():
+            relpath = f"{basedir_relpath}/{subpath}"
+            st = direntry.stat(follow_symlinks=False)
+            mode = stat.S_IMODE(st.st_mode)
+            if stat.S_ISLNK(st.st_mode):
+                target = os.readlink(direntry.path)
+                entries.append(ContentsEntry(relpath, "l", mode, 0, target))
+            elif stat.S_ISDIR(st.st_mode):
+                entries.append(ContentsEntry(relpath, "d", mode, 0))
+            else:
+                entry = ContentsEntry(relpath, "f", mode, st.st_size)
+                entries.append(entry)
+                file_entries.append((entry, direntry.path))
+
+    def process_file(entry: ContentsEntry, path: str):
+        # hashlib releases the GIL while hashing, so this scales with threads.
+        entry.target = hash_file(path)
+        if store:
+            store.add(Path(path), digest=entry.target)
+            store.link_to(entry.target, entry.is_executable, Path(path))
+
+    with concurrent.futures.ThreadPoolExecutor(threads or os.cpu_count()) as executor:
+        futures = [executor.submit(process_file, *fe) for fe in file_entries]
+        for future in futures:
+            future.result()
+    return entries
+
+
+def read_artifact_contents(artifact_path: Path) -> dict[str, ContentsEntry]:
+    """Reads the contents manifest of an artifact directory or archive.
+
+    For archives, only the leading manifest members are decompressed.
+    """
+    if artifact_path.is_dir():
+        contents_path = artifact_path / ARTIFACT_CONTENTS_NAME
+        if not contents_path.exists():
+            raise IOError(f"Artifact {artifact_path} has no {ARTIFACT_CONTENTS_NAME}")
+        return parse_contents_manifest(contents_path.read_text())
+    with open_archive(artifact_path) as tf:
+        # The contents manifest immediately follows artifact_manifest.txt.
+        for _ in range(2):
+            member = tf.next()
+            if member is not None and member.name == ARTIFACT_CONTENTS_NAME:
+                with tf.extractfile(member) as contents_file:
+                    return parse_contents_manifest(contents_file.read().decode())
+    raise IOError(f"Artifact archive {artifact_path} has no {ARTIFACT_CONTENTS_NAME}")
+
+
+def diff_contents(
+    old: dict[str, ContentsEntry], new: dict[str, ContentsEntry]
+) -> list[tuple[str, str]]:
+    """Compares two contents manifests.
+
+    Returns sorted (change, relpath) tuples where change is "+" (added),
+    "-" (removed) or "M" (kind, mode, size, digest or link target changed).
+    """
+    changes = []
+    for relpath in sorted(old.keys() | new.keys()):
+        old_entry = old.get(relpath)
+        new_entry = new.get(relpath)
+        if old_entry is None:
+            changes.append(("+", relpath))
+        elif new_entry is None:
+            changes.append(("-", relpath))
+        elif old_entry != new_entry:
+            changes.append(("M", relpath))
+    return changes
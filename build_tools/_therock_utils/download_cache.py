@@ -0,0 +1,169 @@
+"""Local cache of downloaded artifact archives, shared across runs.
+
+CI jobs on the same runner repeatedly fetch the same artifacts (notably the
+`generic` ones, which every test shard needs). The DownloadCache keeps one
+copy of each downloaded object, keyed by a string which identifies its
+contents (such as the S3 key plus the object's ETag), and downloads are
+satisfied by hardlinking (or copying) from it.
+
+Layout:
+    {root}/{sha256(cache_key)[:2]}/{sha256(cache_key)[2:]}
+
+Files added to the cache are copied, so the cache never shares an inode with a
+file its caller may go on to modify or delete. Entries are made read-only,
+since outputs hardlinked from the cache share their inode. On Windows, where
+read-only files cannot be deleted, outputs are copied from the cache instead.
+Entries are written to a temporary file which is atomically renamed into
+place, so concurrent users never observe partial entries. The mtime of an
+entry is bumped whenever it is used, and the least recently used entries are
+evicted once the cache exceeds its size limit.
+"""
+
+import hashlib
+import os
+from pathlib import Path
+import platform
+import shutil
+import threading
+
+# If set, fetch_artifacts.py uses a download cache in this directory.
+DOWNLOAD_CACHE_DIR_ENV_VAR = "THEROCK_ARTIFACT_CACHE_DIR"
+
+DEFAULT_MAX_BYTES = 20 << 30
+
+
+class DownloadCache:
+    """Size-bounded LRU cache of downloaded files.
+
+    Methods may be called from several threads (and processes) at once.
+    """
+
+    def __init__(self, root: Path, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.hit_bytes = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def entry_path(self, cache_key: str) -> Path:
+        digest = hashlib.sha256(cache_key.encode()).hexdigest()
+        return self.root / digest[0:2] / digest[2:]
+
+    def get(self, cache_key: str) -> Path | None:
+        """Returns the path of a cached entry, recording a hit or miss."""
+        path = self.entry_path(cache_key)
+        try:
+            # Marks the entry as recently used.
+            os.utime(path)
+            size = path.stat().st_size
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+            self.hit_bytes += size
+        return path
+
+    def link_to(self, cache_key: str, dest_path: Path) -> bool:
+        """Replaces `dest_path` with a cached entry, if there is one."""
+        path = self.get(cache_key)
+        if path is None:
+            return False
+        tmp_path = dest_path.with_name(f"{dest_path.name}.cache.tmp")
+        try:
+            if platform.system() == "Windows":
+                shutil.copyfile(path, tmp_path)
+            else:
+                os.link(path, tmp_path)
+        except FileNotFoundError:
+            # Evicted concurrently.
+            return False
+        except OSError:
+            shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, dest_path)
+        return True
+
+    def add(self, path: Path, cache_key: str):
+        """Adds a copy of the file at `path` to the cache.
+
+        The file is left as it was, and may be modified or deleted afterwards.
+        """
+        entry = self.entry_path(cache_key)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        tmp_entry = entry.with_name(
+            f"{entry.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+        )
+        shutil.copyfile(path, tmp_entry)
+        self._commit(tmp_entry, entry)
+
+    def open_writer(self, cache_key: str) -> "CacheWriter":
+        """Opens a writer which adds an entry once all of its data is written."""
+        entry = self.entry_path(cache_key)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        tmp_entry = entry.with_name(
+            f"{entry.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+        )
+        return CacheWriter(self, tmp_entry, entry)
+
+    def _commit(self, tmp_entry: Path, entry: Path):
+        os.chmod(tmp_entry, 0o444)
+        os.replace(tmp_entry, entry)
+        self.evict()
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits its limit."""
+        entries = []
+        total = 0
+        for subdir in self.root.iterdir():
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir):
+                if entry.name.endswith(".tmp"):
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                continue
+            total -= size
+            with self._lock:
+                self.evictions += 1
+
+    def summary(self) -> str:
+        lookups = self.hits + self.misses
+        rate = 100.0 * self.hits / lookups if lookups else 0.0
+        return (
+            f"{self.hits} hits, {self.misses} misses ({rate:.0f}% hit rate), "
+            f"{self.hit_bytes / 1e6:.1f} MB served from cache, "
+            f"{self.evictions} evictions"
+        )
+
+
+class CacheWriter:
+    """Incrementally writes a cache entry (see `DownloadCache.open_writer`)."""
+
+    def __init__(self, cache: DownloadCache, tmp_entry: Path, entry: Path):
+        self.cache = cache
+        self.tmp_entry = tmp_entry
+        self.entry = entry
+        self.file = open(tmp_entry, "wb")
+
+    def write(self, data) -> int:
+        return self.file.write(data)
+
+    def commit(self):
+        self.file.close()
+        self.cache._commit(self.tmp_entry, self.entry)
+
+    def abort(self):
+        self.file.close()
+        self.tmp_entry.unlink(missing_ok=True)
@@ -0,0 +1,215 @@
+"""Size-aware scheduling of concurrent artifact downloads.
+
+Artifacts range from a few KB to several GB, so submitting every download at
+once with a fixed timeout both oversubscribes the disk and times out large
+artifacts. The DownloadScheduler instead:
+
+* Starts downloads largest first, since the largest artifacts bound the total
+  time. Smaller downloads fill in while the in-flight limit allows.
+* Caps the bytes in flight to `max_in_flight_bytes` and to the free disk space
+  of the output directory (less a reserve). Downloads in flight may not have
+  preallocated their space yet (see `S3Downloader.download`), so the bytes in
+  flight are subtracted from the free space when deciding what fits. This may
+  undercount the space available when they have, but never overcommits it.
+  A download which does not fit on disk even when started alone fails early.
+* Gives each download a timeout proportional to its size (see
+  `download_timeout`). On a timeout or error, the downloads still running are
+  cancelled and waited for before the error is raised.
+* Records the duration and throughput of each download (see `metrics` and
+  `summary`).
+"""
+
+from typing import Callable
+
+from dataclasses import dataclass
+import concurrent.futures
+from pathlib import Path
+import shutil
+import threading
+import time
+
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_MAX_IN_FLIGHT_BYTES = 16 << 30
+DEFAULT_DISK_RESERVE_BYTES = 1 << 30
+DEFAULT_MIN_TIMEOUT = 300.0
+# Downloads slower than this (on average) time out.
+DEFAULT_MIN_BYTES_PER_SECOND = 1 << 20
+
+
+def download_timeout(
+    size: int,
+    min_timeout: float = DEFAULT_MIN_TIMEOUT,
+    min_bytes_per_second: float = DEFAULT_MIN_BYTES_PER_SECOND,
+) -> float:
+    """Returns the seconds allowed for downloading `size` bytes."""
+    return min_timeout + size / min_bytes_per_second
+
+
+@dataclass
+class ScheduledDownload:
+    """A download of `size` bytes, performed by calling `download(cancel)`.
+
+    `cancel` is a `threading.Event` which is set when the download should stop
+    early, which it should do promptly by raising.
+    """
+
+    name: str
+    size: int
+    download: Callable[[threading.Event], object]
+
+
+@dataclass
+class DownloadMetrics:
+    name: str
+    size: int
+    seconds: float
+
+    @property
+    def mb_per_second(self) -> float:
+        return self.size / 1e6 / self.seconds if self.seconds > 0 else 0.0
+
+
+class DownloadScheduler:
+    """Runs downloads concurrently, largest first, within byte limits.
+
+    Usage:
+        scheduler = DownloadScheduler(output_dir)
+        scheduler.run([ScheduledDownload(name, size, download_fn), ...])
+        print(scheduler.summary())
+    """
+
+    def __init__(
+        self,
+        output_dir: Path,
+        *,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        max_in_flight_bytes: int = DEFAULT_MAX_IN_FLIGHT_BYTES,
+        disk_reserve_bytes: int = DEFAULT_DISK_RESERVE_BYTES,
+        min_timeout: float = DEFAULT_MIN_TIMEOUT,
+        min_bytes_per_second: float = DEFAULT_MIN_BYTES_PER_SECOND,
+        log: Callable[[str], None] = print,
+    ):
+        self.output_dir = output_dir
+        self.max_workers = max_workers
+        self.max_in_flight_bytes = max_in_flight_bytes
+        self.disk_reserve_bytes = disk_reserve_bytes
+        self.min_timeout = min_timeout
+        self.min_bytes_per_second = min_bytes_per_second
+        self.log = log
+        self.metrics: list[DownloadMetrics] = []
+        self.elapsed = 0.0
+
+    def free_bytes(self) -> int:
+        """Returns the disk space available for new downloads."""
+        free = shutil.disk_usage(self.output_dir).free
+        return max(0, free - self.disk_reserve_bytes)
+
+    def run(self, downloads: list[ScheduledDownload]):
+        """Runs all downloads, raising the first error or timeout.
+
+        Before raising, the other downloads are cancelled and waited for.
+        """
+        pending = sorted(downloads, key=lambda d: d.size, reverse=True)
+        free = self.free_bytes()
+        if pending and pending[0].size > free:
+            self._raise_disk_full(pending[0], free)
+        if sum(d.size for d in pending) > free:
+            self.log(
+                f"++ Warning: downloads total {sum(d.size for d in pending)} bytes, "
+                f"but only {free} bytes are available in {self.output_dir}"
+            )
+        # Future -> (download, start time, deadline).
+        in_flight: dict[
+            concurrent.futures.Future, tuple[ScheduledDownload, float, float]
+        ] = {}
+        in_flight_bytes = 0
+        cancel = threading.Event()
+        start = time.monotonic()
+        executor = concurrent.futures.ThreadPoolExecutor(
+            self.max_workers, thread_name_prefix="download"
+        )
+        try:
+            while pending or in_flight:
+                while pending and len(in_flight) < self.max_workers:
+                    download = self._next_download(pending, in_flight_bytes)
+                    if download is None:
+                        break
+                    pending.remove(download)
+                    now = time.monotonic()
+                    timeout = download_timeout(
+                        download.size, self.min_timeout, self.min_bytes_per_second
+                    )
+                    future = executor.submit(download.download, cancel)
+                    in_flight[future] = (download, now, now + timeout)
+                    in_flight_bytes += download.size
+
+                next_deadline = min(deadline for _, _, deadline in in_flight.values())
+                done, _ = concurrent.futures.wait(
+                    in_flight,
+                    timeout=max(0.0, next_deadline - time.monotonic()),
+                    return_when=concurrent.futures.FIRST_COMPLETED,
+                )
+                for future in done:
+                    download, started, _ = in_flight.pop(future)
+                    in_flight_bytes -= download.size
+                    future.result()
+                    metrics = DownloadMetrics(
+                        download.name, download.size, time.monotonic() - started
+                    )
+                    self.metrics.append(metrics)
+                    self.log(
+                        f"++ Downloaded {download.name}: {download.size / 1e6:.1f} MB "
+                        f"in {metrics.seconds:.1f}s = {metrics.mb_per_second:.1f} MB/s"
+                    )
+                now = time.monotonic()
+                for download, started, deadline in in_flight.values():
+                    if now >= deadline:
+                        raise TimeoutError(
+                            f"Downloading {download.name} ({download.size} bytes) "
+                            f"timed out after {now - started:.0f}s"
+                        )
+        finally:
+            # Stop any downloads still running after an error, so that none
+            # outlive the run.
+            cancel.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+            self.elapsed += time.monotonic() - start
+
+    def _next_download(
+        self, pending: list[ScheduledDownload], in_flight_bytes: int
+    ) -> ScheduledDownload | None:
+        """Returns the largest pending download which fits, if any."""
+        free = max(0, self.free_bytes() - in_flight_bytes)
+        for download in pending:
+            if download.size > free:
+                continue
+            # With nothing in flight, a download larger than
+            # max_in_flight_bytes is started on its own.
+            if (
+                not in_flight_bytes
+                or in_flight_bytes + download.size <= self.max_in_flight_bytes
+            ):
+                return download
+        if not in_flight_bytes:
+            self._raise_disk_full(pending[-1], free)
+        return None
+
+    def _raise_disk_full(self, download: ScheduledDownload, free: int):
+        raise IOError(
+            f"Not enough disk space in {self.output_dir} to download "
+            f"{download.name}: {download.size} bytes needed, {free} available "
+            f"(keeping {self.disk_reserve_bytes} bytes free)"
+        )
+
+    def summary(self) -> str:
+        total_bytes = sum(m.size for m in self.metrics)
+        mb = total_bytes / 1e6
+        rate = mb / self.elapsed if self.elapsed > 0 else 0.0
+        summary = (
+            f"{len(self.metrics)} downloads, {mb:.1f} MB in "
+            f"{self.elapsed:.2f}s = {rate:.1f} MB/s"
+        )
+        if self.metrics:
+            slowest = min(self.metrics, key=lambda m: m.mb_per_second)
+            summary += f" (slowest {slowest.name} at {slowest.mb_per_second:.1f} MB/s)"
+        return summary
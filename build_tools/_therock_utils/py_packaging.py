@@ -107,8 +107,7 @@ class Parameters:
         excludes: tuple[str] = (),
     ) -> ArtifactCatalog:
         """Filters the global view of artifacts to only include a subset."""
-        return ArtifactCatalog(
-            self.artifacts.artifact_dir,
+        return self.artifacts.project(
             filter=filter,
             includes=includes,
             excludes=excludes,
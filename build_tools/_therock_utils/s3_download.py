@@ -0,0 +1,524 @@
+"""Parallel ranged downloads of S3 objects.
+
+A single `download_fileobj` stream is limited by the throughput of one TCP
+connection. The S3Downloader splits large objects into byte ranges which are
+fetched concurrently and written with positional writes into a preallocated
+output file. Each range is retried independently with exponential backoff,
+and all ranges of all objects share one pool of connections, so the total
+number of concurrent requests is bounded no matter how many objects are
+downloaded at once.
+
+Objects can also be consumed as a stream (see `S3Downloader.open_stream`),
+which fetches ranges ahead of the reader so that a consumer (such as an archive
+extractor) can process the object as it arrives without writing it to disk.
+
+If the expected sha256 digest of an object is given, its contents are hashed
+in order as ranges arrive and the download fails on a mismatch.
+
+Downloads are resumable: data is written to a partial file in a `.partial`
+directory next to the output, along with a small state file recording which
+ranges are complete. If a download fails (or the process is interrupted), the
+next download of the same object to the same path only fetches the missing
+ranges, provided the object's size and ETag are unchanged. Ranges are fetched
+with `IfMatch` on the ETag, so an object replaced mid-download fails rather
+than producing a mix of old and new contents.
+
+If given a `DownloadCache`, objects are looked up in it before being fetched,
+and fetched (and verified) objects are added to it. Objects with an expected
+digest are cached by that digest, so identical objects under different keys
+share an entry. Others are cached by bucket, key and ETag.
+
+The downloader only needs the `head_object` and `get_object` calls of a boto3
+S3 client, so it works against any S3 compatible endpoint (including local
+stand-ins such as minio or moto).
+"""
+
+from typing import Callable, Iterable
+
+from collections import deque
+import concurrent.futures
+import hashlib
+import io
+import json
+import os
+from pathlib import Path
+import threading
+import time
+
+from .download_cache import CacheWriter, DownloadCache
+
+DEFAULT_PART_SIZE = 32 << 20
+DEFAULT_MAX_CONCURRENCY = 16
+# Streams use smaller ranges, since `read_ahead` of them are held in memory.
+DEFAULT_STREAM_PART_SIZE = 8 << 20
+DEFAULT_STREAM_READ_AHEAD = 4
+
+# Size of each read from a response body stream.
+_READ_CHUNK_SIZE = 1 << 20
+
+# Directory (next to the output file) holding partial downloads.
+PARTIAL_DIR_NAME = ".partial"
+# Bumped whenever the partial download state format changes.
+_PARTIAL_STATE_VERSION = 1
+
+
+def _pwrite(fd: int, data: bytes, offset: int, lock: threading.Lock):
+    if hasattr(os, "pwrite"):
+        os.pwrite(fd, data, offset)
+    else:
+        # Windows has no pwrite.
+        with lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            os.write(fd, data)
+
+
+def _pread(fd: int, size: int, offset: int, lock: threading.Lock) -> bytes:
+    if hasattr(os, "pread"):
+        return os.pread(fd, size, offset)
+    with lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+
+
+def _hash_range(hasher, fd: int, start: int, end: int, lock: threading.Lock):
+    for offset in range(start, end + 1, _READ_CHUNK_SIZE):
+        size = min(_READ_CHUNK_SIZE, end + 1 - offset)
+        hasher.update(_pread(fd, size, offset, lock))
+
+
+def _check_digest(hasher, sha256: str, key: str):
+    if hasher.hexdigest() != sha256:
+        raise IOError(
+            f"sha256 mismatch downloading {key}: expected {sha256}, "
+            f"got {hasher.hexdigest()}"
+        )
+
+
+def _check_cancelled(cancel: threading.Event | None, key: str):
+    if cancel is not None and cancel.is_set():
+        raise IOError(f"Download of {key} cancelled")
+
+
+def _cancel_and_wait(futures: Iterable[concurrent.futures.Future]):
+    """Cancels futures which have not started and waits for the others."""
+    futures = list(futures)
+    for future in futures:
+        future.cancel()
+    concurrent.futures.wait(futures)
+
+
+def _partial_paths(output_path: Path) -> tuple[Path, Path]:
+    """Returns the partial file and state file paths for an output path."""
+    partial_path = output_path.parent / PARTIAL_DIR_NAME / output_path.name
+    return partial_path, partial_path.with_name(f"{partial_path.name}.json")
+
+
+def _load_partial_state(
+    partial_path: Path, state_path: Path, identity: dict
+) -> set[int]:
+    """Returns the completed range starts of a resumable partial download.
+
+    Returns an empty set unless the partial file and its state exist and were
+    recorded for the same object (bucket, key, size and ETag) and part size.
+    """
+    try:
+        state = json.loads(state_path.read_text())
+        if partial_path.stat().st_size != identity["size"]:
+            return set()
+    except (OSError, ValueError):
+        return set()
+    if state.get("version") != _PARTIAL_STATE_VERSION:
+        return set()
+    if any(state.get(name) != value for name, value in identity.items()):
+        return set()
+    return set(state.get("completed", []))
+
+
+def _save_partial_state(state_path: Path, identity: dict, completed: set[int]):
+    contents = dict(identity, version=_PARTIAL_STATE_VERSION)
+    contents["completed"] = sorted(completed)
+    tmp_path = state_path.with_name(f"{state_path.name}.tmp")
+    tmp_path.write_text(json.dumps(contents))
+    os.replace(tmp_path, state_path)
+
+
+def _discard_partial(partial_path: Path, state_path: Path):
+    partial_path.unlink(missing_ok=True)
+    state_path.unlink(missing_ok=True)
+    try:
+        partial_path.parent.rmdir()
+    except OSError:
+        # Not empty (other downloads in progress) or already removed.
+        pass
+
+
+class S3Downloader:
+    """Downloads S3 objects as concurrent byte ranges.
+
+    Usage:
+        with S3Downloader(s3_client) as downloader:
+            downloader.download(bucket, key, output_path)
+
+    `download` may be called from several threads at once. Objects larger
+    than `part_size` are split into ranges of that size.
+    """
+
+    def __init__(
+        self,
+        s3_client,
+        *,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        part_size: int = DEFAULT_PART_SIZE,
+        max_retries: int = 3,
+        base_delay: float = 1.0,
+        log: Callable[[str], None] = print,
+        cache: DownloadCache | None = None,
+    ):
+        self.s3_client = s3_client
+        self.cache = cache
+        self.part_size = part_size
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.log = log
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_concurrency, thread_name_prefix="s3-range"
+        )
+
+    def __enter__(self) -> "S3Downloader":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+    def download(
+        self,
+        bucket: str,
+        key: str,
+        output_path: Path,
+        *,
+        sha256: str | None = None,
+        cancel: threading.Event | None = None,
+    ) -> int:
+        """Downloads an object to `output_path`, returning its size.
+
+        Data is written to a partial file which is moved to `output_path`
+        once complete. If the download fails, the partial file is kept so that
+        a later download of the same object resumes from the ranges which did
+        complete. On a digest mismatch, the partial file is removed.
+
+        If `cancel` is set while downloading, the download stops (after the
+        chunk being read by each range) and raises, keeping its partial file.
+        """
+        _check_cancelled(cancel, key)
+        size, etag, cache_key = self._head(bucket, key, sha256)
+        if cache_key and self.cache.link_to(cache_key, output_path):
+            return size
+        ranges = [
+            (start, min(start + self.part_size, size) - 1)
+            for start in range(0, size, self.part_size)
+        ]
+        partial_path, state_path = _partial_paths(output_path)
+        identity = {
+            "bucket": bucket,
+            "key": key,
+            "size": size,
+            "etag": etag,
+            "part_size": self.part_size,
+        }
+        completed = _load_partial_state(partial_path, state_path, identity)
+        if completed:
+            resumed_bytes = sum(
+                end + 1 - start for start, end in ranges if start in completed
+            )
+            self.log(
+                f"++ Resuming download of {key} "
+                f"({resumed_bytes} of {size} bytes already downloaded)"
+            )
+        partial_path.parent.mkdir(parents=True, exist_ok=True)
+        write_lock = threading.Lock()
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0)
+        if not completed:
+            flags |= os.O_TRUNC
+        fd = os.open(partial_path, flags, 0o644)
+        futures: dict[int, concurrent.futures.Future] = {}
+        try:
+            if not completed:
+                # Preallocate so that ranges can be written in any order.
+                if hasattr(os, "posix_fallocate") and size:
+                    os.posix_fallocate(fd, 0, size)
+                else:
+                    os.ftruncate(fd, size)
+            _save_partial_state(state_path, identity, completed)
+
+            def write(offset: int, chunk: bytes):
+                _pwrite(fd, chunk, offset, write_lock)
+
+            # Ranges are recorded and hashed in order as they complete, while
+            # later ranges are still downloading.
+            hasher = hashlib.sha256() if sha256 else None
+            try:
+                for start, end in ranges:
+                    if start not in completed:
+                        futures[start] = self.executor.submit(
+                            self._download_range,
+                            bucket,
+                            key,
+                            start,
+                            end,
+                            write,
+                            etag=etag,
+                            cancel=cancel,
+                        )
+                for start, end in ranges:
+                    if start in futures:
+                        futures[start].result()
+                        completed.add(start)
+                        _save_partial_state(state_path, identity, completed)
+                    if hasher:
+                        _hash_range(hasher, fd, start, end, write_lock)
+            except BaseException:
+                # Record the ranges which completed so that they need not be
+                # fetched again.
+                _cancel_and_wait(futures.values())
+                completed.update(
+                    start
+                    for start, future in futures.items()
+                    if not future.cancelled() and future.exception() is None
+                )
+                _save_partial_state(state_path, identity, completed)
+                raise
+            if os.fstat(fd).st_size != size:
+                raise IOError(
+                    f"Size mismatch downloading {key}: expected {size}, "
+                    f"got {os.fstat(fd).st_size}"
+                )
+            try:
+                if hasher:
+                    _check_digest(hasher, sha256, key)
+            except IOError:
+                os.close(fd)
+                fd = None
+                _discard_partial(partial_path, state_path)
+                raise
+        finally:
+            if fd is not None:
+                # Ranges still running on the shared pool write to the fd,
+                # which must not be closed (and possibly reused) under them.
+                _cancel_and_wait(futures.values())
+                os.close(fd)
+        os.replace(partial_path, output_path)
+        _discard_partial(partial_path, state_path)
+        if cache_key:
+            self.cache.add(output_path, cache_key)
+        return size
+
+    def open_stream(
+        self,
+        bucket: str,
+        key: str,
+        *,
+        part_size: int = DEFAULT_STREAM_PART_SIZE,
+        read_ahead: int = DEFAULT_STREAM_READ_AHEAD,
+        sha256: str | None = None,
+    ) -> io.RawIOBase:
+        """Opens an object for sequential reading.
+
+        Up to `read_ahead` ranges of `part_size` bytes are fetched concurrently
+        ahead of the reader, which bounds the memory held per stream. Objects
+        in the cache are read from it instead, and fetched objects are added
+        to the cache once all of their ranges have arrived (and been verified
+        against `sha256`, if given). A digest mismatch raises an IOError from
+        the read which reaches the end of the object.
+        """
+        size, etag, cache_key = self._head(bucket, key, sha256)
+        cache_writer = None
+        if cache_key:
+            cached_path = self.cache.get(cache_key)
+            if cached_path:
+                return open(cached_path, "rb", buffering=0)
+            cache_writer = self.cache.open_writer(cache_key)
+        return S3ObjectStream(
+            self,
+            bucket,
+            key,
+            size,
+            part_size,
+            read_ahead,
+            cache_writer,
+            sha256,
+            etag=etag,
+        )
+
+    def _head(
+        self, bucket: str, key: str, sha256: str | None
+    ) -> tuple[int, str, str | None]:
+        """Returns the size, ETag and (if caching) cache key of an object."""
+        response = self.s3_client.head_object(Bucket=bucket, Key=key)
+        cache_key = None
+        if self.cache and sha256:
+            cache_key = f"sha256:{sha256}"
+        elif self.cache:
+            cache_key = f"s3://{bucket}/{key}@{response['ETag']}"
+        return response["ContentLength"], response["ETag"], cache_key
+
+    def _fetch_range(
+        self, bucket: str, key: str, start: int, end: int, etag: str | None = None
+    ) -> bytearray:
+        data = bytearray(end + 1 - start)
+
+        def write(offset: int, chunk: bytes):
+            data[offset - start : offset - start + len(chunk)] = chunk
+
+        self._download_range(bucket, key, start, end, write, etag=etag)
+        return data
+
+    def _download_range(
+        self,
+        bucket: str,
+        key: str,
+        start: int,
+        end: int,
+        write: Callable[[int, bytes], None],
+        *,
+        etag: str | None = None,
+        cancel: threading.Event | None = None,
+    ):
+        # Only pass IfMatch when given, as the parameter must be a string.
+        conditions = {"IfMatch": etag} if etag else {}
+        for attempt in range(self.max_retries):
+            offset = start
+            try:
+                _check_cancelled(cancel, key)
+                response = self.s3_client.get_object(
+                    Bucket=bucket, Key=key, Range=f"bytes={start}-{end}", **conditions
+                )
+                body = response["Body"]
+                while offset <= end:
+                    _check_cancelled(cancel, key)
+                    chunk = body.read(min(_READ_CHUNK_SIZE, end + 1 - offset))
+                    if not chunk:
+                        raise IOError(
+                            f"Short read of {key} at {offset} (expected through {end})"
+                        )
+                    write(offset, chunk)
+                    offset += len(chunk)
+                return
+            except Exception as e:
+                if attempt == self.max_retries - 1 or (cancel and cancel.is_set()):
+                    raise
+                delay = self.base_delay * (2**attempt)
+                self.log(
+                    f"++ Error downloading {key} bytes {start}-{end} ({e}), "
+                    f"retrying in {delay} seconds..."
+                )
+                time.sleep(delay)
+
+
+class S3ObjectStream(io.RawIOBase):
+    """Read-only, non-seekable file object over an S3 object.
+
+    Ranges are fetched on the downloader's shared pool in order, `read_ahead`
+    at a time, and handed to the reader as they complete. If given a
+    `cache_writer`, ranges are also written to it as they are handed over and
+    it is committed once the last range has been received. If given a
+    `sha256`, ranges are hashed as they are handed over and the last one is
+    only handed over (and cached) if the digest matches. If given an `etag`,
+    ranges are fetched with `IfMatch` on it, so that an object replaced while
+    it is being read fails rather than mixing old and new contents (which
+    would be cached under the old ETag).
+    """
+
+    def __init__(
+        self,
+        downloader: S3Downloader,
+        bucket: str,
+        key: str,
+        size: int,
+        part_size: int,
+        read_ahead: int,
+        cache_writer: CacheWriter | None = None,
+        sha256: str | None = None,
+        *,
+        etag: str | None = None,
+    ):
+        super().__init__()
+        self.downloader = downloader
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.etag = etag
+        self._ranges = deque(
+            (start, min(start + part_size, size) - 1)
+            for start in range(0, size, part_size)
+        )
+        self._pending: deque[concurrent.futures.Future] = deque()
+        self._read_ahead = max(1, read_ahead)
+        self._part = memoryview(b"")
+        self._cache_writer = cache_writer
+        self._sha256 = sha256
+        self._hasher = hashlib.sha256() if sha256 else None
+        if not self._ranges:
+            self._finish()
+        self._fill()
+
+    def _finish(self):
+        """Verifies and caches the object once all of its data has arrived."""
+        if self._hasher:
+            try:
+                _check_digest(self._hasher, self._sha256, self.key)
+            except IOError:
+                if self._cache_writer:
+                    self._cache_writer.abort()
+                    self._cache_writer = None
+                raise
+        if self._cache_writer:
+            self._cache_writer.commit()
+            self._cache_writer = None
+
+    def _fill(self):
+        while self._ranges and len(self._pending) < self._read_ahead:
+            start, end = self._ranges.popleft()
+            self._pending.append(
+                self.downloader.executor.submit(
+                    self.downloader._fetch_range,
+                    self.bucket,
+                    self.key,
+                    start,
+                    end,
+                    self.etag,
+                )
+            )
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        if not self._part:
+            if not self._pending:
+                return 0
+            part = self._pending.popleft().result()
+            if self._hasher:
+                self._hasher.update(part)
+            if self._cache_writer:
+                self._cache_writer.write(part)
+            if not self._pending and not self._ranges:
+                self._finish()
+            self._part = memoryview(part)
+            self._fill()
+        n = min(len(buffer), len(self._part))
+        buffer[:n] = self._part[:n]
+        self._part = self._part[n:]
+        return n
+
+    def close(self):
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._ranges.clear()
+        if self._cache_writer:
+            self._cache_writer.abort()
+            self._cache_writer = None
+        super().close()
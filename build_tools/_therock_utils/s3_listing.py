@@ -0,0 +1,141 @@
+"""Structured, cached listings of the objects uploaded for a CI run.
+
+Listing a run prefix paginates `list_objects_v2` over every object the run
+uploaded, and several scripts in one CI job need the same listing. A
+RunListing records the key, size and ETag of each object, and can be saved
+to a cache file which is reused by later invocations until it is older than
+a TTL (artifacts may still be uploading while a run is in progress).
+
+Artifacts are identified by parsing object names as `ArtifactName`s, so
+filtering by target family is an exact match rather than a substring check.
+"""
+
+from typing import Iterable
+
+from dataclasses import dataclass
+import json
+import os
+from pathlib import Path
+import time
+
+from .artifacts import ArtifactName, ArtifactRegistry
+
+# Bumped whenever the cache file format changes.
+_LISTING_CACHE_VERSION = 1
+
+DEFAULT_LISTING_TTL = 600.0
+
+
+@dataclass(frozen=True)
+class ListedObject:
+    key: str
+    size: int
+    etag: str
+
+    @property
+    def filename(self) -> str:
+        return self.key.rsplit("/", 1)[-1]
+
+
+class RunListing:
+    def __init__(
+        self, bucket: str, prefix: str, objects: list[ListedObject], listed_at: float
+    ):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.objects = objects
+        self.listed_at = listed_at
+        self._by_filename = {o.filename: o for o in objects}
+
+    @staticmethod
+    def list(paginator, bucket: str, prefix: str) -> "RunListing":
+        """Lists a prefix using a `list_objects_v2` paginator."""
+        listed_at = time.time()
+        objects = []
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for entry in page.get("Contents", []):
+                objects.append(
+                    ListedObject(
+                        entry["Key"], entry.get("Size", 0), entry.get("ETag", "")
+                    )
+                )
+        return RunListing(bucket, prefix, objects, listed_at)
+
+    @staticmethod
+    def load(path: Path) -> "RunListing | None":
+        """Loads a saved listing, returning None if it is missing or invalid."""
+        try:
+            contents = json.loads(path.read_text())
+        except (OSError, ValueError):
+            return None
+        if contents.get("version") != _LISTING_CACHE_VERSION:
+            return None
+        return RunListing(
+            contents["bucket"],
+            contents["prefix"],
+            [ListedObject(*o) for o in contents["objects"]],
+            contents["listed_at"],
+        )
+
+    def save(self, path: Path):
+        contents = {
+            "version": _LISTING_CACHE_VERSION,
+            "bucket": self.bucket,
+            "prefix": self.prefix,
+            "listed_at": self.listed_at,
+            "objects": [[o.key, o.size, o.etag] for o in self.objects],
+        }
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps(contents))
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def cached(
+        paginator,
+        bucket: str,
+        prefix: str,
+        cache_path: Path | None,
+        ttl: float = DEFAULT_LISTING_TTL,
+    ) -> "RunListing":
+        """Returns the listing saved at `cache_path` if fresh, else lists anew.
+
+        A TTL of 0 disables the cache.
+        """
+        if cache_path and ttl > 0:
+            listing = RunListing.load(cache_path)
+            if (
+                listing
+                and (listing.bucket, listing.prefix) == (bucket, prefix)
+                and 0 <= time.time() - listing.listed_at < ttl
+            ):
+                return listing
+        listing = RunListing.list(paginator, bucket, prefix)
+        if cache_path and ttl > 0:
+            listing.save(cache_path)
+        return listing
+
+    def get(self, filename: str) -> ListedObject | None:
+        return self._by_filename.get(filename)
+
+    def artifacts(
+        self, target_families: Iterable[str] | None = None
+    ) -> dict[ArtifactName, ListedObject]:
+        """Returns the artifact archives, optionally of the given target families."""
+        families = set(target_families) if target_families is not None else None
+        artifacts = {}
+        for o in self.objects:
+            an = ArtifactName.from_filename(o.filename)
+            if an is None:
+                continue
+            if families is not None and an.target_family not in families:
+                continue
+            artifacts[an] = o
+        return artifacts
+
+    def registry(
+        self, target_families: Iterable[str] | None = None
+    ) -> ArtifactRegistry:
+        return ArtifactRegistry.from_filenames(
+            o.filename for o in self.artifacts(target_families).values()
+        )
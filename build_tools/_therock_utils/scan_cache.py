@@ -0,0 +1,162 @@
+"""Persistent cache of directory listings for PatternMatcher scans.
+
+Build flows invoke `fileset_tool.py` many times over the same `stage/` and
+`artifacts/` trees, and on a no-op incremental build nothing under them has
+changed. The ScanCache records the child entries of each scanned directory,
+keyed by the directory path and validated against the directory's mtime and
+inode. Adding, removing or renaming a child updates the directory mtime, so
+a changed directory is simply re-listed. Only names and entry types are
+cached: file stat data is always fetched live, since modifying a file's
+contents does not touch its parent directory.
+
+There is one cache file per scanned base directory, written atomically, so
+concurrent fileset_tool invocations can at worst lose each other's updates.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+import time
+
+# If set, PatternMatcher instances which are not explicitly configured will
+# persist scan caches in this directory.
+SCAN_CACHE_DIR_ENV_VAR = "THEROCK_FILESET_SCAN_CACHE_DIR"
+
+# Bumped whenever the on-disk format changes.
+_CACHE_VERSION = 1
+
+# Directories modified within this window of being listed are not cached, as
+# a subsequent modification could land within the same mtime granularity
+# and go unnoticed (the "racy git" problem).
+_RACY_WINDOW_NS = 2_000_000_000
+
+_KIND_DIR = "d"
+_KIND_SYMLINK = "l"
+_KIND_FILE = "f"
+_KIND_OTHER = "o"
+
+
+class CachedDirEntry:
+    """Stand-in for os.DirEntry reconstituted from a ScanCache record."""
+
+    __slots__ = ["name", "path", "_kind", "_inode", "_stat", "_lstat"]
+
+    def __init__(self, dirpath: str, name: str, kind: str, inode: int):
+        self.name = name
+        self.path = os.path.join(dirpath, name)
+        self._kind = kind
+        self._inode = inode
+        self._stat: os.stat_result | None = None
+        self._lstat: os.stat_result | None = None
+
+    def inode(self) -> int:
+        return self._inode
+
+    def is_dir(self, *, follow_symlinks: bool = True) -> bool:
+        if self._kind == _KIND_SYMLINK and follow_symlinks:
+            return os.path.isdir(self.path)
+        return self._kind == _KIND_DIR
+
+    def is_file(self, *, follow_symlinks: bool = True) -> bool:
+        if self._kind == _KIND_SYMLINK and follow_symlinks:
+            return os.path.isfile(self.path)
+        return self._kind == _KIND_FILE
+
+    def is_symlink(self) -> bool:
+        return self._kind == _KIND_SYMLINK
+
+    def stat(self, *, follow_symlinks: bool = True) -> os.stat_result:
+        if follow_symlinks:
+            if self._stat is None:
+                self._stat = os.stat(self.path)
+            return self._stat
+        if self._lstat is None:
+            self._lstat = os.lstat(self.path)
+        return self._lstat
+
+    def __fspath__(self) -> str:
+        return self.path
+
+    def __repr__(self):
+        return f"<CachedDirEntry {self.name!r}>"
+
+
+def _entry_kind(entry: os.DirEntry[str]) -> str:
+    if entry.is_symlink():
+        return _KIND_SYMLINK
+    if entry.is_dir(follow_symlinks=False):
+        return _KIND_DIR
+    if entry.is_file(follow_symlinks=False):
+        return _KIND_FILE
+    return _KIND_OTHER
+
+
+class ScanCache:
+    """Directory listing cache for one base directory."""
+
+    def __init__(self, cache_dir: Path, basedir: Path):
+        self.basedir = os.fspath(basedir)
+        key = hashlib.sha256(self.basedir.encode()).hexdigest()[:32]
+        self.cache_file = cache_dir / f"{key}.json"
+        # Map of directory path to [mtime_ns, inode, [[name, kind, inode], ...]].
+        self.dirs: dict[str, list] = {}
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.cache_file, "rt") as f:
+                contents = json.load(f)
+        except (OSError, ValueError):
+            return
+        if (
+            contents.get("version") != _CACHE_VERSION
+            or contents.get("basedir") != self.basedir
+        ):
+            return
+        self.dirs = contents.get("dirs", {})
+
+    def save(self):
+        if not self.dirty:
+            return
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.cache_file.with_name(
+            f"{self.cache_file.name}.{os.getpid()}.tmp"
+        )
+        with open(tmp_file, "wt") as f:
+            json.dump(
+                {"version": _CACHE_VERSION, "basedir": self.basedir, "dirs": self.dirs},
+                f,
+                separators=(",", ":"),
+            )
+        os.replace(tmp_file, self.cache_file)
+        self.dirty = False
+
+    def list_dir(self, dirpath: str) -> list[os.DirEntry[str] | CachedDirEntry]:
+        """Lists a directory, from the cache if it is unchanged."""
+        st = os.stat(dirpath)
+        record = self.dirs.get(dirpath)
+        if record and record[0] == st.st_mtime_ns and record[1] == st.st_ino:
+            self.hits += 1
+            return [
+                CachedDirEntry(dirpath, name, kind, inode)
+                for name, kind, inode in record[2]
+            ]
+
+        self.misses += 1
+        with os.scandir(dirpath) as it:
+            entries = list(it)
+        if time.time_ns() - st.st_mtime_ns > _RACY_WINDOW_NS:
+            self.dirs[dirpath] = [
+                st.st_mtime_ns,
+                st.st_ino,
+                [[e.name, _entry_kind(e), e.inode()] for e in entries],
+            ]
+            self.dirty = True
+        elif record:
+            del self.dirs[dirpath]
+            self.dirty = True
+        return entries
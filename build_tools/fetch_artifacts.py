@@ -11,25 +11,31 @@ Example usage (using https://github.com/ROCm/TheRock/actions/runs/15685736080):
   python build_tools/fetch_artifacts.py \
     --run-id 15685736080 --target gfx110X-dgpu --output-dir ~/.therock/artifacts_15685736080
 
-Or, to fetch _all_ artifacts and not just a subset (this is safest for packaging
-workflows where dependencies may not be accurately modeled, at the cost of
-additional disk space):
+The selected artifacts are resolved to their dependency closure using the
+artifact graph published with the run (see _therock_utils/artifact_graph.py).
+Or, to fetch _all_ artifacts and not just a subset (at the cost of additional
+disk space):
   mkdir -p ~/.therock/artifacts_15685736080
   python build_tools/fetch_artifacts.py \
     --run-id 15685736080 --target gfx110X-dgpu --output-dir ~/.therock/artifacts_15685736080 \
     --all
+
+Downloads are shared across runs through a local cache if `--cache-dir` (or the
+THEROCK_ARTIFACT_CACHE_DIR environment variable) is set.
 """
 
 import argparse
 import boto3
 from botocore import UNSIGNED
 from botocore.config import Config
-import concurrent.futures
+from botocore.exceptions import ClientError
 from dataclasses import dataclass
+import functools
+import os
 from pathlib import Path
 import platform
 import sys
-import tarfile
+import threading
 import time
 import warnings
 from urllib3.exceptions import InsecureRequestWarning
@@ -48,7 +54,17 @@ THEROCK_DIR = Path(__file__).resolve().parent.parent
 # Importing build_artifact_upload.py
 sys.path.append(str(THEROCK_DIR / "build_tools" / "github_actions"))
 from upload_build_artifacts import retrieve_bucket_info
-from _therock_utils.artifacts import ArtifactName
+from _therock_utils.archive_util import open_archive
+from _therock_utils.artifact_graph import ArtifactGraph, artifact_graph_filename
+from _therock_utils.artifacts import ArtifactName, ArtifactRegistry
+from _therock_utils.download_cache import (
+    DEFAULT_MAX_BYTES,
+    DOWNLOAD_CACHE_DIR_ENV_VAR,
+    DownloadCache,
+)
+from _therock_utils.download_scheduler import DownloadScheduler, ScheduledDownload
+from _therock_utils.s3_download import S3Downloader
+from _therock_utils.s3_listing import DEFAULT_LISTING_TTL, RunListing
 
 GENERIC_VARIANT = "generic"
 PLATFORM = platform.system().lower()
@@ -60,24 +76,84 @@ def log(*args, **kwargs):
     sys.stdout.flush()
 
 
-def retrieve_s3_artifacts(run_id, amdgpu_family):
-    """Checks that the AWS S3 bucket exists and returns artifact names."""
+# Shared by all downloads, which bounds the total number of concurrent range
+# requests across artifacts.
+downloader = S3Downloader(s3_client, log=log)
+
+
+def add_download_cache_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        default=os.getenv(DOWNLOAD_CACHE_DIR_ENV_VAR),
+        help=f"Local download cache shared across runs (defaults to ${DOWNLOAD_CACHE_DIR_ENV_VAR})",
+    )
+    parser.add_argument(
+        "--cache-max-gb",
+        type=float,
+        default=DEFAULT_MAX_BYTES / (1 << 30),
+        help="Size limit of the download cache, evicting least recently used artifacts",
+    )
+
+
+def configure_download_cache(args: argparse.Namespace):
+    """Enables the download cache, if one was requested."""
+    if args.cache_dir:
+        downloader.cache = DownloadCache(
+            Path(args.cache_dir), int(args.cache_max_gb * (1 << 30))
+        )
+        log(f"Using download cache {args.cache_dir}")
+
+
+def log_download_cache_stats():
+    if downloader.cache:
+        log(f"Download cache: {downloader.cache.summary()}")
+
+
+def add_listing_cache_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--listing-ttl",
+        type=float,
+        default=DEFAULT_LISTING_TTL,
+        help="Seconds for which the S3 listing of a run, cached next to the output directory, is reused (0 to disable)",
+    )
+
+
+def listing_cache_path(output_dir: Path, run_id: str) -> Path:
+    """Returns where the S3 listing of a run is cached for an output directory.
+
+    The cache lives next to (not in) the output directory, since some flows
+    recreate the output directory.
+    """
+    output_dir = Path(output_dir).resolve()
+    return output_dir.parent / f".{output_dir.name}.s3_listing_{run_id}-{PLATFORM}.json"
+
+
+def retrieve_s3_run_listing(
+    run_id,
+    cache_path: Path | None = None,
+    ttl: float = DEFAULT_LISTING_TTL,
+) -> RunListing:
+    """Lists the objects uploaded for a run, reusing a fresh cached listing."""
     EXTERNAL_REPO, BUCKET = retrieve_bucket_info()
     s3_directory_path = f"{EXTERNAL_REPO}{run_id}-{PLATFORM}/"
-    page_iterator = paginator.paginate(Bucket=BUCKET, Prefix=s3_directory_path)
-    data = set()
-    for page in page_iterator:
-        if "Contents" in page:
-            for artifact in page["Contents"]:
-                artifact_key = artifact["Key"]
-                if (
-                    "sha256sum" not in artifact_key
-                    and "tar.xz" in artifact_key
-                    and (amdgpu_family in artifact_key or "generic" in artifact_key)
-                ):
-                    file_name = artifact_key.split("/")[-1]
-                    data.add(file_name)
-    return data
+    return RunListing.cached(paginator, BUCKET, s3_directory_path, cache_path, ttl)
+
+
+def retrieve_s3_artifacts(
+    run_id,
+    amdgpu_family,
+    cache_path: Path | None = None,
+    ttl: float = DEFAULT_LISTING_TTL,
+):
+    """Checks that the AWS S3 bucket exists and returns artifact names.
+
+    Only artifacts of the `amdgpu_family` and generic target families are
+    returned.
+    """
+    listing = retrieve_s3_run_listing(run_id, cache_path, ttl)
+    artifacts = listing.artifacts([amdgpu_family, GENERIC_VARIANT])
+    return set(o.filename for o in artifacts.values())
 
 
 @dataclass
@@ -99,16 +175,26 @@ def collect_artifacts_download_requests(
     run_id: str,
     output_dir: Path,
     variant: str,
-    existing_artifacts: set[str],
+    existing_artifacts: ArtifactRegistry,
+    fallback_variant: str | None = None,
 ) -> list[ArtifactDownloadRequest]:
-    """Collects S3 artifact URLs to execute later in parallel."""
+    """Collects S3 artifact URLs to execute later in parallel.
+
+    Artifact names are of the form `{name}_{component}`. Artifacts which do not
+    exist for `variant` are taken from `fallback_variant`, if given.
+    """
     artifacts_to_retrieve = []
     EXTERNAL_REPO, BUCKET = retrieve_bucket_info()
     s3_key_path = f"{EXTERNAL_REPO}{run_id}-{PLATFORM}"
     for artifact_name in artifact_names:
-        file_name = f"{artifact_name}_{variant}.tar.xz"
+        name, component = artifact_name.split("_")
+        file_name = existing_artifacts.filename(ArtifactName(name, component, variant))
+        if not file_name and fallback_variant:
+            file_name = existing_artifacts.filename(
+                ArtifactName(name, component, fallback_variant)
+            )
         # If artifact does exist in s3 bucket
-        if file_name in existing_artifacts:
+        if file_name:
             artifacts_to_retrieve.append(
                 ArtifactDownloadRequest(
                     artifact_key=f"{s3_key_path}/{file_name}",
@@ -120,7 +206,31 @@ def collect_artifacts_download_requests(
     return artifacts_to_retrieve
 
 
-def download_artifact(artifact_download_request: ArtifactDownloadRequest):
+def retrieve_published_sha256(
+    artifact_download_request: ArtifactDownloadRequest,
+) -> str | None:
+    """Retrieves the digest from the artifact's `.sha256sum` file, if published."""
+    hash_key = f"{artifact_download_request.artifact_key}.sha256sum"
+    try:
+        response = s3_client.get_object(
+            Bucket=artifact_download_request.bucket, Key=hash_key
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            log(f"++ No published sha256sum for {hash_key}, not verifying")
+            return None
+        raise
+    return response["Body"].read().decode().split()[0].lower()
+
+
+def download_artifact(
+    artifact_download_request: ArtifactDownloadRequest,
+    cancel: threading.Event | None = None,
+):
+    """Downloads and verifies an artifact, raising if all retries fail.
+
+    If `cancel` is set, the download stops and raises without retrying.
+    """
     MAX_RETRIES = 3
     BASE_DELAY = 3  # seconds
     for attempt in range(MAX_RETRIES):
@@ -128,12 +238,17 @@ def download_artifact(artifact_download_request: ArtifactDownloadRequest):
             artifact_key = artifact_download_request.artifact_key
             bucket = artifact_download_request.bucket
             output_path = artifact_download_request.output_path
+            sha256 = retrieve_published_sha256(artifact_download_request)
             log(f"++ Downloading {artifact_key} to {output_path}")
-            with open(output_path, "wb") as f:
-                s3_client.download_fileobj(bucket, artifact_key, f)
+            downloader.download(
+                bucket, artifact_key, output_path, sha256=sha256, cancel=cancel
+            )
             log(f"++ Download complete for {output_path}")
+            return
         except Exception as e:
             log(f"++ Error downloading {artifact_key}: {e}")
+            if cancel and cancel.is_set():
+                raise
             if attempt < MAX_RETRIES - 1:
                 delay = BASE_DELAY * (2**attempt)
                 print(f"Retrying in {delay} seconds...")
@@ -142,35 +257,80 @@ def download_artifact(artifact_download_request: ArtifactDownloadRequest):
                 log(
                     f"++ Failed downloading from {artifact_key} after {MAX_RETRIES} retries"
                 )
+                raise
 
 
-def download_artifacts(artifact_download_requests: list[ArtifactDownloadRequest]):
-    """Downloads artifacts in parallel using a thread pool executor."""
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = [
-            executor.submit(download_artifact, artifact_download_request)
-            for artifact_download_request in artifact_download_requests
+def open_artifact_stream(artifact_download_request: ArtifactDownloadRequest):
+    """Opens an artifact for streaming, verified against its published digest."""
+    return downloader.open_stream(
+        artifact_download_request.bucket,
+        artifact_download_request.artifact_key,
+        sha256=retrieve_published_sha256(artifact_download_request),
+    )
+
+
+def artifact_download_size(
+    artifact_download_request: ArtifactDownloadRequest,
+    listing: RunListing | None = None,
+) -> int:
+    """Returns the size of an artifact, from the run listing if it has it."""
+    listed = (
+        listing.get(artifact_download_request.output_path.name) if listing else None
+    )
+    if listed and listed.key == artifact_download_request.artifact_key:
+        return listed.size
+    response = s3_client.head_object(
+        Bucket=artifact_download_request.bucket,
+        Key=artifact_download_request.artifact_key,
+    )
+    return response["ContentLength"]
+
+
+def download_artifacts(
+    artifact_download_requests: list[ArtifactDownloadRequest],
+    listing: RunListing | None = None,
+):
+    """Downloads artifacts concurrently, largest first.
+
+    See DownloadScheduler for how downloads are limited by disk space and
+    timed out in proportion to their size. Sizes are taken from `listing`
+    where possible.
+    """
+    if not artifact_download_requests:
+        return
+    scheduler = DownloadScheduler(
+        artifact_download_requests[0].output_path.parent, log=log
+    )
+    scheduler.run(
+        [
+            ScheduledDownload(
+                name=request.output_path.name,
+                size=artifact_download_size(request, listing),
+                download=functools.partial(download_artifact, request),
+            )
+            for request in artifact_download_requests
         ]
-        for future in concurrent.futures.as_completed(futures):
-            future.result(timeout=60)
+    )
+    log(f"++ Download summary: {scheduler.summary()}")
 
 
 def retrieve_all_artifacts(
     run_id: str,
     target: str,
     output_dir: Path,
-    s3_artifacts: set[str],
+    s3_artifacts: ArtifactRegistry,
+    listing: RunListing | None = None,
 ):
     """Retrieves all available artifacts."""
     artifacts_to_retrieve = []
     EXTERNAL_REPO, BUCKET = retrieve_bucket_info()
     s3_key_path = f"{EXTERNAL_REPO}{run_id}-{PLATFORM}"
 
-    for artifact in sorted(list(s3_artifacts)):
-        an = ArtifactName.from_filename(artifact)
-        if an.target_family != "generic" and target != an.target_family:
+    selected = s3_artifacts.query(target_families=[GENERIC_VARIANT, target])
+    for an in s3_artifacts:
+        if an not in selected:
             continue
-
+        artifact = s3_artifacts.filename(an)
         artifacts_to_retrieve.append(
             ArtifactDownloadRequest(
                 artifact_key=f"{s3_key_path}/{artifact}",
@@ -179,16 +339,11 @@ def retrieve_all_artifacts(
             )
         )
 
-    download_artifacts(artifacts_to_retrieve)
+    download_artifacts(artifacts_to_retrieve, listing)
 
 
-def retrieve_base_artifacts(
-    args: argparse.Namespace,
-    run_id: str,
-    output_dir: Path,
-    s3_artifacts: set[str],
-):
-    """Retrieves TheRock base artifacts using urllib."""
+def base_artifact_names(args: argparse.Namespace) -> list[str]:
+    """Returns the `{name}_{component}` base artifacts."""
     base_artifacts = [
         "core-runtime_run",
         "core-runtime_lib",
@@ -203,21 +358,11 @@ def retrieve_base_artifacts(
     ]
     if args.blas:
         base_artifacts.append("host-blas_lib")
+    return base_artifacts
 
-    artifacts_to_retrieve = collect_artifacts_download_requests(
-        base_artifacts, run_id, output_dir, GENERIC_VARIANT, s3_artifacts
-    )
-    download_artifacts(artifacts_to_retrieve)
 
-
-def retrieve_enabled_artifacts(
-    args: argparse.Namespace,
-    target: str,
-    run_id: str,
-    output_dir: Path,
-    s3_artifacts: set[str],
-):
-    """Retrieves TheRock artifacts using urllib, based on the enabled arguments.
+def enabled_artifact_names(args: argparse.Namespace) -> list[str]:
+    """Returns the `{name}_{component}` artifacts for the enabled arguments.
 
     If no artifacts have been collected, we assume that we want to install the default subset.
     If `args.tests` have been enabled, we also collect test artifacts.
@@ -251,11 +396,59 @@ def retrieve_enabled_artifacts(
         enabled_artifacts.append(f"{base_path}_lib")
         if args.tests:
             enabled_artifacts.append(f"{base_path}_test")
+    return enabled_artifacts
+
 
-    artifacts_to_retrieve = collect_artifacts_download_requests(
-        enabled_artifacts, run_id, output_dir, target, s3_artifacts
+def retrieve_artifact_graph(run_id: str, target: str) -> ArtifactGraph | None:
+    """Retrieves the artifact dependency graph published for a run, if any."""
+    EXTERNAL_REPO, BUCKET = retrieve_bucket_info()
+    graph_key = f"{EXTERNAL_REPO}{run_id}-{PLATFORM}/{artifact_graph_filename(target)}"
+    try:
+        response = s3_client.get_object(Bucket=BUCKET, Key=graph_key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            log(f"++ No artifact graph at {graph_key}, using default artifact lists")
+            return None
+        raise
+    return ArtifactGraph.from_json(response["Body"].read().decode())
+
+
+def collect_selected_artifacts_download_requests(
+    args: argparse.Namespace,
+    target: str,
+    run_id: str,
+    output_dir: Path,
+    s3_artifacts: ArtifactRegistry,
+    graph: ArtifactGraph | None,
+) -> list[ArtifactDownloadRequest]:
+    """Collects download requests for the base and enabled artifacts.
+
+    If there is an artifact graph, the base and enabled artifacts are resolved
+    to their dependency closure, taking each artifact from the target family if
+    it exists there and from the generic artifacts otherwise. Base artifacts
+    are always included, even if the graph does not list them. Without a graph,
+    base artifacts are generic and enabled artifacts are for the target family.
+    """
+    base_artifacts = base_artifact_names(args)
+    enabled_artifacts = [] if args.base_only else enabled_artifact_names(args)
+    if graph is None:
+        return collect_artifacts_download_requests(
+            base_artifacts, run_id, output_dir, GENERIC_VARIANT, s3_artifacts
+        ) + collect_artifacts_download_requests(
+            enabled_artifacts, run_id, output_dir, target, s3_artifacts
+        )
+
+    closure = graph.closure(base_artifacts + enabled_artifacts)
+    closure += [name for name in base_artifacts if name not in closure]
+    log(f"++ Resolved {len(closure)} artifacts from the artifact graph")
+    return collect_artifacts_download_requests(
+        closure,
+        run_id,
+        output_dir,
+        target,
+        s3_artifacts,
+        fallback_variant=GENERIC_VARIANT,
     )
-    download_artifacts(artifacts_to_retrieve)
 
 
 def _extract_archives_into_subdirectories(output_dir: Path):
@@ -276,7 +469,7 @@ def _extract_archives_into_subdirectories(output_dir: Path):
         #   2. .partition('.') gets (before, sep, after), discard all but 'before'
         archive_file_stem, _, _ = archive_file.name.partition(".")
 
-        with tarfile.TarFile.open(archive_file, mode="r:xz") as tf:
+        with open_archive(archive_file) as tf:
             log(f"++ Extracting '{archive_file.name}' to '{archive_file_stem}'")
             tf.extractall(output_dir / archive_file_stem, filter="tar")
 
@@ -288,17 +481,26 @@ def run(args):
     if not output_dir.is_dir():
         log(f"Output dir '{output_dir}' does not exist. Exiting...")
         return
-    s3_artifacts = retrieve_s3_artifacts(run_id, target)
+    listing = retrieve_s3_run_listing(
+        run_id, listing_cache_path(output_dir, run_id), args.listing_ttl
+    )
+    s3_artifacts = listing.registry([target, GENERIC_VARIANT])
     if not s3_artifacts:
         log(f"S3 artifacts for {run_id} does not exist. Exiting...")
         return
+    configure_download_cache(args)
 
     if args.all:
-        retrieve_all_artifacts(run_id, target, output_dir, s3_artifacts)
+        retrieve_all_artifacts(run_id, target, output_dir, s3_artifacts, listing)
     else:
-        retrieve_base_artifacts(args, run_id, output_dir, s3_artifacts)
-        if not args.base_only:
-            retrieve_enabled_artifacts(args, target, run_id, output_dir, s3_artifacts)
+        graph = retrieve_artifact_graph(run_id, target)
+        download_artifacts(
+            collect_selected_artifacts_download_requests(
+                args, target, run_id, output_dir, s3_artifacts, graph
+            ),
+            listing,
+        )
+    log_download_cache_stats()
 
     if args.extract:
         _extract_archives_into_subdirectories(output_dir)
@@ -333,6 +535,8 @@ def main(argv):
         action=argparse.BooleanOptionalAction,
         help="Extract files after fetching them",
     )
+    add_download_cache_arguments(parser)
+    add_listing_cache_arguments(parser)
 
     artifacts_group = parser.add_argument_group("artifacts_group")
     artifacts_group.add_argument(
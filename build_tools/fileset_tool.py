@@ -13,17 +13,35 @@ with the following changes:
 * It does not support character classes.
 """
 
-from typing import Callable
+from typing import Callable, Iterable
 import argparse
-from pathlib import Path
+import os
+from pathlib import Path, PurePosixPath
 import platform
 import sys
 import shutil
 import tarfile
 
-from _therock_utils.artifacts import ArtifactPopulator
+from _therock_utils.archive_util import (
+    COPY_BUFSIZE,
+    DEFAULT_COMPRESSION_THREADS,
+    ArchiveWriter,
+    IndexedArchive,
+    archive_index_path,
+    open_archive,
+)
+from _therock_utils.artifacts import ArtifactPopulator, RelpathIndex
+from _therock_utils.content_store import (
+    ARTIFACT_CONTENTS_NAME,
+    ContentStore,
+    collect_contents,
+    diff_contents,
+    parse_contents_manifest,
+    read_artifact_contents,
+    write_contents_manifest,
+)
 from _therock_utils.hash_util import calculate_hash, write_hash
-from _therock_utils.pattern_match import PatternMatcher
+from _therock_utils.pattern_match import MatchPredicate, PatternMatcher
 
 
 def evaluate_optional(optional_value) -> bool:
@@ -170,12 +188,23 @@ def do_artifact(args):
 
     This is called once per component and will create a directory for that
     component.
+
+    With `--incremental`, an existing output directory is updated in place:
+    only entries that differ from the desired fileset are (re)linked, and
+    entries that are no longer part of it are removed.
+
+    With `--contents-manifest`, an `artifact_contents.txt` manifest is written
+    with the kind, mode, size and digest (or symlink target) of every entry.
+    With `--content-store`, every file is additionally deduplicated into the
+    given content addressed store (the artifact holds hardlinks to blobs).
     """
     descriptor = load_toml_file(args.descriptor) or {}
     component_name = args.component
     # Set up output dir.
     output_dir: Path = args.output_dir
-    if output_dir.exists():
+    manifest_path = output_dir / "artifact_manifest.txt"
+    incremental = args.incremental and output_dir.exists()
+    if output_dir.exists() and not incremental:
         shutil.rmtree(output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
 
@@ -187,6 +216,7 @@ def do_artifact(args):
         component_record = {}
 
     all_basedir_relpaths = []
+    materialized_relpaths: set[str] = set()
     for basedir_relpath, basedir_record in component_record.items():
         use_default_patterns = basedir_record.get("default_patterns", True)
         basedir = args.root_dir / Path(basedir_relpath)
@@ -218,29 +248,101 @@ def do_artifact(args):
             force_includes=force_includes,
         )
         pm.add_basedir(basedir)
-        pm.copy_to(
-            destdir=output_dir,
-            destprefix=basedir_relpath + "/",
-            remove_dest=False,
+        materialized_relpaths.update(
+            pm.copy_to(
+                destdir=output_dir,
+                destprefix=basedir_relpath + "/",
+                remove_dest=False,
+                update=incremental,
+            )
         )
 
+    if incremental:
+        _remove_stale_entries(output_dir, materialized_relpaths, manifest_path)
+
+    if args.contents_manifest or args.content_store:
+        entries = collect_contents(
+            output_dir,
+            all_basedir_relpaths,
+            store=ContentStore(args.content_store) if args.content_store else None,
+        )
+        write_contents_manifest(output_dir / ARTIFACT_CONTENTS_NAME, entries)
+
     # Write a manifest containing relative paths of all base directories.
-    manifest_path = output_dir / "artifact_manifest.txt"
-    manifest_path.write_text("\n".join(all_basedir_relpaths) + "\n")
+    _write_text_atomic(manifest_path, "\n".join(all_basedir_relpaths) + "\n")
+
+
+def _remove_stale_entries(
+    output_dir: Path, keep_relpaths: set[str], manifest_path: Path
+):
+    """Removes entries under output_dir that are not in keep_relpaths.
+
+    Directories which are not kept themselves are removed only once empty,
+    so parents of kept entries survive.
+    """
+    for dirpath, dirnames, filenames in os.walk(output_dir, topdown=False):
+        dir_relpath = Path(dirpath).relative_to(output_dir).as_posix()
+        prefix = "" if dir_relpath == "." else f"{dir_relpath}/"
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if f"{prefix}{name}" not in keep_relpaths and path != str(manifest_path):
+                os.unlink(path)
+        for name in dirnames:
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                # os.walk reports symlinks to directories as directories.
+                if f"{prefix}{name}" not in keep_relpaths:
+                    os.unlink(path)
+            elif f"{prefix}{name}" not in keep_relpaths and not os.listdir(path):
+                os.rmdir(path)
+
+
+def _write_text_atomic(path: Path, text: str):
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    tmp_path.write_text(text)
+    os.replace(tmp_path, path)
 
 
 def do_artifact_archive(args):
+    """Creates an archive file from one or more artifact directories.
+
+    With `--skip-unchanged`, an existing archive of a single artifact is kept
+    if its contents manifest (see `collect_contents`) matches the artifact's,
+    so artifacts whose files did not change are not compressed again. Its
+    outputs are touched so that build systems see them as up to date.
+    """
     output_path: Path = args.o
+    if args.skip_unchanged and _is_archive_unchanged(args):
+        for path in [output_path, args.hash_file] + (
+            [archive_index_path(output_path)] if args.index else []
+        ):
+            if path:
+                os.utime(path)
+        print(f"Archive {output_path} is unchanged")
+        return
     if output_path.exists():
         output_path.unlink()
+    # A stale index would describe the previous archive.
+    archive_index_path(output_path).unlink(missing_ok=True)
     output_path.parent.mkdir(parents=True, exist_ok=True)
 
-    with _open_archive(output_path, args.compression_level) as arc:
+    with ArchiveWriter(
+        output_path,
+        compression_level=args.compression_level,
+        threads=args.compression_threads,
+        index=args.index,
+    ) as writer:
         for artifact_path in args.artifact:
             manifest_path: Path = artifact_path / "artifact_manifest.txt"
             relpaths = manifest_path.read_text().splitlines()
             # Important: The manifest must be stored first.
-            arc.add(manifest_path, arcname=manifest_path.name, recursive=False)
+            writer.tar.add(manifest_path, arcname=manifest_path.name, recursive=False)
+            # Followed by the contents manifest, if any.
+            contents_path: Path = artifact_path / ARTIFACT_CONTENTS_NAME
+            if contents_path.exists():
+                writer.tar.add(
+                    contents_path, arcname=contents_path.name, recursive=False
+                )
             for relpath in relpaths:
                 if not relpath:
                     continue
@@ -251,22 +353,198 @@ def do_artifact_archive(args):
                 pm.add_basedir(source_dir)
                 for subpath, dir_entry in pm.all.items():
                     fullpath = f"{relpath}/{subpath}"
-                    arc.add(dir_entry.path, arcname=fullpath, recursive=False)
+                    writer.add_direntry(dir_entry, fullpath)
+    print(f"Archived {writer.throughput_summary()}")
 
     if args.hash_file:
         digest = calculate_hash(output_path, args.hash_algorithm)
         write_hash(args.hash_file, digest)
 
 
-def _open_archive(p: Path, compression_level: int) -> tarfile.TarFile:
-    return tarfile.TarFile.open(p, mode="x:xz", preset=compression_level)
+def _is_archive_unchanged(args) -> bool:
+    """Checks whether an existing archive holds what it would be rebuilt with."""
+    output_path: Path = args.o
+    if len(args.artifact) != 1 or not output_path.exists():
+        return False
+    manifest_path: Path = args.artifact[0] / "artifact_manifest.txt"
+    contents_path: Path = args.artifact[0] / ARTIFACT_CONTENTS_NAME
+    if not contents_path.exists():
+        return False
+    if args.hash_file and not args.hash_file.exists():
+        return False
+    if args.index != IndexedArchive.has_index(output_path):
+        return False
+    try:
+        with open_archive(output_path) as tf:
+            archived_manifest = _read_archive_manifest(tf, tf.next())
+            contents_member = tf.next()
+            if (
+                contents_member is None
+                or contents_member.name != ARTIFACT_CONTENTS_NAME
+            ):
+                return False
+            with tf.extractfile(contents_member) as contents_file:
+                archived_contents = parse_contents_manifest(
+                    contents_file.read().decode()
+                )
+    except Exception:
+        # An unreadable archive is rebuilt.
+        return False
+    return archived_manifest == [
+        relpath for relpath in manifest_path.read_text().splitlines() if relpath
+    ] and archived_contents == parse_contents_manifest(contents_path.read_text())
+
+
+def do_artifact_diff(args):
+    changes = diff_contents(
+        read_artifact_contents(args.old), read_artifact_contents(args.new)
+    )
+    for change, relpath in changes:
+        print(f"{change} {relpath}")
+    if changes:
+        sys.exit(1)
+
+
+def do_artifact_extract(args):
+    """Extracts matching files from an artifact archive.
+
+    Patterns are matched against paths relative to the artifact basedirs, and
+    files are extracted flattened into the output directory (as with
+    `artifact-flatten`). If the archive has an index, only the compressed
+    blocks holding matching members are decompressed. Otherwise, the archive
+    is scanned sequentially, and scanned again if a matching hardlink's target
+    did not match (as its data was already passed).
+    """
+    archive_path: Path = args.artifact
+    output_dir: Path = args.o
+    predicate = MatchPredicate(args.include, args.exclude or [])
+
+    def select(names: Iterable[str], relpath_index: RelpathIndex):
+        for name in names:
+            found = relpath_index.lookup(name)
+            if found and predicate.matches(found[1], None):
+                yield name, found[1]
+
+    if IndexedArchive.has_index(archive_path):
+        with IndexedArchive(archive_path) as archive:
+            relpath_index = RelpathIndex(
+                _read_archive_manifest(
+                    archive.tar, archive.getmember("artifact_manifest.txt")
+                ),
+                output_dir,
+                flatten=True,
+            )
+            # Visit members in archive order so each block is decompressed once.
+            names = sorted(archive.member_offsets, key=archive.member_offsets.get)
+            members = (
+                (archive.getmember(name), scoped_path)
+                for name, scoped_path in select(names, relpath_index)
+            )
+            count, _ = _extract_members(
+                archive.tar, members, archive.getmember, output_dir
+            )
+            print(
+                f"Extracted {count} members from {archive_path.name} (decompressed "
+                f"{archive.reader.blocks_decompressed} of {archive.block_count} blocks)"
+            )
+    else:
+        with open_archive(archive_path) as tf:
+            relpath_index = RelpathIndex(
+                _read_archive_manifest(tf, tf.next()), output_dir, flatten=True
+            )
+
+            def scan_members():
+                while member := tf.next():
+                    for _, scoped_path in select([member.name], relpath_index):
+                        yield member, scoped_path
+
+            count, unresolved_links = _extract_members(
+                tf, scan_members(), None, output_dir
+            )
+        if unresolved_links:
+            with open_archive(archive_path) as tf:
+                while unresolved_links and (member := tf.next()):
+                    dest_paths = unresolved_links.pop(member.name, [])
+                    if dest_paths:
+                        _write_member_file(tf, member, dest_paths[0])
+                    for dest_path in dest_paths[1:]:
+                        os.link(dest_paths[0], dest_path)
+            if unresolved_links:
+                raise IOError(
+                    f"Hardlink targets missing from {archive_path}: "
+                    f"{sorted(unresolved_links)}"
+                )
+        print(f"Extracted {count} members from {archive_path.name} (no index)")
+
+
+def _read_archive_manifest(tf: tarfile.TarFile, member: tarfile.TarInfo | None):
+    if member is None or member.name != "artifact_manifest.txt":
+        raise IOError("Artifact archive must have artifact_manifest.txt first")
+    with tf.extractfile(member) as mf_file:
+        return [relpath for relpath in mf_file.read().decode().splitlines() if relpath]
+
+
+def _extract_members(
+    tf: tarfile.TarFile,
+    members: Iterable[tuple[tarfile.TarInfo, str]],
+    lookup: Callable[[str], tarfile.TarInfo] | None,
+    output_dir: Path,
+) -> tuple[int, dict[str, list[Path]]]:
+    """Extracts members to their scoped paths, returning the member count.
+
+    A hardlink whose target was not extracted gets the target's data, read
+    from the member returned by `lookup`. If `lookup` is None (the archive can
+    only be read front to back), such hardlinks are instead returned by target
+    name, for the caller to write in another pass over the archive.
+    """
+    dest_paths: dict[str, Path] = {}
+    unresolved_links: dict[str, list[Path]] = {}
+    count = 0
+    for member, scoped_path in members:
+        dest_path = output_dir / PurePosixPath(scoped_path)
+        if dest_path.is_symlink() or (dest_path.exists() and not dest_path.is_dir()):
+            dest_path.unlink()
+        dest_path.parent.mkdir(parents=True, exist_ok=True)
+        if member.isdir():
+            dest_path.mkdir(exist_ok=True)
+        elif member.issym():
+            dest_path.symlink_to(member.linkname)
+        elif member.islnk() and member.linkname in dest_paths:
+            os.link(dest_paths[member.linkname], dest_path)
+        elif member.islnk() and lookup is None:
+            unresolved_links.setdefault(member.linkname, []).append(dest_path)
+        elif member.isfile() or member.islnk():
+            # A hardlink whose target was not selected gets the target's data.
+            data_member = lookup(member.linkname) if member.islnk() else member
+            _write_member_file(tf, data_member, dest_path)
+            dest_paths[member.name] = dest_path
+        else:
+            raise IOError(f"Unhandled tar member: {member}")
+        count += 1
+    return count, unresolved_links
+
+
+def _write_member_file(tf: tarfile.TarFile, member: tarfile.TarInfo, dest_path: Path):
+    with tf.extractfile(member) as member_file:
+        with open(dest_path, "wb") as out_file:
+            shutil.copyfileobj(member_file, out_file, COPY_BUFSIZE)
+    exec_mask = member.mode & 0o111
+    os.chmod(dest_path, os.stat(dest_path).st_mode | exec_mask)
 
 
 def _do_artifact_flatten(args):
     flattener = ArtifactPopulator(
-        output_path=args.o, verbose=args.verbose, flatten=True
+        output_path=args.o,
+        verbose=args.verbose,
+        flatten=True,
+        content_store=ContentStore(args.content_store) if args.content_store else None,
+        jobs=args.jobs,
+        memory_limit=args.memory_limit_mb << 20,
+        update=args.update,
     )
     flattener(*args.artifact)
+    if args.verbose:
+        print(f"Populated {flattener.throughput_summary()}", file=sys.stderr)
     relpaths = list(flattener.relpaths)
     relpaths.sort()
     for relpath in relpaths:
@@ -358,6 +636,22 @@ def main(cl_args: list[str]):
     artifact_p.add_argument(
         "--component", required=True, help="Component within the descriptor to merge"
     )
+    artifact_p.add_argument(
+        "--incremental",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="Update an existing output directory in place vs recreating it",
+    )
+    artifact_p.add_argument(
+        "--contents-manifest",
+        action="store_true",
+        help="Write an artifact_contents.txt with per-file size, mode and digest",
+    )
+    artifact_p.add_argument(
+        "--content-store",
+        type=Path,
+        help="Content addressed store directory to deduplicate files into (implies --contents-manifest)",
+    )
     artifact_p.set_defaults(func=do_artifact)
 
     # 'artifact-archive' command
@@ -369,13 +663,22 @@ def main(cl_args: list[str]):
         "artifact", nargs="+", type=Path, help="Artifact directory"
     )
     artifact_archive_p.add_argument(
-        "-o", type=Path, required=True, help="Output archive name"
+        "-o",
+        type=Path,
+        required=True,
+        help="Output archive name (.tar.xz, or .tar.zst to compress with zstd)",
     )
     artifact_archive_p.add_argument(
         "--compression-level",
         type=int,
         default=6,
-        help="LZMA compression preset level [0-9, default 6]",
+        help="LZMA compression preset level [0-9, default 6] or zstd level",
+    )
+    artifact_archive_p.add_argument(
+        "--compression-threads",
+        type=int,
+        default=DEFAULT_COMPRESSION_THREADS,
+        help=f"Number of compression threads (default {DEFAULT_COMPRESSION_THREADS}, 0 uses all cores)",
     )
     artifact_archive_p.add_argument(
         "--hash-file",
@@ -385,8 +688,49 @@ def main(cl_args: list[str]):
     artifact_archive_p.add_argument(
         "--hash-algorithm", default="sha256", help="Hash algorithm"
     )
+    artifact_archive_p.add_argument(
+        "--index",
+        action="store_true",
+        help="Write a {archive}.index for random access by artifact-extract (.tar.xz only)",
+    )
+    artifact_archive_p.add_argument(
+        "--skip-unchanged",
+        action="store_true",
+        help="Keep an existing archive whose artifact_contents.txt matches the artifact's "
+        "(compression options are not compared)",
+    )
     artifact_archive_p.set_defaults(func=do_artifact_archive)
 
+    # 'artifact-diff' command
+    artifact_diff_p = sub_p.add_parser(
+        "artifact-diff",
+        help="Lists changed files between two artifact directories or archives "
+        "using their contents manifests (exits with 1 if there are changes)",
+    )
+    artifact_diff_p.add_argument("old", type=Path, help="Old artifact dir or archive")
+    artifact_diff_p.add_argument("new", type=Path, help="New artifact dir or archive")
+    artifact_diff_p.set_defaults(func=do_artifact_diff)
+
+    # 'artifact-extract' command
+    artifact_extract_p = sub_p.add_parser(
+        "artifact-extract",
+        help="Extracts matching files from an artifact archive into a flat directory",
+    )
+    artifact_extract_p.add_argument("artifact", type=Path, help="Artifact archive")
+    artifact_extract_p.add_argument(
+        "-o", type=Path, required=True, help="Output directory"
+    )
+    artifact_extract_p.add_argument(
+        "--include",
+        nargs="+",
+        required=True,
+        help="Recursive glob pattern (relative to the artifact basedir) to extract",
+    )
+    artifact_extract_p.add_argument(
+        "--exclude", nargs="+", help="Recursive glob pattern to exclude"
+    )
+    artifact_extract_p.set_defaults(func=do_artifact_extract)
+
     # 'artifact-flatten' command
     artifact_flatten_p = sub_p.add_parser(
         "artifact-flatten",
@@ -401,6 +745,28 @@ def main(cl_args: list[str]):
     artifact_flatten_p.add_argument(
         "--verbose", action="store_true", help="Print verbose status"
     )
+    artifact_flatten_p.add_argument(
+        "--content-store",
+        type=Path,
+        help="Content addressed store directory to link/deduplicate files with",
+    )
+    artifact_flatten_p.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of archives to extract in parallel processes (default 1, 0 uses all cores)",
+    )
+    artifact_flatten_p.add_argument(
+        "--update",
+        action="store_true",
+        help="Skip files which already exist in the output with identical contents",
+    )
+    artifact_flatten_p.add_argument(
+        "--memory-limit-mb",
+        type=int,
+        default=64,
+        help="Maximum file contents buffered in memory per extracting process",
+    )
     artifact_flatten_p.set_defaults(func=_do_artifact_flatten)
 
     args = p.parse_args(cl_args)
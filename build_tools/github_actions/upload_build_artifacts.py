@@ -48,7 +48,7 @@ def create_index_file(args: argparse.Namespace):
     build_dir = args.build_dir / "artifacts"
 
     indexer_args = argparse.Namespace()
-    indexer_args.filter = ["*.tar.xz*"]
+    indexer_args.filter = ["*.tar.xz*", "*.tar.zst*"]
     indexer_args.output_file = "index.html"
     indexer_args.verbose = False
     indexer_args.recursive = False
@@ -73,6 +73,10 @@ def upload_artifacts(args: argparse.Namespace, bucket_uri: str):
         "*",
         "--include",
         "*.tar.xz*",
+        "--include",
+        "*.tar.zst*",
+        "--include",
+        "artifact_graph_*.json",
     ]
     exec(cmd, cwd=Path.cwd())
 
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""Micro-benchmarks for the fileset and artifact utilities.
+
+These are not run as part of the test suite. They exist to sanity check the
+performance of hot paths in `_therock_utils` against synthetic inputs sized
+like real TheRock builds.
+
+Usage:
+  python build_tools/hack/fileset_benchmark.py match --paths 500000
+  python build_tools/hack/fileset_benchmark.py scan --latency-ms 2 --threads 16
+  python build_tools/hack/fileset_benchmark.py relpaths --roots 200
+"""
+
+import argparse
+import os
+from pathlib import Path
+import sys
+import tempfile
+import time
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from _therock_utils import pattern_match
+from _therock_utils.artifacts import RelpathIndex
+from _therock_utils.pattern_match import (
+    MatchPredicate,
+    PatternMatcher,
+    RecursiveGlobPattern,
+)
+
+# Mirrors the "lib" ComponentDefaults in fileset_tool.py after the
+# cross-exclude extension.
+LIB_INCLUDES = ["**/*.dll", "**/*.dylib", "**/*.dylib.*", "**/*.so", "**/*.so.*"]
+LIB_EXCLUDES = [
+    "**/*.a",
+    "**/*.lib",
+    "**/cmake/**",
+    "**/include/**",
+    "**/share/modulefiles/**",
+    "**/pkgconfig/**",
+    "**/share/doc/**",
+]
+
+
+def synthetic_relpaths(count: int) -> list[str]:
+    """Generates relpaths shaped roughly like an LLVM install tree."""
+    suffixes = [".h", ".so", ".so.7", ".a", ".cmake", ".py", "", ".txt"]
+    dirs = [
+        "bin",
+        "include/llvm/IR",
+        "lib",
+        "lib/cmake/llvm",
+        "lib/llvm/lib/clang/20/include",
+        "lib/pkgconfig",
+        "share/doc/llvm",
+    ]
+    paths = []
+    for i in range(count):
+        d = dirs[i % len(dirs)]
+        paths.append(f"{d}/sub{i % 97}/file{i}{suffixes[i % len(suffixes)]}")
+    return paths
+
+
+def _timeit(label: str, fn, count: int, unit: str = "paths"):
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    print(f"  {label:<12} {elapsed:8.3f}s  ({count / elapsed:,.0f} {unit}/s)")
+    return result
+
+
+def do_match(args: argparse.Namespace):
+    paths = synthetic_relpaths(args.paths)
+    includes = [RecursiveGlobPattern(p) for p in LIB_INCLUDES]
+    excludes = [RecursiveGlobPattern(p) for p in LIB_EXCLUDES]
+
+    def sequential():
+        matched = 0
+        for path in paths:
+            if not any(p.matches(path, None) for p in includes):
+                continue
+            if any(p.matches(path, None) for p in excludes):
+                continue
+            matched += 1
+        return matched
+
+    pred = MatchPredicate(LIB_INCLUDES, LIB_EXCLUDES)
+
+    def compiled():
+        return sum(1 for path in paths if pred.matches(path, None))
+
+    print(
+        f"Matching {len(paths)} paths against "
+        f"{len(LIB_INCLUDES) + len(LIB_EXCLUDES)} patterns:"
+    )
+    expected = _timeit("sequential", sequential, len(paths))
+    actual = _timeit("compiled", compiled, len(paths))
+    if expected != actual:
+        raise AssertionError(f"Mismatch: sequential={expected}, compiled={actual}")
+
+
+def synthetic_tree(root: Path, dirs: int, files_per_dir: int):
+    """Creates a tree of `dirs` directories nested up to 4 levels deep."""
+    for i in range(dirs):
+        d = root.joinpath(*[f"d{(i >> shift) % 8}" for shift in (0, 3, 6, 9)])
+        d.mkdir(parents=True, exist_ok=True)
+        for j in range(files_per_dir):
+            (d / f"file{j}.h").touch()
+
+
+def do_scan(args: argparse.Namespace):
+    real_scandir = os.scandir
+    latency = args.latency_ms / 1000.0
+
+    def slow_scandir(path):
+        # Simulates metadata round trip latency of a network file system.
+        time.sleep(latency)
+        return real_scandir(path)
+
+    with tempfile.TemporaryDirectory() as td:
+        root = Path(td)
+        synthetic_tree(root, args.dirs, args.files_per_dir)
+        results = {}
+        print(
+            f"Scanning synthetic tree ({args.dirs} dirs x {args.files_per_dir} "
+            f"files) with {args.latency_ms}ms simulated latency:"
+        )
+        with mock.patch.object(pattern_match.os, "scandir", slow_scandir):
+            for threads in [0, args.threads]:
+
+                def scan():
+                    pm = PatternMatcher(scan_threads=threads)
+                    pm.add_basedir(root)
+                    return list(pm.all)
+
+                label = f"threads={threads}" if threads > 1 else "sequential"
+                results[threads] = _timeit(label, scan, args.dirs, "dirs")
+        if results[0] != results[args.threads]:
+            raise AssertionError("Parallel scan differs from sequential scan")
+
+
+def do_relpaths(args: argparse.Namespace):
+    relpaths = [f"math-libs/lib{i}/stage" for i in range(args.roots)]
+    members = [
+        f"{relpaths[i % len(relpaths)]}/{path}"
+        for i, path in enumerate(synthetic_relpaths(args.members))
+    ]
+    output_path = Path("out")
+
+    def linear():
+        # The per-member relpath scan that ArtifactPopulator used to perform.
+        results = []
+        for member_name in members:
+            for prefix_relpath in relpaths:
+                dest_root = output_path / prefix_relpath
+                prefix_relpath += "/"
+                if member_name.startswith(prefix_relpath):
+                    results.append((dest_root, member_name[len(prefix_relpath) :]))
+                    break
+        return results
+
+    def indexed():
+        index = RelpathIndex(relpaths, output_path, flatten=False)
+        return [index.lookup(member_name) for member_name in members]
+
+    print(f"Resolving {len(members)} members against {len(relpaths)} relpaths:")
+    expected = _timeit("linear", linear, len(members), "members")
+    actual = _timeit("indexed", indexed, len(members), "members")
+    if expected != actual:
+        raise AssertionError("Indexed lookup differs from linear scan")
+
+
+def main(cl_args: list[str]):
+    p = argparse.ArgumentParser("fileset_benchmark.py")
+    sub_p = p.add_subparsers(required=True)
+
+    match_p = sub_p.add_parser("match", help="Benchmark MatchPredicate")
+    match_p.add_argument(
+        "--paths", type=int, default=500000, help="Number of synthetic paths"
+    )
+    match_p.set_defaults(func=do_match)
+
+    scan_p = sub_p.add_parser("scan", help="Benchmark PatternMatcher scanning")
+    scan_p.add_argument("--dirs", type=int, default=2000, help="Directory count")
+    scan_p.add_argument(
+        "--files-per-dir", type=int, default=10, help="Files per directory"
+    )
+    scan_p.add_argument(
+        "--latency-ms",
+        type=float,
+        default=2.0,
+        help="Simulated latency of each directory listing",
+    )
+    scan_p.add_argument(
+        "--threads", type=int, default=16, help="Parallel scan thread count"
+    )
+    scan_p.set_defaults(func=do_scan)
+
+    relpaths_p = sub_p.add_parser(
+        "relpaths", help="Benchmark archive member to relpath resolution"
+    )
+    relpaths_p.add_argument(
+        "--roots", type=int, default=200, help="Number of manifest relpaths"
+    )
+    relpaths_p.add_argument(
+        "--members", type=int, default=20000, help="Number of archive members"
+    )
+    relpaths_p.set_defaults(func=do_relpaths)
+
+    args = p.parse_args(cl_args)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -10,7 +10,7 @@ It installs TheRock to an output directory from one of these sources:
 Usage:
 python build_tools/install_rocm_from_artifacts.py [--output-dir OUTPUT_DIR] [--amdgpu-family AMDGPU_FAMILY] (--run-id RUN_ID | --release RELEASE | --input-dir INPUT_DIR)
                                         [--blas | --no-blas] [--fft | --no-fft] [--miopen | --no-miopen] [--prim | --no-prim]
-                                        [--rand | --no-rand] [--rccl | --no-rccl] [--tests | --no-tests] [--base-only]
+                                        [--rand | --no-rand] [--rccl | --no-rccl] [--tests | --no-tests] [--base-only] [--update]
 
 Examples:
 - Downloads and unpacks the gfx94X S3 artifacts from GitHub CI workflow run 14474448215 (from https://github.com/ROCm/TheRock/actions/runs/14474448215) to the default output directory `therock-build`:
@@ -25,17 +25,25 @@ You can select your AMD GPU family from this file https://github.com/ROCm/TheRoc
 By default for CI workflow retrieval, all artifacts (excluding test artifacts) will be downloaded. For specific artifacts, pass in the flag such as `--rand` (RAND artifacts) For test artifacts, pass in the flag `--tests` (test artifacts). For base artifacts only, pass in the flag `--base-only`
 
 Note: the script will overwrite the output directory argument. If no argument is passed, it will overwrite the default "therock-build" directory.
+For `--run-id` installs, pass `--update` to update an existing output directory in place instead (only files which changed are rewritten). Files from a previous installation which are not part of the new one are kept, so only use it to reinstall the same selection of artifacts.
 """
 
 import argparse
-import boto3
-from botocore import UNSIGNED
-from botocore.config import Config
 from fetch_artifacts import (
-    retrieve_base_artifacts,
-    retrieve_enabled_artifacts,
-    retrieve_s3_artifacts,
+    GENERIC_VARIANT,
+    add_download_cache_arguments,
+    add_listing_cache_arguments,
+    collect_selected_artifacts_download_requests,
+    configure_download_cache,
+    download_artifacts,
+    downloader,
+    listing_cache_path,
+    log_download_cache_stats,
+    open_artifact_stream,
+    retrieve_artifact_graph,
+    retrieve_s3_run_listing,
 )
+import functools
 import os
 from pathlib import Path
 import platform
@@ -44,14 +52,15 @@ import shutil
 import subprocess
 import sys
 import tarfile
-from _therock_utils.artifacts import ArtifactPopulator
+import time
+from _therock_utils.archive_util import (
+    COPY_BUFSIZE,
+    extract_tar_stream,
+    open_gzip_stream,
+)
+from _therock_utils.artifacts import ArtifactPopulator, ArtifactStream
 
 PLATFORM = platform.system().lower()
-s3_client = boto3.client(
-    "s3",
-    verify=False,
-    config=Config(max_pool_connections=100, signature_version=UNSIGNED),
-)
 
 
 def log(*args, **kwargs):
@@ -59,46 +68,101 @@ def log(*args, **kwargs):
     sys.stdout.flush()
 
 
-def _untar_files(output_dir, destination):
-    """
-    Retrieves all tar files in the output_dir, then extracts all files to the output_dir
-    """
-    log(f"Extracting {destination.name} to {str(output_dir)}")
-    with tarfile.open(destination) as extracted_tar_file:
-        extracted_tar_file.extractall(output_dir)
-    destination.unlink()
+class _TimedReader:
+    """Wraps a readable file object, recording the bytes read and time taken."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.bytes_read = 0
+        self.seconds = 0.0
+
+    def read(self, size: int = -1) -> bytes:
+        start = time.monotonic()
+        data = self.fileobj.read(size)
+        self.seconds += time.monotonic() - start
+        self.bytes_read += len(data)
+        return data
+
+
+def _update_output_directory(args) -> bool:
+    return args.update and args.run_id is not None
 
 
 def _create_output_directory(args):
     """
     If the output directory already exists, delete it and its contents.
     Then, create the output directory.
+
+    With `--update`, `--run-id` installs keep an existing output directory, which they
+    update in place.
     """
     output_dir_path = args.output_dir
-    log(f"Creating directory {output_dir_path}")
     if os.path.isdir(output_dir_path):
+        if _update_output_directory(args):
+            log(f"Updating existing directory {output_dir_path}")
+            return
         log(
             f"Directory {output_dir_path} already exists, removing existing directory and files"
         )
         shutil.rmtree(output_dir_path)
-    os.mkdir(output_dir_path)
+    log(f"Creating directory {output_dir_path}")
+    os.makedirs(output_dir_path)
     log(f"Created directory {output_dir_path}")
 
 
 def _retrieve_s3_release_assets(
-    release_bucket, amdgpu_family, release_version, output_dir
+    release_bucket, amdgpu_family, release_version, output_dir, stream=True
 ):
     """
-    Makes an API call to retrieve the release's assets, then retrieves the asset matching the amdgpu family
+    Retrieves the release's asset matching the amdgpu family and extracts it to output_dir
+
+    If stream, the asset is decompressed and extracted as it downloads, without writing it to disk.
     """
     asset_name = f"therock-dist-{PLATFORM}-{amdgpu_family}-{release_version}.tar.gz"
-    destination = output_dir / asset_name
-
-    with open(destination, "wb") as f:
-        s3_client.download_fileobj(release_bucket, asset_name, f)
-
-    # After downloading the asset, untar-ing the file
-    _untar_files(output_dir, destination)
+    start = time.monotonic()
+    if stream:
+        fileobj = downloader.open_stream(release_bucket, asset_name)
+        timings = [("open", time.monotonic() - start)]
+    else:
+        destination = output_dir / asset_name
+        downloader.download(release_bucket, asset_name, destination)
+        timings = [("download", time.monotonic() - start)]
+        fileobj = open(destination, "rb")
+
+    log(f"Extracting {asset_name} to {str(output_dir)}")
+    extract_start = time.monotonic()
+    compressed = _TimedReader(fileobj)
+    try:
+        with open_gzip_stream(compressed) as decompressed_stream:
+            decompressed = _TimedReader(decompressed_stream)
+            with tarfile.open(
+                fileobj=decompressed, mode="r|", bufsize=COPY_BUFSIZE
+            ) as tf:
+                file_count, byte_count = extract_tar_stream(tf, output_dir)
+        # Consume any trailing bytes, so that the stream is fully cached.
+        while compressed.read(COPY_BUFSIZE):
+            pass
+    finally:
+        fileobj.close()
+    if not stream:
+        destination.unlink()
+    extract_seconds = time.monotonic() - extract_start
+
+    # The compressed stream is read on a separate thread when decompressing
+    # with pigz, so its time overlaps the decompressed stream's.
+    timings.append(("download" if stream else "read archive", compressed.seconds))
+    timings.append(("read tar stream", decompressed.seconds))
+    timings.append(("extract", extract_seconds - decompressed.seconds))
+    timings.append(("total", time.monotonic() - start))
+    log(
+        f"Extracted {file_count} files ({byte_count / 1e6:.1f} MB) from "
+        f"{compressed.bytes_read / 1e6:.1f} MB compressed "
+        f"({decompressed.bytes_read / 1e6:.1f} MB tar stream)"
+    )
+    log(
+        "Phase timings: "
+        + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in timings)
+    )
 
 
 def retrieve_artifacts_by_run_id(args):
@@ -109,20 +173,54 @@ def retrieve_artifacts_by_run_id(args):
     output_dir = args.output_dir
     amdgpu_family = args.amdgpu_family
     log(f"Retrieving artifacts for run ID {run_id}")
-    s3_artifacts = retrieve_s3_artifacts(run_id, amdgpu_family)
+    listing = retrieve_s3_run_listing(
+        run_id, listing_cache_path(output_dir, run_id), args.listing_ttl
+    )
+    s3_artifacts = listing.registry([amdgpu_family, GENERIC_VARIANT])
+    configure_download_cache(args)
+
+    # Collecting base and all math-lib tar artifacts, with their dependencies
+    graph = retrieve_artifact_graph(run_id, amdgpu_family)
+    requests = collect_selected_artifacts_download_requests(
+        args, amdgpu_family, run_id, output_dir, s3_artifacts, graph
+    )
 
-    # Retrieving base and all math-lib tar artifacts and downloading them to output_dir
-    retrieve_base_artifacts(args, run_id, output_dir, s3_artifacts)
-    if not args.base_only:
-        retrieve_enabled_artifacts(
-            args, amdgpu_family, run_id, output_dir, s3_artifacts
+    # With --update, files already in an existing output directory (see
+    # _create_output_directory) are only rewritten if they changed.
+    update = _update_output_directory(args)
+    if args.stream:
+        # Each artifact is decompressed and extracted as it downloads, without
+        # writing the archive to disk.
+        log(f"Streaming artifacts for {run_id}")
+        flattener = ArtifactPopulator(
+            output_path=output_dir, flatten=True, update=update
+        )
+        flattener.populate_streams(
+            [
+                ArtifactStream(
+                    filename=request.output_path.name,
+                    open=functools.partial(open_artifact_stream, request),
+                )
+                for request in requests
+            ],
+            on_progress=lambda progress: log(f"++ {progress.summary()}"),
         )
+        log(f"Extracted {flattener.throughput_summary()}")
+        log_download_cache_stats()
+        log(f"Retrieved artifacts for run ID {run_id}")
+        return
+
+    download_artifacts(requests, listing)
+    log_download_cache_stats()
 
     # Flattening artifacts from .tar* files then removing .tar* files
     log(f"Untar-ing artifacts for {run_id}")
     tar_file_paths = list(output_dir.glob("*.tar.*"))
-    flattener = ArtifactPopulator(output_path=output_dir, verbose=True, flatten=True)
+    flattener = ArtifactPopulator(
+        output_path=output_dir, verbose=True, flatten=True, update=update
+    )
     flattener(*tar_file_paths)
+    log(f"Extracted {flattener.throughput_summary()}")
     for file_path in tar_file_paths:
         file_path.unlink()
 
@@ -160,9 +258,11 @@ def retrieve_artifacts_by_release(args):
     release_version = args.release
 
     log(f"Retrieving artifacts from release bucket {release_bucket}")
+    configure_download_cache(args)
     _retrieve_s3_release_assets(
-        release_bucket, amdgpu_family, release_version, output_dir
+        release_bucket, amdgpu_family, release_version, output_dir, args.stream
     )
+    log_download_cache_stats()
 
 
 def retrieve_artifacts_by_input_dir(args):
@@ -284,6 +384,20 @@ def main(argv):
         "--base-only", help="Include only base artifacts", action="store_true"
     )
 
+    artifacts_group.add_argument(
+        "--stream",
+        default=True,
+        help="Extract artifacts (or the release tarball) as they download, without writing archives to disk",
+        action=argparse.BooleanOptionalAction,
+    )
+    parser.add_argument(
+        "--update",
+        help="For --run-id installs, update an existing output directory in place rather than removing it first. Files which are not part of the new installation are kept",
+        action="store_true",
+    )
+    add_download_cache_arguments(parser)
+    add_listing_cache_arguments(parser)
+
     group.add_argument(
         "--input-dir",
         type=str,
@@ -0,0 +1,254 @@
+from pathlib import Path
+import gzip
+import io
+import os
+import platform
+import shutil
+import sys
+import tarfile
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.fspath(Path(__file__).parent.parent))
+
+from _therock_utils.archive_util import (
+    ArchiveWriter,
+    IndexedArchive,
+    extract_tar_stream,
+    open_archive,
+    open_gzip_stream,
+)
+
+
+def member_info(ti: tarfile.TarInfo) -> tuple:
+    return (
+        ti.name,
+        ti.type,
+        ti.mode,
+        ti.size,
+        int(ti.mtime),
+        ti.linkname,
+        ti.uid,
+        ti.gid,
+        ti.uname,
+        ti.gname,
+    )
+
+
+class ArchiveWriterTest(unittest.TestCase):
+    def setUp(self):
+        override_temp = os.getenv("TEST_TMPDIR")
+        if override_temp is not None:
+            self.temp_context = None
+            self.temp_dir = Path(override_temp)
+            self.temp_dir.mkdir(parents=True, exist_ok=True)
+        else:
+            self.temp_context = tempfile.TemporaryDirectory()
+            self.temp_dir = Path(self.temp_context.name)
+
+    def tearDown(self):
+        if self.temp_context:
+            self.temp_context.cleanup()
+
+    def testAddDirEntryMatchesTarfileAdd(self):
+        src_dir = self.temp_dir / "src"
+        (src_dir / "sub").mkdir(parents=True)
+        (src_dir / "sub" / "file.txt").write_text("Hello World!")
+        (src_dir / "empty").touch()
+        (src_dir / "link").symlink_to("sub/file.txt")
+        if platform.system() != "Windows":
+            os.chmod(src_dir / "empty", 0o755)
+        # Two paths to the same inode are stored as a tar hardlink.
+        os.link(src_dir / "sub" / "file.txt", src_dir / "hardlink.txt")
+        entries = []
+
+        def scan(d: str, prefix: str):
+            for entry in sorted(os.scandir(d), key=lambda e: e.name):
+                entries.append((f"{prefix}{entry.name}", entry))
+                if entry.is_dir(follow_symlinks=False):
+                    scan(entry.path, f"{prefix}{entry.name}/")
+
+        scan(src_dir, "")
+
+        expected_archive = self.temp_dir / "expected.tar.xz"
+        actual_archive = self.temp_dir / "actual.tar.xz"
+        with ArchiveWriter(expected_archive, compression_level=0) as writer:
+            for arcname, entry in entries:
+                writer.tar.add(entry.path, arcname=arcname, recursive=False)
+        with ArchiveWriter(actual_archive, compression_level=0) as writer:
+            for arcname, entry in entries:
+                writer.add_direntry(entry, arcname)
+
+        def read_members(archive: Path) -> list[tuple]:
+            members = []
+            with open_archive(archive) as tf:
+                for ti in tf:
+                    contents = tf.extractfile(ti).read() if ti.isfile() else None
+                    members.append((member_info(ti), contents))
+            return members
+
+        actual = read_members(actual_archive)
+        self.assertListEqual(actual, read_members(expected_archive))
+        self.assertIn(
+            tarfile.LNKTYPE, [info[1] for info, _ in actual], "Expected a hardlink"
+        )
+
+    def testMultipleXzBlocks(self):
+        contents = os.urandom(1 << 20) * 2
+        archive = self.temp_dir / "multi.tar.xz"
+        src = self.temp_dir / "big.bin"
+        src.write_bytes(contents)
+        # Preset 0 uses 768KiB blocks.
+        with ArchiveWriter(archive, compression_level=0, threads=3) as writer:
+            writer.tar.add(src, arcname="big.bin")
+        self.assertEqual(writer.uncompressed_bytes % tarfile.RECORDSIZE, 0)
+        self.assertEqual(writer.compressed_bytes, archive.stat().st_size)
+        with tarfile.open(archive, mode="r:xz") as tf:
+            self.assertEqual(tf.extractfile("big.bin").read(), contents)
+
+    def testIndexedArchive(self):
+        src_dir = self.temp_dir / "src"
+        src_dir.mkdir()
+        contents = {
+            "a.bin": os.urandom(1 << 20),
+            "b.txt": b"Hello World!",
+            "c.bin": os.urandom(1 << 20),
+            "d.txt": b"Goodbye!",
+        }
+        for name, data in contents.items():
+            (src_dir / name).write_bytes(data)
+        archive_path = self.temp_dir / "indexed.tar.xz"
+        with ArchiveWriter(archive_path, compression_level=0, index=True) as writer:
+            for name in contents:
+                writer.add_direntry(
+                    next(e for e in os.scandir(src_dir) if e.name == name), name
+                )
+
+        with IndexedArchive(archive_path) as archive:
+            self.assertGreater(archive.block_count, 2)
+            self.assertEqual(
+                archive.tar.extractfile(archive.getmember("d.txt")).read(), b"Goodbye!"
+            )
+            # Only the trailing block(s) holding d.txt were decompressed.
+            self.assertLess(archive.reader.blocks_decompressed, archive.block_count)
+            for name, data in contents.items():
+                member = archive.getmember(name)
+                self.assertEqual(archive.tar.extractfile(member).read(), data)
+            with self.assertRaises(KeyError):
+                archive.getmember("missing")
+        self.assertTrue(IndexedArchive.has_index(archive_path))
+
+        # An index which no longer matches its archive is not used.
+        archive_path.unlink()
+        with ArchiveWriter(archive_path, compression_level=0) as writer:
+            writer.add_direntry(
+                next(e for e in os.scandir(src_dir) if e.name == "b.txt"), "b.txt"
+            )
+        self.assertFalse(IndexedArchive.has_index(archive_path))
+        with self.assertRaisesRegex(IOError, "stale"):
+            IndexedArchive(archive_path)
+
+    def testIndexRequiresXz(self):
+        with self.assertRaises(ValueError):
+            ArchiveWriter(self.temp_dir / "a.tar.zst", compression_level=0, index=True)
+
+
+class TarballStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_context = tempfile.TemporaryDirectory()
+        self.temp_dir = Path(self.temp_context.name)
+
+    def tearDown(self):
+        self.temp_context.cleanup()
+
+    def make_tarball(self) -> tuple[bytes, dict[str, bytes]]:
+        contents = {
+            "dist/bin/tool": os.urandom(5000),
+            "dist/lib/small.txt": b"Hello World!",
+            "dist/lib/empty": b"",
+        }
+        tar_bytes = io.BytesIO()
+        with tarfile.open(fileobj=tar_bytes, mode="w") as tf:
+            for name, data in contents.items():
+                ti = tarfile.TarInfo(name)
+                ti.size = len(data)
+                ti.mode = 0o755 if name.endswith("tool") else 0o644
+                ti.mtime = 1000000000
+                tf.addfile(ti, io.BytesIO(data))
+            link = tarfile.TarInfo("dist/lib/link.txt")
+            link.type = tarfile.SYMTYPE
+            link.linkname = "small.txt"
+            tf.addfile(link)
+            hardlink = tarfile.TarInfo("dist/lib/hardlink.txt")
+            hardlink.type = tarfile.LNKTYPE
+            hardlink.linkname = "dist/lib/small.txt"
+            tf.addfile(hardlink)
+        return gzip.compress(tar_bytes.getvalue()), contents
+
+    def extract(self, compressed: bytes, output_dir: Path, **kwargs):
+        with open_gzip_stream(io.BytesIO(compressed), **kwargs) as reader:
+            with tarfile.open(fileobj=reader, mode="r|") as tf:
+                return extract_tar_stream(tf, output_dir, memory_limit=1024)
+
+    def testExtractTarStream(self):
+        compressed, contents = self.make_tarball()
+        output_dir = self.temp_dir / "out"
+        file_count, byte_count = self.extract(compressed, output_dir, use_pigz=False)
+        self.assertEqual(file_count, 3)
+        self.assertEqual(byte_count, sum(len(data) for data in contents.values()))
+        for name, data in contents.items():
+            self.assertEqual((output_dir / name).read_bytes(), data)
+        self.assertEqual(
+            int((output_dir / "dist/bin/tool").stat().st_mtime), 1000000000
+        )
+        self.assertEqual(os.readlink(output_dir / "dist/lib/link.txt"), "small.txt")
+        self.assertEqual(
+            (output_dir / "dist/lib/hardlink.txt").read_bytes(), b"Hello World!"
+        )
+        if platform.system() != "Windows":
+            self.assertTrue(os.access(output_dir / "dist/bin/tool", os.X_OK))
+
+    def testExtractReplacesExisting(self):
+        compressed, contents = self.make_tarball()
+        output_dir = self.temp_dir / "out"
+        # A directory (and a symlink) where the archive has files.
+        (output_dir / "dist" / "lib" / "small.txt" / "sub").mkdir(parents=True)
+        (output_dir / "dist" / "lib" / "small.txt" / "sub" / "old").touch()
+        (output_dir / "dist" / "lib" / "empty").symlink_to("small.txt")
+        self.extract(compressed, output_dir, use_pigz=False)
+        for name, data in contents.items():
+            self.assertEqual((output_dir / name).read_bytes(), data)
+
+    def testExtractRejectsOutsideOutput(self):
+        tar_bytes = io.BytesIO()
+        with tarfile.open(fileobj=tar_bytes, mode="w") as tf:
+            tf.addfile(tarfile.TarInfo("../escape"), io.BytesIO())
+        with self.assertRaises(tarfile.FilterError):
+            self.extract(
+                gzip.compress(tar_bytes.getvalue()),
+                self.temp_dir / "out",
+                use_pigz=False,
+            )
+
+    @unittest.skipUnless(
+        shutil.which("pigz") or shutil.which("gzip"), "requires pigz or gzip"
+    )
+    def testPigzPipe(self):
+        compressed, contents = self.make_tarball()
+        # gzip accepts the same arguments as pigz.
+        pigz = shutil.which("pigz") or shutil.which("gzip")
+        output_dir = self.temp_dir / "out"
+        with mock.patch("shutil.which", return_value=pigz):
+            self.extract(compressed, output_dir)
+        for name, data in contents.items():
+            self.assertEqual((output_dir / name).read_bytes(), data)
+
+        with mock.patch("shutil.which", return_value=pigz):
+            with self.assertRaisesRegex(IOError, "pigz failed"):
+                with open_gzip_stream(io.BytesIO(b"not gzip")) as reader:
+                    reader.read()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+from pathlib import Path
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.fspath(Path(__file__).parent.parent))
+
+from _therock_utils.artifact_graph import ArtifactGraph
+
+
+def make_graph(artifacts: dict[str, tuple[list[str], list[str]]]) -> ArtifactGraph:
+    return ArtifactGraph.from_json(
+        json.dumps(
+            {
+                "version": 1,
+                "artifacts": {
+                    name: {"components": components, "deps": deps}
+                    for name, (components, deps) in artifacts.items()
+                },
+            }
+        )
+    )
+
+
+class ArtifactGraphTest(unittest.TestCase):
+    def setUp(self):
+        self.graph = make_graph(
+            {
+                "base": (["lib", "run"], []),
+                "sysdeps": (["lib"], []),
+                "core-hip": (["lib", "dev"], ["base", "sysdeps"]),
+                "rand": (["lib", "test"], ["core-hip"]),
+                "blas": (["lib", "test"], ["core-hip"]),
+                "miopen": (["lib", "test"], ["blas", "rand"]),
+                "docs-only": (["doc"], ["base"]),
+            }
+        )
+
+    def testTransitiveDeps(self):
+        self.assertEqual(
+            self.graph.transitive_deps("miopen"),
+            ["base", "sysdeps", "core-hip", "blas", "rand"],
+        )
+        self.assertEqual(self.graph.transitive_deps("base"), [])
+
+    def testClosure(self):
+        self.assertEqual(
+            self.graph.closure(["blas_test"]),
+            ["base_lib", "sysdeps_lib", "core-hip_lib", "blas_lib", "blas_test"],
+        )
+        # Only the lib components of dependencies are needed.
+        self.assertEqual(
+            self.graph.closure(["miopen_lib", "core-hip_dev"]),
+            [
+                "base_lib",
+                "sysdeps_lib",
+                "core-hip_dev",
+                "core-hip_lib",
+                "blas_lib",
+                "rand_lib",
+                "miopen_lib",
+            ],
+        )
+        # Unknown artifacts and components are skipped.
+        self.assertEqual(
+            self.graph.closure(["rccl_lib", "rand_dbg", "docs-only_doc"]),
+            ["base_lib", "docs-only_doc"],
+        )
+
+    def testVersion(self):
+        with self.assertRaises(IOError):
+            ArtifactGraph.from_json(json.dumps({"version": 0, "artifacts": {}}))
+
+
+if __name__ == "__main__":
+    unittest.main()
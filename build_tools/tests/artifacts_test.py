@@ -1,12 +1,24 @@
 from pathlib import Path
+import io
 import os
+import subprocess
 import tempfile
 import unittest
+from unittest import mock
 import sys
 
 sys.path.insert(0, os.fspath(Path(__file__).parent.parent))
 
-from _therock_utils.artifacts import ArtifactName
+from _therock_utils.archive_util import ArchiveWriter
+from _therock_utils.artifacts import (
+    ArtifactCatalog,
+    ArtifactName,
+    ArtifactPopulator,
+    ArtifactRegistry,
+    ArtifactStream,
+    RelpathIndex,
+)
+from _therock_utils.pattern_match import PatternMatcher
 
 
 class ArtifactNameTest(unittest.TestCase):
@@ -46,6 +58,11 @@ class ArtifactNameTest(unittest.TestCase):
         self.assertEqual(an1.component, "component")
         self.assertEqual(an1.target_family, "generic")
 
+        f2 = "name_component_gfx110X-dgpu.tar.zst"
+        an2 = ArtifactName.from_filename(f2)
+        self.assertEqual(an2.name, "name")
+        self.assertEqual(an2.target_family, "gfx110X-dgpu")
+
         f_invalid1 = "invalid_name.zip"
         an_invalid1 = ArtifactName.from_filename(f_invalid1)
         self.assertIsNone(an_invalid1)
@@ -58,5 +75,312 @@ class ArtifactNameTest(unittest.TestCase):
         self.assertIsNone(an_invalid2)
 
 
+class ArtifactPopulatorTest(unittest.TestCase):
+    def setUp(self):
+        override_temp = os.getenv("TEST_TMPDIR")
+        if override_temp is not None:
+            self.temp_context = None
+            self.temp_dir = Path(override_temp)
+            self.temp_dir.mkdir(parents=True, exist_ok=True)
+        else:
+            self.temp_context = tempfile.TemporaryDirectory()
+            self.temp_dir = Path(self.temp_context.name)
+
+    def tearDown(self):
+        if self.temp_context:
+            self.temp_context.cleanup()
+
+    def make_archive(self, name: str, files: dict[str, str]) -> Path:
+        archive_path = self.temp_dir / f"{name}.tar.xz"
+        src_dir = self.temp_dir / "src" / name
+        (src_dir / "stage").mkdir(parents=True)
+        (src_dir / "artifact_manifest.txt").write_text("stage\n")
+        with ArchiveWriter(archive_path, compression_level=0) as writer:
+            writer.tar.add(
+                src_dir / "artifact_manifest.txt", arcname="artifact_manifest.txt"
+            )
+            for relpath, text in files.items():
+                file_path = src_dir / "stage" / relpath
+                file_path.parent.mkdir(parents=True, exist_ok=True)
+                file_path.write_text(text)
+                writer.tar.add(file_path, arcname=f"stage/{relpath}")
+        return archive_path
+
+    @unittest.skipIf(sys.platform == "win32", "Requires the resource module")
+    def testBoundedMemory(self):
+        huge_size = 128 << 20
+        src_dir = self.temp_dir / "src"
+        (src_dir / "stage").mkdir(parents=True)
+        (src_dir / "artifact_manifest.txt").write_text("stage\n")
+        with open(src_dir / "stage" / "huge.bin", "wb") as f:
+            f.truncate(huge_size)
+        archive_path = self.temp_dir / "huge_lib_generic.tar.xz"
+        with ArchiveWriter(archive_path, compression_level=0) as writer:
+            writer.tar.add(
+                src_dir / "artifact_manifest.txt", arcname="artifact_manifest.txt"
+            )
+            writer.tar.add(src_dir / "stage" / "huge.bin", arcname="stage/huge.bin")
+
+        # Measure the peak RSS growth of extraction in a fresh process.
+        output_path = self.temp_dir / "output"
+        script = f"""
+import resource, sys
+from pathlib import Path
+sys.path.insert(0, {os.fspath(Path(__file__).parent.parent)!r})
+from _therock_utils.artifacts import ArtifactPopulator
+populator = ArtifactPopulator(output_path=Path({os.fspath(output_path)!r}), jobs=1)
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+populator(Path({os.fspath(archive_path)!r}))
+after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+scale = 1 if sys.platform == "darwin" else 1024
+print((after - before) * scale)
+"""
+        rss_growth = int(subprocess.check_output([sys.executable, "-c", script]))
+        self.assertEqual((output_path / "stage" / "huge.bin").stat().st_size, huge_size)
+        self.assertLess(rss_growth, 32 << 20)
+
+    def testParallelMatchesSequential(self):
+        archives = [
+            self.make_archive("a_lib_generic", {"lib/a.so": "a", "share/x.txt": "a"}),
+            self.make_archive("b_lib_generic", {"lib/b.so": "b", "share/x.txt": "b"}),
+            self.make_archive("c_lib_generic", {"bin/c": "c", "share/x.txt": "c"}),
+        ]
+
+        def populate(jobs: int) -> dict[str, str]:
+            output_path = self.temp_dir / f"output_{jobs}"
+            populator = ArtifactPopulator(
+                output_path=output_path, flatten=True, jobs=jobs
+            )
+            populator(*archives)
+            self.assertEqual(populator.extracted_files, 6)
+            self.assertEqual(populator.relpaths, {"stage"})
+            return {
+                p.relative_to(output_path).as_posix(): p.read_text()
+                for p in output_path.rglob("*")
+                if p.is_file()
+            }
+
+        sequential = populate(1)
+        # Overlapping files are resolved in favor of the last artifact.
+        self.assertEqual(sequential["share/x.txt"], "c")
+        self.assertDictEqual(populate(3), sequential)
+
+    def testUpdate(self):
+        archives = [
+            self.make_archive("a_lib_generic", {"lib/a.so": "a", "share/x.txt": "aa"}),
+            self.make_archive("b_lib_generic", {"lib/b.so": "b", "share/x.txt": "b"}),
+        ]
+        for jobs in [1, 2]:
+            with self.subTest(jobs=jobs):
+                output_path = self.temp_dir / f"output_{jobs}"
+                ArtifactPopulator(output_path=output_path, flatten=True, jobs=jobs)(
+                    *archives
+                )
+                (output_path / "lib" / "a.so").write_text("modified")
+                b_inode = (output_path / "lib" / "b.so").stat().st_ino
+
+                populator = ArtifactPopulator(
+                    output_path=output_path, flatten=True, jobs=jobs, update=True
+                )
+                populator(*archives)
+                self.assertEqual((output_path / "lib" / "a.so").read_text(), "a")
+                self.assertEqual((output_path / "share" / "x.txt").read_text(), "b")
+                self.assertEqual((output_path / "lib" / "b.so").stat().st_ino, b_inode)
+                # Sequentially, a's share/x.txt replaces b's before b rewrites
+                # it. In parallel, b's unchanged version is kept in place.
+                self.assertEqual(populator.unchanged_files, jobs)
+
+    def testPopulateStreams(self):
+        archives = [
+            self.make_archive("a_lib_generic", {"lib/a.so": "a", "share/x.txt": "a"}),
+            self.make_archive("b_lib_generic", {"lib/b.so": "b", "share/x.txt": "b"}),
+            self.make_archive("c_lib_generic", {"bin/c": "c", "share/x.txt": "c"}),
+        ]
+        output_path = self.temp_dir / "output"
+        populator = ArtifactPopulator(output_path=output_path, flatten=True)
+        reports = []
+        progress = populator.populate_streams(
+            [
+                ArtifactStream(
+                    filename=archive.name,
+                    open=lambda archive=archive: io.BytesIO(archive.read_bytes()),
+                )
+                for archive in archives
+            ],
+            max_streams=2,
+            on_progress=reports.append,
+        )
+        self.assertEqual(populator.extracted_files, 6)
+        self.assertEqual(populator.relpaths, {"stage"})
+        self.assertEqual(
+            {
+                p.relative_to(output_path).as_posix(): p.read_text()
+                for p in output_path.rglob("*")
+                if p.is_file()
+            },
+            {"lib/a.so": "a", "lib/b.so": "b", "bin/c": "c", "share/x.txt": "c"},
+        )
+        self.assertEqual(reports, [progress])
+        self.assertEqual(progress.artifacts_done, 3)
+        self.assertEqual(progress.extracted_files, 6)
+        self.assertGreater(progress.decompressed_bytes, progress.downloaded_bytes)
+
+    def testPopulateStreamsFailure(self):
+        archive = self.make_archive("a_lib_generic", {"lib/a.so": "a"})
+        truncated = archive.read_bytes()[:100]
+        output_path = self.temp_dir / "output"
+        populator = ArtifactPopulator(output_path=output_path, flatten=True)
+        with self.assertRaises(Exception):
+            populator.populate_streams(
+                [
+                    ArtifactStream(archive.name, lambda: io.BytesIO(truncated)),
+                    ArtifactStream(archive.name, lambda: io.BytesIO(truncated)),
+                ]
+            )
+        # Staging directories are cleaned up.
+        self.assertEqual(list(output_path.glob(".populate-*")), [])
+
+
+class ArtifactCatalogTest(unittest.TestCase):
+    def setUp(self):
+        override_temp = os.getenv("TEST_TMPDIR")
+        if override_temp is not None:
+            self.temp_context = None
+            self.temp_dir = Path(override_temp)
+            self.temp_dir.mkdir(parents=True, exist_ok=True)
+        else:
+            self.temp_context = tempfile.TemporaryDirectory()
+            self.temp_dir = Path(self.temp_context.name)
+
+    def tearDown(self):
+        if self.temp_context:
+            self.temp_context.cleanup()
+
+    def testProjectionsShareScans(self):
+        for name in ["blas_lib_gfx110X", "blas_lib_gfx94X", "core_lib_generic"]:
+            artifact_dir = self.temp_dir / name
+            (artifact_dir / "stage" / "lib" / "cmake").mkdir(parents=True)
+            (artifact_dir / "artifact_manifest.txt").write_text("stage\n")
+            (artifact_dir / "stage" / "lib" / f"lib{name}.so").touch()
+            (artifact_dir / "stage" / "lib" / "cmake" / "config.cmake").touch()
+
+        def is_generic(an: ArtifactName) -> bool:
+            return an.target_family == "generic"
+
+        def is_gfx94X(an: ArtifactName) -> bool:
+            return an.target_family == "gfx94X"
+
+        def matches(catalog: ArtifactCatalog) -> list[str]:
+            return sorted(relpath for relpath, _ in catalog.pm.matches())
+
+        with mock.patch.object(
+            PatternMatcher,
+            "add_basedir",
+            autospec=True,
+            side_effect=PatternMatcher.add_basedir,
+        ) as add_basedir:
+            catalog = ArtifactCatalog(self.temp_dir)
+            self.assertEqual(catalog.all_target_families, {"gfx110X", "gfx94X"})
+            self.assertEqual(add_basedir.call_count, 0)
+            generic = catalog.project(is_generic, excludes=["**/cmake/**"])
+            gfx94X = catalog.project(is_gfx94X)
+            self.assertEqual(matches(generic), ["lib", "lib/libcore_lib_generic.so"])
+            self.assertEqual(
+                matches(gfx94X),
+                [
+                    "lib",
+                    "lib/cmake",
+                    "lib/cmake/config.cmake",
+                    "lib/libblas_lib_gfx94X.so",
+                ],
+            )
+            matches(catalog)
+            self.assertEqual(add_basedir.call_count, 3)
+
+        # Projections match freshly scanned catalogs.
+        self.assertEqual(
+            matches(generic),
+            matches(
+                ArtifactCatalog(self.temp_dir, is_generic, excludes=["**/cmake/**"])
+            ),
+        )
+        self.assertEqual(
+            matches(gfx94X), matches(ArtifactCatalog(self.temp_dir, is_gfx94X))
+        )
+
+
+class ArtifactRegistryTest(unittest.TestCase):
+    def testQuery(self):
+        registry = ArtifactRegistry.from_filenames(
+            [
+                "blas_lib_gfx94X.tar.xz",
+                "blas_test_gfx94X.tar.xz",
+                "blas_lib_gfx110X.tar.zst",
+                "core-hip_lib_generic.tar.xz",
+                "core-hip_dev_generic.tar.xz",
+                "blas_lib_gfx94X.tar.xz.sha256sum",
+                "invalid.tar.xz",
+            ]
+        )
+        self.assertEqual(len(registry), 5)
+        self.assertEqual(registry.target_families, {"gfx94X", "gfx110X", "generic"})
+        lib_gfx94X = registry.query(
+            components=["lib"], target_families=["gfx94X", "generic"]
+        )
+        self.assertEqual(
+            lib_gfx94X,
+            {
+                ArtifactName("blas", "lib", "gfx94X"),
+                ArtifactName("core-hip", "lib", "generic"),
+            },
+        )
+        self.assertEqual(
+            registry.filename(ArtifactName("blas", "lib", "gfx110X")),
+            "blas_lib_gfx110X.tar.zst",
+        )
+        self.assertEqual(registry.query(names=["missing"]), set())
+        self.assertEqual(registry.query(), set(registry))
+        # Iteration is in file name order.
+        self.assertEqual(
+            [registry.filename(an) for an in registry][:2],
+            ["blas_lib_gfx110X.tar.zst", "blas_lib_gfx94X.tar.xz"],
+        )
+
+    def testFromDir(self):
+        with tempfile.TemporaryDirectory() as td:
+            artifact_dir = Path(td)
+            (artifact_dir / "blas_lib_gfx94X").mkdir()
+            (artifact_dir / "blas_lib_gfx94X.tar.xz").touch()
+            (artifact_dir / "base_lib_generic.tar.xz").touch()
+            (artifact_dir / "README.md").touch()
+            registry = ArtifactRegistry.from_dir(artifact_dir)
+            self.assertEqual(
+                registry.filename(ArtifactName("blas", "lib", "gfx94X")),
+                "blas_lib_gfx94X",
+            )
+            self.assertEqual(len(registry), 2)
+            dirs_only = ArtifactRegistry.from_dir(artifact_dir, include_archives=False)
+            self.assertEqual(set(dirs_only), {ArtifactName("blas", "lib", "gfx94X")})
+
+
+class RelpathIndexTest(unittest.TestCase):
+    def testLookup(self):
+        out = Path("out")
+        index = RelpathIndex(["a/stage", "", "b/stage", "a"], out, flatten=False)
+        self.assertEqual(
+            index.lookup("a/stage/lib/x.so"), (out / "a/stage", "lib/x.so")
+        )
+        self.assertEqual(index.lookup("b/stage/bin/y"), (out / "b/stage", "bin/y"))
+        # Nested relpaths resolve to the first in manifest order.
+        self.assertEqual(index.lookup("a/other/z"), (out / "a", "other/z"))
+        self.assertIsNone(index.lookup("b/other/z"))
+        self.assertIsNone(index.lookup("top_level_file"))
+
+    def testLookupFlatten(self):
+        out = Path("out")
+        index = RelpathIndex(["a/stage", "b/stage"], out, flatten=True)
+        self.assertEqual(index.lookup("b/stage/bin/y"), (out, "bin/y"))
+
+
 if __name__ == "__main__":
     unittest.main()
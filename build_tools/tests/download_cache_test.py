@@ -0,0 +1,87 @@
+from pathlib import Path
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.fspath(Path(__file__).parent.parent))
+
+from _therock_utils.download_cache import DownloadCache
+
+
+class DownloadCacheTest(unittest.TestCase):
+    def setUp(self):
+        override_temp = os.getenv("TEST_TMPDIR")
+        if override_temp is not None:
+            self.temp_context = None
+            self.temp_dir = Path(override_temp)
+            self.temp_dir.mkdir(parents=True, exist_ok=True)
+        else:
+            self.temp_context = tempfile.TemporaryDirectory()
+            self.temp_dir = Path(self.temp_context.name)
+
+    def tearDown(self):
+        if self.temp_context:
+            self.temp_context.cleanup()
+
+    def testAddAndLink(self):
+        cache = DownloadCache(self.temp_dir / "cache")
+        src = self.temp_dir / "src.tar.xz"
+        src.write_bytes(b"contents")
+        dest = self.temp_dir / "dest.tar.xz"
+
+        self.assertFalse(cache.link_to("key@1", dest))
+        cache.add(src, "key@1")
+        self.assertTrue(cache.link_to("key@1", dest))
+        self.assertEqual(dest.read_bytes(), b"contents")
+        # A different ETag is a different entry.
+        self.assertFalse(cache.link_to("key@2", dest))
+        self.assertEqual((cache.hits, cache.misses, cache.hit_bytes), (1, 2, 8))
+
+    def testAddedFileStaysWritable(self):
+        cache = DownloadCache(self.temp_dir / "cache")
+        src = self.temp_dir / "src.tar.xz"
+        src.write_bytes(b"contents")
+        cache.add(src, "key@1")
+
+        # The added file is not shared with the (read-only) cache entry.
+        with open(src, "ab") as f:
+            f.write(b" modified")
+        src.unlink()
+        self.assertEqual(cache.get("key@1").read_bytes(), b"contents")
+
+    def testWriter(self):
+        cache = DownloadCache(self.temp_dir / "cache")
+        writer = cache.open_writer("aborted")
+        writer.write(b"partial")
+        writer.abort()
+        self.assertIsNone(cache.get("aborted"))
+
+        writer = cache.open_writer("committed")
+        writer.write(b"all")
+        writer.commit()
+        self.assertEqual(cache.get("committed").read_bytes(), b"all")
+        self.assertEqual(
+            [p.name for p in cache.root.rglob("*") if p.name.endswith(".tmp")], []
+        )
+
+    def testEvictsLeastRecentlyUsed(self):
+        cache = DownloadCache(self.temp_dir / "cache", max_bytes=250)
+        src = self.temp_dir / "src"
+        for i, name in enumerate(["a", "b"]):
+            src.write_bytes(b"x" * 100)
+            cache.add(src, name)
+            src.unlink()
+            os.utime(cache.entry_path(name), (1000 + i, 1000 + i))
+        # Using "a" makes "b" the least recently used.
+        self.assertIsNotNone(cache.get("a"))
+        src.write_bytes(b"x" * 100)
+        cache.add(src, "c")
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("c"))
+        self.assertEqual(cache.evictions, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
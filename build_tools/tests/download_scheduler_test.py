@@ -0,0 +1,125 @@
+from pathlib import Path
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.fspath(Path(__file__).parent.parent))
+
+from _therock_utils.download_scheduler import (
+    DownloadScheduler,
+    ScheduledDownload,
+    download_timeout,
+)
+
+
+class DownloadSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_context = tempfile.TemporaryDirectory()
+        self.temp_dir = Path(self.temp_context.name)
+        self.lock = threading.Lock()
+        self.started: list[str] = []
+        self.in_flight_bytes = 0
+        self.max_in_flight_bytes = 0
+        self.cancelled: list[str] = []
+
+    def tearDown(self):
+        self.temp_context.cleanup()
+
+    def make_download(self, name: str, size: int, seconds: float = 0.01):
+        def download(cancel: threading.Event):
+            with self.lock:
+                self.started.append(name)
+                self.in_flight_bytes += size
+                self.max_in_flight_bytes = max(
+                    self.max_in_flight_bytes, self.in_flight_bytes
+                )
+            cancelled = cancel.wait(seconds)
+            with self.lock:
+                self.in_flight_bytes -= size
+                if cancelled:
+                    self.cancelled.append(name)
+
+        return ScheduledDownload(name, size, download)
+
+    def testLargestFirst(self):
+        scheduler = DownloadScheduler(self.temp_dir, max_workers=1, log=lambda _: None)
+        scheduler.run(
+            [
+                self.make_download("small", 10),
+                self.make_download("large", 1000),
+                self.make_download("medium", 100),
+            ]
+        )
+        self.assertEqual(self.started, ["large", "medium", "small"])
+        self.assertEqual([m.name for m in scheduler.metrics], self.started)
+        self.assertIn("3 downloads, 0.0 MB", scheduler.summary())
+
+    def testMaxInFlightBytes(self):
+        scheduler = DownloadScheduler(
+            self.temp_dir, max_in_flight_bytes=100, log=lambda _: None
+        )
+        scheduler.run(
+            [self.make_download(f"d{i}", 40) for i in range(6)]
+            # Larger than the limit, so started on its own.
+            + [self.make_download("huge", 500)]
+        )
+        self.assertEqual(self.started[0], "huge")
+        self.assertEqual(len(scheduler.metrics), 7)
+        self.assertEqual(self.max_in_flight_bytes, 500)
+
+        self.started.clear()
+        self.max_in_flight_bytes = 0
+        scheduler.run([self.make_download(f"d{i}", 40) for i in range(6)])
+        self.assertEqual(self.max_in_flight_bytes, 80)
+
+    def testNotEnoughDiskSpace(self):
+        scheduler = DownloadScheduler(self.temp_dir, log=lambda _: None)
+        with mock.patch.object(scheduler, "free_bytes", return_value=100):
+            with self.assertRaisesRegex(IOError, "Not enough disk space"):
+                scheduler.run(
+                    [self.make_download("small", 10), self.make_download("large", 200)]
+                )
+        self.assertEqual(self.started, [])
+
+    def testDiskSpaceCountsInFlight(self):
+        scheduler = DownloadScheduler(self.temp_dir, log=lambda _: None)
+        # Free space does not shrink as downloads start, as happens before
+        # they preallocate.
+        with mock.patch.object(scheduler, "free_bytes", return_value=90):
+            scheduler.run([self.make_download(f"d{i}", 40, 0.05) for i in range(4)])
+        self.assertEqual(len(scheduler.metrics), 4)
+        self.assertEqual(self.max_in_flight_bytes, 80)
+
+    def testTimeout(self):
+        self.assertEqual(
+            download_timeout(10 << 20, min_timeout=60, min_bytes_per_second=1 << 20),
+            70,
+        )
+        scheduler = DownloadScheduler(
+            self.temp_dir, min_timeout=0.05, log=lambda _: None
+        )
+        start = time.monotonic()
+        with self.assertRaisesRegex(TimeoutError, "Downloading slow"):
+            scheduler.run(
+                [self.make_download("fast", 1), self.make_download("slow", 2, 10.0)]
+            )
+        # The slow download was stopped, rather than left running.
+        self.assertLess(time.monotonic() - start, 5.0)
+        self.assertEqual(self.cancelled, ["slow"])
+        self.assertEqual(self.in_flight_bytes, 0)
+
+    def testError(self):
+        def fail(cancel: threading.Event):
+            raise IOError("Connection reset")
+
+        scheduler = DownloadScheduler(self.temp_dir, log=lambda _: None)
+        with self.assertRaisesRegex(IOError, "Connection reset"):
+            scheduler.run([ScheduledDownload("failing", 1, fail)])
+
+
+if __name__ == "__main__":
+    unittest.main()
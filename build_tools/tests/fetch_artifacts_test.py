@@ -1,5 +1,7 @@
 from botocore.exceptions import ClientError
+import argparse
 from pathlib import Path
+import io
 import os
 import sys
 import unittest
@@ -7,7 +9,15 @@ from unittest.mock import patch
 
 sys.path.insert(0, os.fspath(Path(__file__).parent.parent))
 
+from _therock_utils.artifact_graph import ArtifactGraph
+from _therock_utils.artifacts import ArtifactRegistry
+from _therock_utils.s3_listing import ListedObject, RunListing
 from fetch_artifacts import (
+    ArtifactDownloadRequest,
+    artifact_download_size,
+    collect_artifacts_download_requests,
+    collect_selected_artifacts_download_requests,
+    retrieve_published_sha256,
     retrieve_s3_artifacts,
 )
 
@@ -21,22 +31,30 @@ class ArtifactsIndexPageTest(unittest.TestCase):
         mock_paginator.paginate.return_value = [
             {
                 "Contents": [
-                    {"Key": "hello/empty_1test.tar.xz"},
-                    {"Key": "hello/empty_2test.tar.xz"},
+                    {"Key": "hello/empty_lib_test.tar.xz"},
+                    {"Key": "hello/empty_dev_test.tar.zst"},
                 ]
             },
-            {"Contents": [{"Key": "test/empty_3generic.tar.xz"}]},
-            {"Contents": [{"Key": "test/empty_3test.tar.xz.sha256sum"}]},
-            {"Contents": [{"Key": "rocm-libraries/test/empty_4test.tar.xz"}]},
+            {"Contents": [{"Key": "test/empty_lib_generic.tar.xz"}]},
+            {"Contents": [{"Key": "test/empty_lib_test.tar.xz.sha256sum"}]},
+            {"Contents": [{"Key": "test/empty_lib_test.tar.xz.index"}]},
+            {"Contents": [{"Key": "rocm-libraries/test/other_lib_test.tar.xz"}]},
+            # Only exact target family matches are included.
+            {"Contents": [{"Key": "test/empty_lib_test-dcgpu.tar.xz"}]},
+            {"Contents": [{"Key": "test/index-test.html"}]},
         ]
 
         result = retrieve_s3_artifacts("123", "test")
 
-        self.assertEqual(len(result), 4)
-        self.assertTrue("empty_1test.tar.xz" in result)
-        self.assertTrue("empty_2test.tar.xz" in result)
-        self.assertTrue("empty_3generic.tar.xz" in result)
-        self.assertTrue("empty_4test.tar.xz" in result)
+        self.assertEqual(
+            result,
+            {
+                "empty_lib_test.tar.xz",
+                "empty_dev_test.tar.zst",
+                "empty_lib_generic.tar.xz",
+                "other_lib_test.tar.xz",
+            },
+        )
 
     @patch("fetch_artifacts.paginator")
     def testRetrieveS3ArtifactsNotFound(self, mock_paginator):
@@ -52,6 +70,159 @@ class ArtifactsIndexPageTest(unittest.TestCase):
 
         self.assertEqual(context.exception.response["Error"]["Code"], "AccessDenied")
 
+    @patch("fetch_artifacts.retrieve_bucket_info", return_value=("", "bucket"))
+    def testCollectArtifactsDownloadRequests(self, _):
+        registry = ArtifactRegistry.from_filenames(
+            [
+                "blas_lib_gfx94X.tar.xz",
+                "blas_lib_gfx110X.tar.xz",
+                "fft_lib_gfx94X.tar.zst",
+                "rand_test_gfx94X.tar.xz",
+            ]
+        )
+        requests = collect_artifacts_download_requests(
+            ["blas_lib", "fft_lib", "rand_lib"], "123", Path("out"), "gfx94X", registry
+        )
+        self.assertEqual(
+            [r.output_path for r in requests],
+            [Path("out/blas_lib_gfx94X.tar.xz"), Path("out/fft_lib_gfx94X.tar.zst")],
+        )
+        self.assertTrue(requests[0].artifact_key.endswith("/blas_lib_gfx94X.tar.xz"))
+
+    @patch("fetch_artifacts.retrieve_bucket_info", return_value=("", "bucket"))
+    def testCollectSelectedArtifactsFromGraph(self, _):
+        graph = ArtifactGraph(
+            components={
+                "base": ["lib"],
+                "core-hip": ["lib", "dev"],
+                "blas": ["lib", "test"],
+                "rand": ["lib", "test"],
+                "miopen": ["lib", "test"],
+                # A base artifact which nothing selected depends on.
+                "amd-llvm": ["lib", "run"],
+            },
+            deps={
+                "amd-llvm": [],
+                "base": [],
+                "core-hip": ["base"],
+                "blas": ["core-hip"],
+                "rand": ["core-hip"],
+                "miopen": ["blas", "rand"],
+            },
+        )
+        registry = ArtifactRegistry.from_filenames(
+            [
+                "amd-llvm_lib_generic.tar.xz",
+                "amd-llvm_run_generic.tar.xz",
+                # A base artifact missing from the graph.
+                "sysdeps_lib_generic.tar.xz",
+                "base_lib_generic.tar.xz",
+                "core-hip_lib_generic.tar.xz",
+                "core-hip_dev_generic.tar.xz",
+                "blas_lib_gfx94X.tar.xz",
+                "blas_test_gfx94X.tar.xz",
+                "rand_lib_gfx94X.tar.xz",
+                "rand_test_gfx94X.tar.xz",
+                "miopen_lib_gfx94X.tar.xz",
+                "miopen_test_gfx94X.tar.xz",
+            ]
+        )
+        args = argparse.Namespace(
+            blas=False,
+            fft=False,
+            miopen=True,
+            prim=False,
+            rand=False,
+            rccl=False,
+            tests=True,
+            base_only=False,
+        )
+        requests = collect_selected_artifacts_download_requests(
+            args, "gfx94X", "123", Path("out"), registry, graph
+        )
+        # All base artifacts and the miopen libraries' dependencies are
+        # included, but not the dependencies' tests.
+        base_artifacts = [
+            "amd-llvm_lib_generic.tar.xz",
+            "amd-llvm_run_generic.tar.xz",
+            "base_lib_generic.tar.xz",
+            "core-hip_dev_generic.tar.xz",
+            "core-hip_lib_generic.tar.xz",
+        ]
+        self.assertEqual(
+            [r.output_path.name for r in requests],
+            base_artifacts
+            + [
+                "blas_lib_gfx94X.tar.xz",
+                "rand_lib_gfx94X.tar.xz",
+                "miopen_lib_gfx94X.tar.xz",
+                "miopen_test_gfx94X.tar.xz",
+                "sysdeps_lib_generic.tar.xz",
+            ],
+        )
+
+        # --base-only fetches the same base artifacts as without a graph.
+        args.base_only = True
+        requests = collect_selected_artifacts_download_requests(
+            args, "gfx94X", "123", Path("out"), registry, graph
+        )
+        self.assertEqual(
+            sorted(r.output_path.name for r in requests),
+            sorted(base_artifacts + ["sysdeps_lib_generic.tar.xz"]),
+        )
+        self.assertEqual(
+            sorted(r.output_path.name for r in requests),
+            sorted(
+                r.output_path.name
+                for r in collect_selected_artifacts_download_requests(
+                    args, "gfx94X", "123", Path("out"), registry, None
+                )
+            ),
+        )
+
+    @patch("fetch_artifacts.s3_client")
+    def testRetrievePublishedSha256(self, mock_s3_client):
+        request = ArtifactDownloadRequest(
+            "run/blas_lib_gfx94X.tar.xz", "bucket", Path("out")
+        )
+        mock_s3_client.get_object.return_value = {
+            "Body": io.BytesIO(b"ABCDEF0123\n"),
+        }
+        self.assertEqual(retrieve_published_sha256(request), "abcdef0123")
+        mock_s3_client.get_object.assert_called_with(
+            Bucket="bucket", Key="run/blas_lib_gfx94X.tar.xz.sha256sum"
+        )
+
+        mock_s3_client.get_object.side_effect = ClientError(
+            error_response={"Error": {"Code": "NoSuchKey", "Message": "Not Found"}},
+            operation_name="GetObject",
+        )
+        self.assertIsNone(retrieve_published_sha256(request))
+
+    @patch("fetch_artifacts.s3_client")
+    def testArtifactDownloadSize(self, mock_s3_client):
+        listing = RunListing(
+            "bucket",
+            "run/",
+            [
+                ListedObject("run/blas_lib_gfx94X.tar.xz", 1234, '"etag"'),
+                ListedObject("run/nested/fft_lib_gfx94X.tar.xz", 10, '"etag"'),
+            ],
+            listed_at=0.0,
+        )
+        mock_s3_client.head_object.return_value = {"ContentLength": 5678}
+        blas = ArtifactDownloadRequest(
+            "run/blas_lib_gfx94X.tar.xz", "bucket", Path("out/blas_lib_gfx94X.tar.xz")
+        )
+        fft = ArtifactDownloadRequest(
+            "run/fft_lib_gfx94X.tar.xz", "bucket", Path("out/fft_lib_gfx94X.tar.xz")
+        )
+        self.assertEqual(artifact_download_size(blas, listing), 1234)
+        mock_s3_client.head_object.assert_not_called()
+        # Sizes of objects not in the listing are retrieved from S3.
+        self.assertEqual(artifact_download_size(fft, listing), 5678)
+        self.assertEqual(artifact_download_size(blas), 5678)
+
 
 if __name__ == "__main__":
     unittest.main()
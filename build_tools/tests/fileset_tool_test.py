@@ -1,14 +1,18 @@
 import hashlib
+import importlib.util
+import io
 import os
 from pathlib import Path
 import platform
 import shlex
 import subprocess
 import sys
+import tarfile
 import tempfile
 import unittest
 
 sys.path.insert(0, os.fspath(Path(__file__).parent.parent))
+from _therock_utils.archive_util import ArchiveWriter
 from _therock_utils.hash_util import calculate_hash
 
 FILESET_TOOL = Path(__file__).parent.parent / "fileset_tool.py"
@@ -189,6 +193,455 @@ class FilesetToolTest(unittest.TestCase):
         if not is_windows():
             self.assertTrue(is_executable(flat2_dir / "share" / "doc" / "executable"))
 
+    def testArchiveFormats(self):
+        input_dir = self.temp_dir / "input"
+        artifact_dir = self.temp_dir / "artifact_dir"
+        descriptor_file = self.temp_dir / "artifact.toml"
+        write_text(descriptor_file, ARTIFACT_DESCRIPTOR_1)
+        # Large enough to span several xz blocks at preset 0.
+        big_contents = os.urandom(1 << 20) * 3
+        big_file = input_dir / "example" / "stage" / "share" / "doc" / "big.bin"
+        big_file.parent.mkdir(parents=True)
+        big_file.write_bytes(big_contents)
+        exec(
+            [
+                sys.executable,
+                FILESET_TOOL,
+                "artifact",
+                "--descriptor",
+                descriptor_file,
+                "--output-dir",
+                artifact_dir,
+                "--root-dir",
+                input_dir,
+                "--component",
+                "doc",
+            ]
+        )
+
+        extensions = [".tar.xz"]
+        if importlib.util.find_spec("zstandard"):
+            extensions.append(".tar.zst")
+        for extension in extensions:
+            with self.subTest(extension=extension):
+                artifact_archive = self.temp_dir / f"artifact{extension}"
+                flat_dir = self.temp_dir / f"flat{extension}"
+                exec(
+                    [
+                        sys.executable,
+                        FILESET_TOOL,
+                        "artifact-archive",
+                        artifact_dir,
+                        "-o",
+                        artifact_archive,
+                        "--compression-level",
+                        "0",
+                        "--compression-threads",
+                        "4",
+                    ]
+                )
+                exec(
+                    [
+                        sys.executable,
+                        FILESET_TOOL,
+                        "artifact-flatten",
+                        artifact_archive,
+                        "-o",
+                        flat_dir,
+                    ]
+                )
+                self.assertEqual(
+                    (flat_dir / "share" / "doc" / "big.bin").read_bytes(),
+                    big_contents,
+                )
+
+    def testContentStore(self):
+        input_dir = self.temp_dir / "input"
+        store_dir = self.temp_dir / "store"
+        descriptor_file = self.temp_dir / "artifact.toml"
+        write_text(descriptor_file, ARTIFACT_DESCRIPTOR_1)
+        doc_dir = input_dir / "example" / "stage" / "share" / "doc"
+        write_text(doc_dir / "README.txt", "Hello World!")
+        write_text(doc_dir / "COPY.txt", "Hello World!")
+        (doc_dir / "README").symlink_to("README.txt")
+
+        # Two artifacts of the same content share blobs.
+        artifact_dirs = [self.temp_dir / "artifact1", self.temp_dir / "artifact2"]
+        for artifact_dir in artifact_dirs:
+            exec(
+                [
+                    sys.executable,
+                    FILESET_TOOL,
+                    "artifact",
+                    "--descriptor",
+                    descriptor_file,
+                    "--output-dir",
+                    artifact_dir,
+                    "--root-dir",
+                    input_dir,
+                    "--component",
+                    "doc",
+                    "--content-store",
+                    store_dir,
+                ]
+            )
+        readme_relpath = Path("example/stage/share/doc/README.txt")
+        readme_inodes = set(
+            os.stat(artifact_dir / readme_relpath).st_ino
+            for artifact_dir in artifact_dirs
+        )
+        readme_inodes.add(
+            os.stat(artifact_dirs[0] / readme_relpath.with_name("COPY.txt")).st_ino
+        )
+        self.assertEqual(len(readme_inodes), 1)
+        self.assertNotEqual(os.stat(doc_dir / "README.txt").st_ino, readme_inodes.pop())
+        contents_lines = (
+            (artifact_dirs[0] / "artifact_contents.txt").read_text().splitlines()
+        )
+        self.assertIn(
+            "l\t0777\t0\tREADME.txt\texample/stage/share/doc/README", contents_lines
+        )
+
+        # Flattening an archive through the store links existing blobs.
+        artifact_archive = self.temp_dir / "artifact.tar.xz"
+        flat_dir = self.temp_dir / "flat"
+        exec(
+            [
+                sys.executable,
+                FILESET_TOOL,
+                "artifact-archive",
+                artifact_dirs[0],
+                "-o",
+                artifact_archive,
+            ]
+        )
+        exec(
+            [
+                sys.executable,
+                FILESET_TOOL,
+                "artifact-flatten",
+                artifact_archive,
+                "-o",
+                flat_dir,
+                "--content-store",
+                store_dir,
+            ]
+        )
+        self.assertEqual(
+            os.stat(flat_dir / "share" / "doc" / "README.txt").st_ino,
+            os.stat(artifact_dirs[0] / readme_relpath).st_ino,
+        )
+        self.assertEqual(
+            os.readlink(flat_dir / "share" / "doc" / "README"), "README.txt"
+        )
+
+        # Files written while flattening are copied into the store, so
+        # modifying them in place does not affect the store.
+        new_store_dir = self.temp_dir / "new_store"
+        new_flat_dir = self.temp_dir / "new_flat"
+        exec(
+            [
+                sys.executable,
+                FILESET_TOOL,
+                "artifact-flatten",
+                artifact_archive,
+                "-o",
+                new_flat_dir,
+                "--content-store",
+                new_store_dir,
+            ]
+        )
+        with open(new_flat_dir / "share" / "doc" / "README.txt", "a") as f:
+            f.write(" Modified")
+        blobs = [p for p in (new_store_dir / "objects").rglob("*") if p.is_file()]
+        self.assertEqual([p.read_text() for p in blobs], ["Hello World!"])
+
+    def testArchiveSkipUnchanged(self):
+        input_dir = self.temp_dir / "input"
+        artifact_dir = self.temp_dir / "artifact"
+        descriptor_file = self.temp_dir / "artifact.toml"
+        write_text(descriptor_file, ARTIFACT_DESCRIPTOR_1)
+        readme_path = input_dir / "example" / "stage" / "share" / "doc" / "README.txt"
+        write_text(readme_path, "Hello World!")
+        archive = self.temp_dir / "artifact.tar.xz"
+        hash_file = self.temp_dir / "artifact.tar.xz.sha256sum"
+
+        def build() -> str:
+            exec(
+                [
+                    sys.executable,
+                    FILESET_TOOL,
+                    "artifact",
+                    "--descriptor",
+                    descriptor_file,
+                    "--output-dir",
+                    artifact_dir,
+                    "--root-dir",
+                    input_dir,
+                    "--component",
+                    "doc",
+                    "--incremental",
+                    "--contents-manifest",
+                ]
+            )
+            return exec(
+                [
+                    sys.executable,
+                    FILESET_TOOL,
+                    "artifact-archive",
+                    artifact_dir,
+                    "-o",
+                    archive,
+                    "--index",
+                    "--hash-file",
+                    hash_file,
+                    "--skip-unchanged",
+                ]
+            )
+
+        self.assertIn("Archived", build())
+        self.assertIn("is unchanged", build())
+        self.assertEqual(
+            hash_file.read_text(), calculate_hash(archive, "sha256").hexdigest() + "\n"
+        )
+
+        write_text(readme_path, "Changed")
+        self.assertIn("Archived", build())
+        diff = exec(
+            [sys.executable, FILESET_TOOL, "artifact-diff", artifact_dir, archive]
+        )
+        self.assertEqual(diff, "")
+
+    def testArtifactDiff(self):
+        input_dir = self.temp_dir / "input"
+        descriptor_file = self.temp_dir / "artifact.toml"
+        write_text(descriptor_file, ARTIFACT_DESCRIPTOR_1)
+        doc_dir = input_dir / "example" / "stage" / "share" / "doc"
+        write_text(doc_dir / "README.txt", "Hello World!")
+        write_text(doc_dir / "CHANGES.txt", "v1")
+        write_text(doc_dir / "OLD.txt", "Old")
+
+        def make_artifact(artifact_dir: Path):
+            exec(
+                [
+                    sys.executable,
+                    FILESET_TOOL,
+                    "artifact",
+                    "--descriptor",
+                    descriptor_file,
+                    "--output-dir",
+                    artifact_dir,
+                    "--root-dir",
+                    input_dir,
+                    "--component",
+                    "doc",
+                    "--contents-manifest",
+                ]
+            )
+
+        old_dir = self.temp_dir / "old"
+        old_archive = self.temp_dir / "old.tar.xz"
+        make_artifact(old_dir)
+        exec(
+            [
+                sys.executable,
+                FILESET_TOOL,
+                "artifact-archive",
+                old_dir,
+                "-o",
+                old_archive,
+            ]
+        )
+        write_text(doc_dir / "CHANGES.txt", "v2")
+        (doc_dir / "OLD.txt").unlink()
+        write_text(doc_dir / "NEW.txt", "New")
+        new_dir = self.temp_dir / "new"
+        make_artifact(new_dir)
+
+        diff_args = [sys.executable, FILESET_TOOL, "artifact-diff"]
+        self.assertEqual(exec(diff_args + [old_archive, old_dir]), "")
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            exec(diff_args + [old_archive, new_dir])
+        self.assertEqual(
+            cm.exception.output.decode().splitlines(),
+            [
+                "M example/stage/share/doc/CHANGES.txt",
+                "+ example/stage/share/doc/NEW.txt",
+                "- example/stage/share/doc/OLD.txt",
+            ],
+        )
+
+    def testArtifactExtract(self):
+        input_dir = self.temp_dir / "input"
+        artifact_dir = self.temp_dir / "artifact"
+        descriptor_file = self.temp_dir / "artifact.toml"
+        write_text(descriptor_file, ARTIFACT_DESCRIPTOR_1)
+        doc_dir = input_dir / "example" / "stage" / "share" / "doc"
+        write_text(doc_dir / "README.txt", "Hello World!")
+        write_text(doc_dir / "other" / "CHANGES.txt", "Changes")
+        (doc_dir / "README").symlink_to("README.txt")
+        exec(
+            [
+                sys.executable,
+                FILESET_TOOL,
+                "artifact",
+                "--descriptor",
+                descriptor_file,
+                "--output-dir",
+                artifact_dir,
+                "--root-dir",
+                input_dir,
+                "--component",
+                "doc",
+            ]
+        )
+        for index in [True, False]:
+            with self.subTest(index=index):
+                archive = self.temp_dir / f"artifact_{index}.tar.xz"
+                extract_dir = self.temp_dir / f"extract_{index}"
+                exec(
+                    [
+                        sys.executable,
+                        FILESET_TOOL,
+                        "artifact-archive",
+                        artifact_dir,
+                        "-o",
+                        archive,
+                    ]
+                    + (["--index"] if index else [])
+                )
+                self.assertEqual(
+                    Path(f"{archive}.index").exists(), index, "Index not written"
+                )
+                exec(
+                    [
+                        sys.executable,
+                        FILESET_TOOL,
+                        "artifact-extract",
+                        archive,
+                        "-o",
+                        extract_dir,
+                        "--include",
+                        "share/doc/README*",
+                    ]
+                )
+                self.assertEqual(
+                    (extract_dir / "share" / "doc" / "README.txt").read_text(),
+                    "Hello World!",
+                )
+                self.assertEqual(
+                    os.readlink(extract_dir / "share" / "doc" / "README"),
+                    "README.txt",
+                )
+                self.assertFalse((extract_dir / "share" / "doc" / "other").exists())
+
+        # Re-archiving without an index removes the previous archive's index.
+        archive = self.temp_dir / "artifact_True.tar.xz"
+        exec(
+            [
+                sys.executable,
+                FILESET_TOOL,
+                "artifact-archive",
+                artifact_dir,
+                "-o",
+                archive,
+            ]
+        )
+        self.assertFalse(Path(f"{archive}.index").exists())
+
+    def testArtifactExtractHardlinkToExcludedTarget(self):
+        def add_file(tar: tarfile.TarFile, name: str, data: bytes):
+            ti = tarfile.TarInfo(name)
+            ti.size = len(data)
+            tar.addfile(ti, io.BytesIO(data))
+
+        # Archives without an index are read front to back, so the excluded
+        # target's data has been passed by the time the hardlink is reached.
+        for suffix in [".tar.xz", ".tar.zst"]:
+            with self.subTest(suffix=suffix):
+                archive = self.temp_dir / f"artifact{suffix}"
+                extract_dir = self.temp_dir / f"extract{suffix}"
+                with ArchiveWriter(archive, compression_level=1) as writer:
+                    add_file(writer.tar, "artifact_manifest.txt", b"example/stage\n")
+                    add_file(writer.tar, "example/stage/share/LICENSE.txt", b"License")
+                    link = tarfile.TarInfo("example/stage/share/README.license")
+                    link.type = tarfile.LNKTYPE
+                    link.linkname = "example/stage/share/LICENSE.txt"
+                    writer.tar.addfile(link)
+                    add_file(writer.tar, "example/stage/share/README.txt", b"Hello")
+                exec(
+                    [
+                        sys.executable,
+                        FILESET_TOOL,
+                        "artifact-extract",
+                        archive,
+                        "-o",
+                        extract_dir,
+                        "--include",
+                        "share/README*",
+                    ]
+                )
+                self.assertEqual(
+                    (extract_dir / "share" / "README.license").read_text(), "License"
+                )
+                self.assertEqual(
+                    (extract_dir / "share" / "README.txt").read_text(), "Hello"
+                )
+                self.assertFalse((extract_dir / "share" / "LICENSE.txt").exists())
+
+    def testIncrementalArtifact(self):
+        input_dir = self.temp_dir / "input"
+        artifact_dir = self.temp_dir / "artifact_dir"
+        descriptor_file = self.temp_dir / "artifact.toml"
+        doc_dir = input_dir / "example" / "stage" / "share" / "doc"
+        artifact_doc_dir = artifact_dir / "example" / "stage" / "share" / "doc"
+        write_text(descriptor_file, ARTIFACT_DESCRIPTOR_1)
+        write_text(doc_dir / "README.txt", "Hello World!")
+        write_text(doc_dir / "REMOVED.txt", "Going away")
+        (doc_dir / "README").symlink_to("README.txt")
+
+        def make_artifact():
+            exec(
+                [
+                    sys.executable,
+                    FILESET_TOOL,
+                    "artifact",
+                    "--descriptor",
+                    descriptor_file,
+                    "--output-dir",
+                    artifact_dir,
+                    "--root-dir",
+                    input_dir,
+                    "--component",
+                    "doc",
+                    "--incremental",
+                ]
+            )
+
+        make_artifact()
+        self.assertTrue((artifact_doc_dir / "REMOVED.txt").exists())
+
+        # A no-op update does not touch the output directory.
+        old_mtime = os.stat(artifact_doc_dir).st_mtime - 100
+        os.utime(artifact_doc_dir, (old_mtime, old_mtime))
+        make_artifact()
+        self.assertEqual(os.stat(artifact_doc_dir).st_mtime, old_mtime)
+
+        # Additions, removals and changes are reflected.
+        (doc_dir / "REMOVED.txt").unlink()
+        write_text(doc_dir / "ADDED.txt", "New")
+        (doc_dir / "README").unlink()
+        (doc_dir / "README").symlink_to("ADDED.txt")
+        write_text(artifact_doc_dir / "stray.txt", "Not in the fileset")
+        make_artifact()
+        self.assertFalse((artifact_doc_dir / "REMOVED.txt").exists())
+        self.assertFalse((artifact_doc_dir / "stray.txt").exists())
+        self.assertEqual((artifact_doc_dir / "ADDED.txt").read_text(), "New")
+        self.assertEqual(os.readlink(artifact_doc_dir / "README"), "ADDED.txt")
+        self.assertEqual(
+            (artifact_dir / "artifact_manifest.txt").read_text(), "example/stage\n"
+        )
+
 
 if __name__ == "__main__":
     unittest.main()
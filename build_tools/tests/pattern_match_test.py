@@ -0,0 +1,252 @@
+from pathlib import Path
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.fspath(Path(__file__).parent.parent))
+
+from _therock_utils.pattern_match import (
+    MatchPredicate,
+    PatternMatcher,
+    RecursiveGlobPattern,
+)
+from _therock_utils.scan_cache import CachedDirEntry
+
+SAMPLE_PATHS = [
+    "bin",
+    "bin/clang",
+    "bin/hipcc",
+    "include",
+    "include/hip/hip_runtime.h",
+    "lib",
+    "lib/libamdhip64.so",
+    "lib/libamdhip64.so.7",
+    "lib/libamdhip64.a",
+    "lib/cmake/hip/hip-config.cmake",
+    "lib/llvm/lib/clang/20/include/stddef.h",
+    "lib/pkgconfig/hip.pc",
+    "share/doc/hip/README.md",
+    "share/modulefiles/rocm",
+    ".build-id/ab/cdef.debug",
+    "foo.dll",
+    "x/y/z.dylib.1",
+]
+
+
+def sequential_matches(
+    match_path: str,
+    includes: list[str],
+    excludes: list[str],
+    force_includes: list[str],
+) -> bool:
+    """Reference implementation which tests each pattern in turn."""
+    if any(RecursiveGlobPattern(p).matches(match_path, None) for p in force_includes):
+        return True
+    if includes and not any(
+        RecursiveGlobPattern(p).matches(match_path, None) for p in includes
+    ):
+        return False
+    if any(RecursiveGlobPattern(p).matches(match_path, None) for p in excludes):
+        return False
+    return True
+
+
+class MatchPredicateTest(unittest.TestCase):
+    def assertSameAsSequential(self, includes=(), excludes=(), force_includes=()):
+        pred = MatchPredicate(includes, excludes, force_includes)
+        for path in SAMPLE_PATHS:
+            with self.subTest(path=path):
+                self.assertEqual(
+                    pred.matches(path, None),
+                    sequential_matches(
+                        path, list(includes), list(excludes), list(force_includes)
+                    ),
+                )
+
+    def testNoPatterns(self):
+        pred = MatchPredicate()
+        self.assertTrue(all(pred.matches(p, None) for p in SAMPLE_PATHS))
+
+    def testIncludesOnly(self):
+        self.assertSameAsSequential(includes=["bin/**", "**/*.so"])
+
+    def testExcludesOnly(self):
+        self.assertSameAsSequential(excludes=["**/include/**", "lib/*.a"])
+
+    def testForceIncludeOverridesExclude(self):
+        pred = MatchPredicate(
+            includes=["lib/**"],
+            excludes=["**/*.a"],
+            force_includes=["lib/libamdhip64.a"],
+        )
+        self.assertTrue(pred.matches("lib/libamdhip64.a", None))
+        self.assertFalse(pred.matches("bin/clang", None))
+        self.assertSameAsSequential(
+            includes=["lib/**"],
+            excludes=["**/*.a"],
+            force_includes=["lib/libamdhip64.a"],
+        )
+
+    def testComponentDefaultLikePatterns(self):
+        lib = ["**/*.dll", "**/*.dylib", "**/*.dylib.*", "**/*.so", "**/*.so.*"]
+        dev = [
+            "**/*.a",
+            "**/*.lib",
+            "**/cmake/**",
+            "**/include/**",
+            "**/share/modulefiles/**",
+            "**/pkgconfig/**",
+        ]
+        doc = ["**/share/doc/**"]
+        self.assertSameAsSequential(includes=lib, excludes=dev + doc)
+        self.assertSameAsSequential(includes=dev, excludes=lib + doc)
+        self.assertSameAsSequential(
+            includes=[".build-id/**/*.debug"], force_includes=["bin/*"]
+        )
+
+    def testLiteralIndexShapes(self):
+        # Exercise each of the literal index shapes plus the regex fallback.
+        patterns = [
+            "lib/libamdhip64.so",
+            "share/doc/**",
+            "**/llvm/lib/**",
+            "**/*.so.*",
+            "**/*.h",
+            ".build-id/**/*.debug",
+            "**/lib*hip*",
+        ]
+        for pattern in patterns:
+            self.assertSameAsSequential(includes=[pattern])
+            self.assertSameAsSequential(excludes=[pattern])
+        self.assertSameAsSequential(includes=patterns[:3], excludes=patterns[3:])
+
+    def testQuestionMark(self):
+        self.assertSameAsSequential(includes=["bin/hip??"])
+
+
+class PatternMatcherTest(unittest.TestCase):
+    def setUp(self):
+        override_temp = os.getenv("TEST_TMPDIR")
+        if override_temp is not None:
+            self.temp_context = None
+            self.temp_dir = Path(override_temp)
+            self.temp_dir.mkdir(parents=True, exist_ok=True)
+        else:
+            self.temp_context = tempfile.TemporaryDirectory()
+            self.temp_dir = Path(self.temp_context.name)
+        for relpath in SAMPLE_PATHS:
+            p = self.temp_dir / relpath
+            if "." in p.name or p.parent.name == "bin":
+                p.parent.mkdir(parents=True, exist_ok=True)
+                p.touch()
+            else:
+                p.mkdir(parents=True, exist_ok=True)
+
+    def tearDown(self):
+        if self.temp_context:
+            self.temp_context.cleanup()
+
+    def assertSameAsFullScan(self, **kwargs) -> PatternMatcher:
+        full = PatternMatcher()
+        full.add_basedir(self.temp_dir)
+        predicate = MatchPredicate(**kwargs)
+        expected = [
+            relpath
+            for relpath, direntry in full.all.items()
+            if predicate.matches(relpath, direntry)
+        ]
+        pm = PatternMatcher(**kwargs)
+        pm.add_basedir(self.temp_dir)
+        self.assertListEqual([relpath for relpath, _ in pm.matches()], expected)
+        return pm
+
+    def testPrunesNonMatchingSubtrees(self):
+        pm = self.assertSameAsFullScan(includes=["bin/**"])
+        self.assertIn("lib", pm.all)
+        self.assertNotIn("lib/libamdhip64.so", pm.all)
+        self.assertNotIn("lib/llvm/lib/clang/20/include/stddef.h", pm.all)
+
+    def testPrunesExcludedSubtrees(self):
+        pm = self.assertSameAsFullScan(
+            includes=["**/*.so", "**/*.so.*"],
+            excludes=["**/include/**", "share/**"],
+        )
+        self.assertIn("lib/libamdhip64.so.7", pm.all)
+        self.assertNotIn("include/hip/hip_runtime.h", pm.all)
+        self.assertNotIn("share/doc/hip/README.md", pm.all)
+
+    def testForceIncludeDefeatsPruning(self):
+        pm = self.assertSameAsFullScan(
+            includes=["bin/**"],
+            excludes=["**/include/**"],
+            force_includes=["include/hip/*.h"],
+        )
+        self.assertIn("include/hip/hip_runtime.h", pm.all)
+        self.assertNotIn("lib/libamdhip64.so", pm.all)
+
+    def testParallelScanMatchesSequential(self):
+        for kwargs in [
+            {},
+            {"includes": ["bin/**"]},
+            {"includes": ["**/*.so", "**/*.so.*"], "excludes": ["**/include/**"]},
+        ]:
+            with self.subTest(**kwargs):
+                sequential = PatternMatcher(**kwargs, scan_threads=0)
+                sequential.add_basedir(self.temp_dir)
+                parallel = PatternMatcher(**kwargs, scan_threads=4)
+                parallel.add_basedir(self.temp_dir)
+                self.assertListEqual(list(parallel.all), list(sequential.all))
+
+    def testParallelScanMissingDir(self):
+        pm = PatternMatcher(scan_threads=4)
+        with self.assertRaises(FileNotFoundError):
+            pm.add_basedir(self.temp_dir / "does_not_exist")
+
+    def _age_dirs(self):
+        # Listings of recently modified directories are not cached.
+        old_time = os.stat(self.temp_dir).st_mtime - 100
+        for dirpath, _, _ in os.walk(self.temp_dir):
+            os.utime(dirpath, (old_time, old_time))
+
+    def testScanCache(self):
+        cache_dir = self.temp_dir / "cache"
+        scan_dir = self.temp_dir / "lib"
+        (scan_dir / "libfoo.so").symlink_to("libamdhip64.so")
+        self._age_dirs()
+
+        pm1 = PatternMatcher(scan_cache_dir=cache_dir)
+        pm1.add_basedir(scan_dir)
+        self.assertTrue(any(cache_dir.iterdir()))
+        self.assertFalse(any(isinstance(e, CachedDirEntry) for e in pm1.all.values()))
+
+        pm2 = PatternMatcher(scan_cache_dir=cache_dir, scan_threads=4)
+        pm2.add_basedir(scan_dir)
+        self.assertListEqual(list(pm2.all), list(pm1.all))
+        self.assertTrue(all(isinstance(e, CachedDirEntry) for e in pm2.all.values()))
+        self.assertTrue(pm2.all["libfoo.so"].is_symlink())
+        self.assertTrue(pm2.all["cmake"].is_dir())
+        self.assertTrue(pm2.all["libamdhip64.so"].is_file())
+        self.assertEqual(pm2.all["libamdhip64.so"].stat().st_size, 0)
+
+        # Copying works from cached entries.
+        pm2.copy_to(destdir=self.temp_dir / "copy")
+        self.assertEqual(
+            os.readlink(self.temp_dir / "copy" / "libfoo.so"), "libamdhip64.so"
+        )
+        self.assertTrue((self.temp_dir / "copy" / "cmake" / "hip").is_dir())
+
+        # Adding a file invalidates the listing of its directory.
+        (scan_dir / "cmake" / "hip" / "new.cmake").touch()
+        pm3 = PatternMatcher(scan_cache_dir=cache_dir)
+        pm3.add_basedir(scan_dir)
+        self.assertIn("cmake/hip/new.cmake", pm3.all)
+        self.assertIsInstance(pm3.all["libamdhip64.so"], CachedDirEntry)
+
+    def testWildcardSegments(self):
+        self.assertSameAsFullScan(includes=["l*/llvm/**/*.h", "*/hip/*"])
+        self.assertSameAsFullScan(includes=["**"], excludes=["*/cmake/**"])
+
+
+if __name__ == "__main__":
+    unittest.main()
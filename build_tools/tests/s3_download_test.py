@@ -0,0 +1,332 @@
+from pathlib import Path
+import concurrent.futures
+import hashlib
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.fspath(Path(__file__).parent.parent))
+
+from _therock_utils.download_cache import DownloadCache
+from _therock_utils.s3_download import S3Downloader
+
+
+class FakeS3Client:
+    """In-memory stand-in for the subset of the boto3 S3 client API used."""
+
+    def __init__(self, objects: dict[str, bytes], latency: float = 0.0):
+        self.objects = objects
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests: list[tuple[str, str | None]] = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        # Number of upcoming get_object calls which return a truncated body.
+        self.truncate_next = 0
+
+    def head_object(self, *, Bucket: str, Key: str) -> dict:
+        data = self.objects[Key]
+        etag = hashlib.md5(data).hexdigest()
+        return {"ContentLength": len(data), "ETag": f'"{etag}"'}
+
+    def get_object(
+        self,
+        *,
+        Bucket: str,
+        Key: str,
+        Range: str | None = None,
+        IfMatch: str | None = None,
+    ) -> dict:
+        data = self.objects[Key]
+        if IfMatch and IfMatch != self.head_object(Bucket=Bucket, Key=Key)["ETag"]:
+            raise IOError("PreconditionFailed")
+        with self.lock:
+            self.requests.append((Key, Range))
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            truncate = self.truncate_next > 0
+            self.truncate_next -= 1 if truncate else 0
+        try:
+            time.sleep(self.latency)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+        if Range:
+            start, end = Range.removeprefix("bytes=").split("-")
+            data = data[int(start) : int(end) + 1]
+        if truncate:
+            data = data[: len(data) // 2]
+        return {"Body": io.BytesIO(data), "ContentLength": len(data)}
+
+
+class S3DownloaderTest(unittest.TestCase):
+    def setUp(self):
+        override_temp = os.getenv("TEST_TMPDIR")
+        if override_temp is not None:
+            self.temp_context = None
+            self.temp_dir = Path(override_temp)
+            self.temp_dir.mkdir(parents=True, exist_ok=True)
+        else:
+            self.temp_context = tempfile.TemporaryDirectory()
+            self.temp_dir = Path(self.temp_context.name)
+
+    def tearDown(self):
+        if self.temp_context:
+            self.temp_context.cleanup()
+
+    def testRangedDownload(self):
+        data = os.urandom(10000)
+        client = FakeS3Client({"big": data, "small": b"hello", "empty": b""})
+        with S3Downloader(client, part_size=1024) as downloader:
+            for key in ["big", "small", "empty"]:
+                output_path = self.temp_dir / key
+                size = downloader.download("bucket", key, output_path)
+                self.assertEqual(output_path.read_bytes(), client.objects[key])
+                self.assertEqual(size, len(client.objects[key]))
+        big_ranges = [r for key, r in client.requests if key == "big"]
+        self.assertEqual(len(big_ranges), 10)
+        self.assertIn("bytes=9216-9999", big_ranges)
+
+    def testRetriesFailedRange(self):
+        data = os.urandom(4096)
+        client = FakeS3Client({"key": data})
+        client.truncate_next = 2
+        with S3Downloader(client, part_size=1024, base_delay=0.0) as downloader:
+            downloader.download("bucket", "key", self.temp_dir / "out")
+        self.assertEqual((self.temp_dir / "out").read_bytes(), data)
+        self.assertEqual(len(client.requests), 6)
+
+    def testFailureKeepsPartial(self):
+        data = os.urandom(4096)
+        client = FakeS3Client({"key": data})
+        client.truncate_next = 100
+        output_path = self.temp_dir / "out"
+        with S3Downloader(
+            client, part_size=1024, max_retries=2, base_delay=0.0
+        ) as downloader:
+            with self.assertRaises(IOError):
+                downloader.download("bucket", "key", output_path)
+            self.assertFalse(output_path.exists())
+            self.assertTrue((self.temp_dir / ".partial" / "out").exists())
+
+            client.truncate_next = 0
+            downloader.download("bucket", "key", output_path)
+        self.assertEqual(output_path.read_bytes(), data)
+        self.assertFalse((self.temp_dir / ".partial").exists())
+
+    def testFailureWaitsForRanges(self):
+        client = FakeS3Client({"key": os.urandom(4096)}, latency=0.1)
+        with S3Downloader(client, part_size=1024, max_retries=1) as downloader:
+            submit = downloader.executor.submit
+            calls = 0
+
+            def failing_submit(*args, **kwargs):
+                nonlocal calls
+                calls += 1
+                if calls == 3:
+                    raise RuntimeError("cannot schedule new futures")
+                return submit(*args, **kwargs)
+
+            downloader.executor.submit = failing_submit
+            with self.assertRaises(RuntimeError):
+                downloader.download("bucket", "key", self.temp_dir / "out")
+        # The ranges already submitted finished before the output was closed.
+        self.assertEqual(len(client.requests), 2)
+        self.assertEqual(client.in_flight, 0)
+
+    def testCancel(self):
+        data = os.urandom(4096)
+        client = FakeS3Client({"key": data}, latency=0.1)
+        output_path = self.temp_dir / "out"
+        cancel = threading.Event()
+        with S3Downloader(
+            client, part_size=1024, max_concurrency=1, base_delay=0.0
+        ) as downloader:
+            timer = threading.Timer(0.15, cancel.set)
+            timer.start()
+            with self.assertRaisesRegex(IOError, "cancelled"):
+                downloader.download("bucket", "key", output_path, cancel=cancel)
+            timer.join()
+            # Ranges queued behind the cancellation were not fetched, and are
+            # fetched when the download is resumed.
+            self.assertLess(len(client.requests), 4)
+            client.requests.clear()
+            downloader.download("bucket", "key", output_path)
+            self.assertEqual(output_path.read_bytes(), data)
+            self.assertEqual(len(client.requests), 3)
+
+    def testResume(self):
+        data = os.urandom(4096)
+        client = FakeS3Client({"key": data})
+        output_path = self.temp_dir / "out"
+        with S3Downloader(client, part_size=1024, max_retries=1) as downloader:
+            # Fail the last range, after the others have completed.
+            original_get_object = client.get_object
+
+            def get_object(**kwargs):
+                if kwargs["Range"] == "bytes=3072-4095":
+                    raise IOError("Connection reset")
+                return original_get_object(**kwargs)
+
+            client.get_object = get_object
+            with self.assertRaisesRegex(IOError, "Connection reset"):
+                downloader.download("bucket", "key", output_path)
+            client.get_object = original_get_object
+
+            # Only the missing ranges are fetched, and the result is verified.
+            client.requests.clear()
+            downloader.download(
+                "bucket", "key", output_path, sha256=hashlib.sha256(data).hexdigest()
+            )
+            self.assertEqual(output_path.read_bytes(), data)
+            self.assertEqual(client.requests, [("key", "bytes=3072-4095")])
+
+    def testResumeChangedObject(self):
+        client = FakeS3Client({"key": os.urandom(4096)})
+        client.truncate_next = 100
+        output_path = self.temp_dir / "out"
+        with S3Downloader(
+            client, part_size=1024, max_retries=1, base_delay=0.0
+        ) as downloader:
+            with self.assertRaises(IOError):
+                downloader.download("bucket", "key", output_path)
+
+            # The object's ETag changed, so the partial download is discarded.
+            client.truncate_next = 0
+            client.objects["key"] = os.urandom(4096)
+            client.requests.clear()
+            downloader.download("bucket", "key", output_path)
+            self.assertEqual(output_path.read_bytes(), client.objects["key"])
+            self.assertEqual(len(client.requests), 4)
+
+    def testOpenStream(self):
+        data = os.urandom(10000)
+        client = FakeS3Client({"key": data}, latency=0.01)
+        client.truncate_next = 1
+        with S3Downloader(client, base_delay=0.0) as downloader:
+            with downloader.open_stream(
+                "bucket", "key", part_size=1024, read_ahead=3
+            ) as stream:
+                chunks = []
+                while chunk := stream.read(1000):
+                    chunks.append(chunk)
+        self.assertEqual(b"".join(chunks), data)
+        # 10 ranges, one of which was retried.
+        self.assertEqual(len(client.requests), 11)
+        self.assertLessEqual(client.max_in_flight, 3)
+
+    def testCache(self):
+        client = FakeS3Client({"key": os.urandom(4096), "streamed": os.urandom(4096)})
+        cache = DownloadCache(self.temp_dir / "cache")
+        with S3Downloader(client, part_size=1024, cache=cache) as downloader:
+            for i in range(2):
+                downloader.download("bucket", "key", self.temp_dir / f"out{i}")
+                self.assertEqual(
+                    (self.temp_dir / f"out{i}").read_bytes(), client.objects["key"]
+                )
+            self.assertEqual(len(client.requests), 4)
+
+            for i in range(2):
+                with downloader.open_stream(
+                    "bucket", "streamed", part_size=1024
+                ) as stream:
+                    self.assertEqual(stream.read(), client.objects["streamed"])
+            self.assertEqual(len(client.requests), 8)
+
+            # A modified object has a different ETag.
+            client.objects["key"] = b"modified"
+            downloader.download("bucket", "key", self.temp_dir / "out2")
+            self.assertEqual((self.temp_dir / "out2").read_bytes(), b"modified")
+        self.assertEqual((cache.hits, cache.misses), (2, 3))
+
+    def testStreamOfReplacedObjectIsNotCached(self):
+        client = FakeS3Client({"key": os.urandom(4096)})
+        cache = DownloadCache(self.temp_dir / "cache")
+        with S3Downloader(
+            client, part_size=1024, max_retries=1, cache=cache
+        ) as downloader:
+            with downloader.open_stream(
+                "bucket", "key", part_size=1024, read_ahead=1
+            ) as stream:
+                stream.read(1024)
+                # Replaced after the first range, so later ranges do not match.
+                client.objects["key"] = os.urandom(4096)
+                with self.assertRaisesRegex(IOError, "PreconditionFailed"):
+                    stream.read()
+        # Nothing was committed to the cache under the original ETag.
+        self.assertEqual(
+            [p for p in (self.temp_dir / "cache").rglob("*") if p.is_file()], []
+        )
+
+    def testVerifySha256(self):
+        data = os.urandom(4096)
+        sha256 = hashlib.sha256(data).hexdigest()
+        client = FakeS3Client({"key": data})
+        with S3Downloader(client, part_size=1024, max_retries=1) as downloader:
+            downloader.download("bucket", "key", self.temp_dir / "out", sha256=sha256)
+            self.assertEqual((self.temp_dir / "out").read_bytes(), data)
+            with self.assertRaisesRegex(IOError, "sha256 mismatch"):
+                downloader.download(
+                    "bucket", "key", self.temp_dir / "bad", sha256="0" * 64
+                )
+            self.assertFalse((self.temp_dir / "bad").exists())
+            self.assertFalse((self.temp_dir / ".partial").exists())
+
+            with downloader.open_stream(
+                "bucket", "key", part_size=1024, sha256=sha256
+            ) as stream:
+                self.assertEqual(stream.read(), data)
+            with downloader.open_stream(
+                "bucket", "key", part_size=1024, sha256="0" * 64
+            ) as stream:
+                # The leading ranges are handed over before the digest is known.
+                for start in range(0, 3072, 1024):
+                    self.assertEqual(stream.read(1024), data[start : start + 1024])
+                with self.assertRaisesRegex(IOError, "sha256 mismatch"):
+                    stream.read()
+
+    def testCacheByDigest(self):
+        data = os.urandom(4096)
+        sha256 = hashlib.sha256(data).hexdigest()
+        client = FakeS3Client({"run1/key": data, "run2/key": data})
+        cache = DownloadCache(self.temp_dir / "cache")
+        with S3Downloader(client, part_size=1024, cache=cache) as downloader:
+            with self.assertRaises(IOError):
+                downloader.download(
+                    "bucket", "run1/key", self.temp_dir / "bad", sha256="0" * 64
+                )
+            # Identical contents under different keys share a cache entry.
+            downloader.download(
+                "bucket", "run1/key", self.temp_dir / "out1", sha256=sha256
+            )
+            downloader.download(
+                "bucket", "run2/key", self.temp_dir / "out2", sha256=sha256
+            )
+        self.assertEqual((self.temp_dir / "out2").read_bytes(), data)
+        self.assertEqual(len(client.requests), 8)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def testConcurrencyIsGlobal(self):
+        objects = {f"key{i}": os.urandom(8192) for i in range(4)}
+        client = FakeS3Client(objects, latency=0.01)
+        with S3Downloader(client, part_size=1024, max_concurrency=3) as downloader:
+            with concurrent.futures.ThreadPoolExecutor(4) as executor:
+                futures = [
+                    executor.submit(
+                        downloader.download, "bucket", key, self.temp_dir / key
+                    )
+                    for key in objects
+                ]
+                for future in futures:
+                    future.result()
+        for key, data in objects.items():
+            self.assertEqual((self.temp_dir / key).read_bytes(), data)
+        self.assertEqual(client.max_in_flight, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+from pathlib import Path
+import os
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.fspath(Path(__file__).parent.parent))
+
+from _therock_utils.artifacts import ArtifactName
+from _therock_utils.s3_listing import RunListing
+
+
+def make_paginator(keys: list[str]) -> mock.Mock:
+    paginator = mock.Mock()
+    paginator.paginate.return_value = [
+        {"Contents": [{"Key": key, "Size": 10, "ETag": '"etag"'} for key in keys]},
+        {},
+    ]
+    return paginator
+
+
+class RunListingTest(unittest.TestCase):
+    def setUp(self):
+        override_temp = os.getenv("TEST_TMPDIR")
+        if override_temp is not None:
+            self.temp_context = None
+            self.temp_dir = Path(override_temp)
+            self.temp_dir.mkdir(parents=True, exist_ok=True)
+        else:
+            self.temp_context = tempfile.TemporaryDirectory()
+            self.temp_dir = Path(self.temp_context.name)
+
+    def tearDown(self):
+        if self.temp_context:
+            self.temp_context.cleanup()
+
+    def testArtifacts(self):
+        listing = RunListing.list(
+            make_paginator(
+                [
+                    "run/blas_lib_gfx94X.tar.xz",
+                    "run/blas_lib_gfx94X.tar.xz.sha256sum",
+                    "run/blas_lib_gfx94X-dcgpu.tar.xz",
+                    "run/base_lib_generic.tar.zst",
+                    "run/index-gfx94X.html",
+                ]
+            ),
+            "bucket",
+            "run/",
+        )
+        self.assertEqual(
+            listing.get("blas_lib_gfx94X.tar.xz.sha256sum").key,
+            "run/blas_lib_gfx94X.tar.xz.sha256sum",
+        )
+        artifacts = listing.artifacts(["gfx94X", "generic"])
+        self.assertEqual(
+            sorted(o.filename for o in artifacts.values()),
+            ["base_lib_generic.tar.zst", "blas_lib_gfx94X.tar.xz"],
+        )
+        self.assertEqual(artifacts[ArtifactName("blas", "lib", "gfx94X")].size, 10)
+        self.assertEqual(len(listing.artifacts()), 3)
+        self.assertEqual(len(listing.registry(["gfx94X-dcgpu"])), 1)
+
+    def testCached(self):
+        cache_path = self.temp_dir / "listing.json"
+        paginator = make_paginator(["run/blas_lib_gfx94X.tar.xz"])
+        first = RunListing.cached(paginator, "bucket", "run/", cache_path, ttl=60)
+        second = RunListing.cached(paginator, "bucket", "run/", cache_path, ttl=60)
+        self.assertEqual(paginator.paginate.call_count, 1)
+        self.assertEqual(second.objects, first.objects)
+
+        # A different prefix, an expired listing or a TTL of 0 lists again.
+        RunListing.cached(paginator, "bucket", "other/", cache_path, ttl=60)
+        self.assertEqual(paginator.paginate.call_count, 2)
+        with mock.patch("time.time", return_value=time.time() + 120):
+            RunListing.cached(paginator, "bucket", "other/", cache_path, ttl=60)
+        self.assertEqual(paginator.paginate.call_count, 3)
+        RunListing.cached(paginator, "bucket", "other/", cache_path, ttl=0)
+        self.assertEqual(paginator.paginate.call_count, 4)
+
+        cache_path.write_text("corrupt")
+        self.assertIsNone(RunListing.load(cache_path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -8,6 +8,12 @@
 # there is just this one for now.
 set_property(GLOBAL PROPERTY THEROCK_DIST_ARTIFACT_DIRS)
 
+# Property containing the slice names of all artifacts created via
+# therock_provide_artifact(). Each slice also has global properties
+# THEROCK_ARTIFACT_${slice_name}_{COMPONENTS,SUBPROJECT_DEPS} recording its
+# arguments, from which therock_write_artifact_graph() derives dependencies.
+set_property(GLOBAL PROPERTY THEROCK_ARTIFACT_SLICES)
+
 function(therock_provide_artifact slice_name)
   cmake_parse_arguments(PARSE_ARGV 1 ARG
     "TARGET_NEUTRAL"
@@ -35,6 +41,9 @@ function(therock_provide_artifact slice_name)
   if(NOT ARG_DESCRIPTOR)
     set(ARG_DESCRIPTOR "artifact.toml")
   endif()
+  set_property(GLOBAL APPEND PROPERTY THEROCK_ARTIFACT_SLICES "${slice_name}")
+  set_property(GLOBAL PROPERTY "THEROCK_ARTIFACT_${slice_name}_COMPONENTS" ${ARG_COMPONENTS})
+  set_property(GLOBAL PROPERTY "THEROCK_ARTIFACT_${slice_name}_SUBPROJECT_DEPS" ${ARG_SUBPROJECT_DEPS})
   cmake_path(ABSOLUTE_PATH ARG_DESCRIPTOR BASE_DIRECTORY "${CMAKE_CURRENT_SOURCE_DIR}")
 
   # We make all artifact slices available as therock-artifacts top-level target.
@@ -59,6 +68,19 @@ function(therock_provide_artifact slice_name)
 
   # Assemble commands.
   set(_fileset_tool "${THEROCK_SOURCE_DIR}/build_tools/fileset_tool.py")
+  # Directory listings of stage/ trees are cached between invocations so that
+  # incremental builds only re-list directories that changed.
+  set(_fileset_tool_env
+    "${CMAKE_COMMAND}" -E env
+    "THEROCK_FILESET_SCAN_CACHE_DIR=${THEROCK_BINARY_DIR}/.fileset_scan_cache"
+  )
+  # With a content store, artifact files are deduplicated into it and each
+  # artifact gets an artifact_contents.txt, which also lets unchanged archives
+  # be kept rather than recompressed (see --skip-unchanged below).
+  set(_content_store_args)
+  if(THEROCK_ARTIFACT_CONTENT_STORE_DIR)
+    set(_content_store_args --content-store "${THEROCK_ARTIFACT_CONTENT_STORE_DIR}")
+  endif()
   set(_command_list)
   set(_manifest_files)
   foreach(_component ${ARG_COMPONENTS})
@@ -67,10 +89,10 @@ function(therock_provide_artifact slice_name)
     set(_manifest_file "${_component_dir}/artifact_manifest.txt")
     list(APPEND _manifest_files "${_manifest_file}")
     list(APPEND _command_list
-      COMMAND "${Python3_EXECUTABLE}" "${_fileset_tool}" artifact
+      COMMAND ${_fileset_tool_env} "${Python3_EXECUTABLE}" "${_fileset_tool}" artifact
         --output-dir "${_component_dir}"
         --root-dir "${THEROCK_BINARY_DIR}" --descriptor "${ARG_DESCRIPTOR}"
-        --component "${_component}"
+        --component "${_component}" --incremental ${_content_store_args}
     )
   endforeach()
 
@@ -98,6 +120,7 @@ function(therock_provide_artifact slice_name)
     set(_archive_file "${THEROCK_BINARY_DIR}/artifacts/${slice_name}_${_component}${_bundle_suffix}${THEROCK_ARTIFACT_ARCHIVE_SUFFIX}.tar.xz")
     list(APPEND _archive_files "${_archive_file}")
     set(_archive_sha_file "${_archive_file}.sha256sum")
+    set(_archive_index_file "${_archive_file}.index")
     # TODO(#726): Lower compression levels are much faster for development and CI.
     #             Set back to 6+ for production builds?
     set(_archive_compression_level 2)
@@ -105,16 +128,22 @@ function(therock_provide_artifact slice_name)
       OUTPUT
         "${_archive_file}"
         "${_archive_sha_file}"
+        "${_archive_index_file}"
       COMMENT "Creating archive ${_archive_file}"
       COMMAND
         "${Python3_EXECUTABLE}" "${_fileset_tool}"
         artifact-archive "${_component_dir}"
           -o "${_archive_file}"
           --compression-level "${_archive_compression_level}"
+          --compression-threads "${THEROCK_ARTIFACT_ARCHIVE_THREADS}"
+          --index
           --hash-file "${_archive_sha_file}" --hash-algorithm sha256
+          --skip-unchanged
       DEPENDS
         "${_manifest_file}"
         "${_fileset_tool}"
+      # Sized for THEROCK_ARTIFACT_ARCHIVE_THREADS threads per archive step.
+      JOB_POOL therock_archive
     )
   endforeach()
 
@@ -153,3 +182,65 @@ function(therock_create_dist)
   endif()
   add_dependencies(therock-dist "${_dist_target_name}")
 endfunction()
+
+
+# Writes artifacts/artifact_graph_${THEROCK_AMDGPU_DIST_BUNDLE_NAME}.json,
+# a machine readable description of every artifact slice, its components and
+# the slices it depends on at runtime:
+#   {"version": 1, "artifacts": {"blas": {"components": [...], "deps": [...]}}}
+# A slice depends on another if any of its subprojects has a (transitive)
+# RUNTIME_DEPS on a subproject of the other. It is uploaded alongside the
+# artifact archives so that fetchers can resolve the dependency closure of
+# the artifacts they need (see build_tools/_therock_utils/artifact_graph.py).
+# Must be called after all subprojects and artifacts are declared.
+function(therock_write_artifact_graph)
+  get_property(_slices GLOBAL PROPERTY THEROCK_ARTIFACT_SLICES)
+  # Map each subproject to the slice which contains it.
+  foreach(_slice ${_slices})
+    get_property(_subprojects GLOBAL PROPERTY "THEROCK_ARTIFACT_${_slice}_SUBPROJECT_DEPS")
+    foreach(_subproject ${_subprojects})
+      set("_slice_of_${_subproject}" "${_slice}")
+    endforeach()
+  endforeach()
+
+  set(_json "{\"version\": 1, \"artifacts\": {}}")
+  foreach(_slice ${_slices})
+    get_property(_components GLOBAL PROPERTY "THEROCK_ARTIFACT_${_slice}_COMPONENTS")
+    get_property(_subprojects GLOBAL PROPERTY "THEROCK_ARTIFACT_${_slice}_SUBPROJECT_DEPS")
+    set(_deps)
+    foreach(_subproject ${_subprojects})
+      if(NOT TARGET "${_subproject}")
+        continue()
+      endif()
+      get_target_property(_runtime_deps "${_subproject}" THEROCK_RUNTIME_DEPS)
+      if(NOT _runtime_deps)
+        continue()
+      endif()
+      foreach(_runtime_dep ${_runtime_deps})
+        set(_dep_slice "${_slice_of_${_runtime_dep}}")
+        if(_dep_slice AND NOT _dep_slice STREQUAL _slice)
+          list(APPEND _deps "${_dep_slice}")
+        endif()
+      endforeach()
+    endforeach()
+    list(REMOVE_DUPLICATES _deps)
+    list(SORT _deps)
+
+    set(_entry "{\"components\": [], \"deps\": []}")
+    set(_i 0)
+    foreach(_component ${_components})
+      string(JSON _entry SET "${_entry}" components ${_i} "\"${_component}\"")
+      math(EXPR _i "${_i} + 1")
+    endforeach()
+    set(_i 0)
+    foreach(_dep ${_deps})
+      string(JSON _entry SET "${_entry}" deps ${_i} "\"${_dep}\"")
+      math(EXPR _i "${_i} + 1")
+    endforeach()
+    string(JSON _json SET "${_json}" artifacts "${_slice}" "${_entry}")
+  endforeach()
+
+  set(_graph_file "${THEROCK_BINARY_DIR}/artifacts/artifact_graph_${THEROCK_AMDGPU_DIST_BUNDLE_NAME}.json")
+  # Only touch the file if it changed.
+  file(CONFIGURE OUTPUT "${_graph_file}" CONTENT "${_json}\n" @ONLY)
+endfunction()
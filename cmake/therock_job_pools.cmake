@@ -12,6 +12,20 @@ function(therock_setup_job_pools)
   endif()
 
   set_property(GLOBAL APPEND PROPERTY JOB_POOLS therock_background=${_background_jobs})
+
+  # Each artifact archive step compresses with THEROCK_ARTIFACT_ARCHIVE_THREADS
+  # threads, so limit how many run at once to roughly fill the cores.
+  set(_archive_threads "${THEROCK_ARTIFACT_ARCHIVE_THREADS}")
+  if(NOT _archive_threads OR _archive_threads LESS_EQUAL 0)
+    # Not yet cached on the first configure (see CMakeLists.txt).
+    set(_archive_threads 4)
+  endif()
+  ProcessorCount(CORE_COUNT)
+  math(EXPR _archive_jobs "${CORE_COUNT} / ${_archive_threads}")
+  if(_archive_jobs LESS 1)
+    set(_archive_jobs 1)
+  endif()
+  set_property(GLOBAL APPEND PROPERTY JOB_POOLS therock_archive=${_archive_jobs})
 endfunction()
 
 therock_setup_job_pools()